@@ -1,24 +1,122 @@
+import sqlite3
+from concurrent.futures import wait
 from secrets import token_urlsafe
-from typing import Any, Optional, List, Union, Dict
+from typing import Any, Optional, List, Union, Dict, TYPE_CHECKING
 
-from fastapi import FastAPI, Body, HTTPException, Query
+from fastapi import FastAPI, Body, HTTPException, Query, Request, Response
 from fastapi.param_functions import Depends
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.security.utils import get_authorization_scheme_param
 from fmcapi.fmc import AuthenticationError
 from requests.exceptions import ConnectionError
-from sse_starlette.sse import EventSourceResponse
-
-from app.api_utils import get_session, domain_dependency, device_domain_dependency, sessions, get_login_response, \
-    yield_when_task_done
-from app.fmc_session import FMCSession
-from app.models import LoginResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.api_utils import get_session, domain_dependency, device_workspace_dependency, workspace_dependency, \
+    get_login_response, yield_when_task_done, yield_deployment_phases, load_session, save_session, is_admin_token, \
+    is_admin_session, get_member_token, fleet_dependency, get_fleet_login_response
+from app.batch_merge import plan_batch_merge, run_batch_merge, submit_batch_deployment, CONFLICT_POLICIES
+from app.constants import BATCH_MERGE_MIN_TOPOLOGIES, BATCH_MERGE_PARALLEL_HUBS, MERGED_TOPOLOGY_TYPES, \
+    STATUS_HEARTBEAT_SECONDS, PROFILE_SAMPLE_SECONDS
+from app.deployment import deployment_jobs
+from app.fmc_recorder import start_fmc_traffic_capture, stop_fmc_traffic_capture
+from app.fleet import get_fleet_devices, get_fleet_topologies
+from app.fmc_session import FMCSession, MergeWorkspace
+from app.inventory import to_fmc_json
+from app.merge_journal import MergeJournal
+from app.models import LoginResponse, FleetLoginResponse, FleetMember
+from app.profiler import SamplingProfiler, save_profile, load_profile
+from app.session_store import session_store
 from app.utils import enable_cors
 
+if TYPE_CHECKING:
+    from sse_starlette.sse import EventSourceResponse
+
 app = FastAPI(title="FMC topology merge tool", description="Merge point-to-point topologies into a new or existing hub-and-spoke topology")
 
 enable_cors(app)
 
 
+@app.middleware("http")
+async def save_session_state(request: Request, call_next) -> Response:
+    """
+    Store the state of the session used by the request before responding so that the next request can be served by
+        any worker process.
+
+    :param request:
+    :param call_next: Route handler
+    :return: Response of the route
+    """
+    response = await call_next(request)
+    fmc_session = getattr(request.state, "fmc_session", None)
+    if fmc_session is not None:
+        await run_in_threadpool(save_session, fmc_session)
+    return response
+
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next) -> Response:
+    """
+    Profile the request if asked by an admin (`PROFILE_ADMIN_USERS`) through "X-Profile" header or "profile" query
+        parameter. The ID of the stored profile is returned in "X-Profile-Id" header (see "/profiles/{profile_id}").
+
+    :param request:
+    :param call_next: Route handler
+    :return: Response of the route
+    """
+    if "x-profile" not in request.headers and "profile" not in request.query_params:
+        return await call_next(request)
+    token = get_authorization_scheme_param(request.headers.get("authorization"))[1]
+    if not await run_in_threadpool(is_admin_token, token):
+        return await call_next(request)
+    with SamplingProfiler(PROFILE_SAMPLE_SECONDS) as profiler:
+        response = await call_next(request)
+    profile_id = token_urlsafe(8)
+    await run_in_threadpool(save_profile, profile_id, request.url.path, profiler)
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+@app.on_event("startup")
+def capture_fmc_traffic() -> None:
+    """
+    Record or replay the FMC traffic if `FMC_RECORD_PATH` or `FMC_REPLAY_PATH` is set.
+    """
+    start_fmc_traffic_capture()
+
+
+@app.on_event("shutdown")
+def stop_fmc_traffic() -> None:
+    """
+    Close the FMC traffic cassette and restore the requests transport.
+    """
+    stop_fmc_traffic_capture()
+
+
+@app.get("/health")
+def health() -> dict[str, bool]:
+    """
+    Liveness probe.
+
+    :return: Always ready once the routes are loaded (see `app.asgi`)
+    """
+    return {"ready": True}
+
+
+@app.get("/ready")
+def ready() -> dict[str, bool]:
+    """
+    Readiness probe. The routes are loaded and the session store is reachable.
+
+    :return: Readiness
+    """
+    try:
+        session_store.connection.execute("SELECT 1")
+    except sqlite3.Error:
+        raise HTTPException(status_code=503, detail="Session store unavailable")
+    return {"ready": True}
+
+
 @app.post("/token", response_model=LoginResponse)
 def login(creds: OAuth2PasswordRequestForm = Depends()) -> dict[str, Union[str, dict[str, str]]]:
     """
@@ -35,6 +133,40 @@ def login(creds: OAuth2PasswordRequestForm = Depends()) -> dict[str, Union[str,
         raise HTTPException(status_code=403, detail="Invalid credentials")
 
 
+@app.post("/fleet", response_model=FleetLoginResponse)
+def fleet_login(members: List[FleetMember] = Body(..., min_items=1)) -> dict[str, Union[str, dict]]:
+    """
+    Login to several FMC hosts and get a fleet token. Their inventories are fetched in parallel. The fleet token
+        with `host` query parameter is accepted by every route to work on that FMC (e.g. to merge).
+
+    :param members: FMC hosts with their credentials
+    :return: Fleet token, the domains of each host and the hosts failed to login
+    """
+    return get_fleet_login_response(members)
+
+
+@app.get("/fleet/devices")
+def get_fleet_devices_view(fleet_sessions: dict[str, FMCSession] = Depends(fleet_dependency)) -> dict[str, list]:
+    """
+    Get the devices of the topologies of all FMC hosts of the fleet.
+
+    :param fleet_sessions:
+    :return: Devices with their host and domain and the domains still being fetched
+    """
+    return get_fleet_devices(fleet_sessions)
+
+
+@app.get("/fleet/topologies")
+def get_fleet_topologies_view(fleet_sessions: dict[str, FMCSession] = Depends(fleet_dependency)) -> dict[str, list]:
+    """
+    Get the topologies of all FMC hosts of the fleet.
+
+    :param fleet_sessions:
+    :return: Topologies with their host and domain and the domains still being fetched
+    """
+    return get_fleet_topologies(fleet_sessions)
+
+
 @app.get("/domains", response_model=Dict[str, str])
 def get_domains(fmc_session: FMCSession = Depends(get_session)) -> dict[str, str]:
     """
@@ -47,14 +179,15 @@ def get_domains(fmc_session: FMCSession = Depends(get_session)) -> dict[str, str
 
 
 @app.get("/devices")
-def get_devices(fmc_session: FMCSession = Depends(domain_dependency)) -> Any:
+def get_devices(fmc_session: FMCSession = Depends(domain_dependency), refresh: bool = False) -> Any:
     """
-    Get list of devices registered on FMC.
+    Get list of devices registered on FMC with their VPN topology counts (cached per domain).
 
     :param fmc_session:
+    :param refresh: Fetch the devices from FMC even if cached
     :return: List of device objects
     """
-    return fmc_session.get_registered_devices()
+    return fmc_session.get_registered_devices(refresh)
 
 
 @app.get("/hns-topologies", response_model=List[dict[str, Any]])
@@ -67,91 +200,268 @@ def get_topologies(fmc_session: FMCSession = Depends(domain_dependency)) -> list
     :return: List of HNS topology objects
     """
     fmc_session.fetch_topologies()
-    return fmc_session.hns_topologies
+    return to_fmc_json(fmc_session.hns_topologies)
+
+
+@app.get("/mesh-topologies", response_model=List[dict[str, Any]])
+def get_mesh_topologies(fmc_session: FMCSession = Depends(domain_dependency)) -> list[dict]:
+    """
+    Get list of all Full Mesh topologies. Point-to-point topologies can be merged into them like into the hub and spoke
+        topologies (see "/hns-p2p-topologies").
+
+    :param fmc_session:
+    :return: List of full mesh topology objects
+    """
+    wait(fmc_session.pending_futures["topologies"])
+    return to_fmc_json(fmc_session.mesh_topologies)
 
 
 @app.get("/hns-p2p-topologies", response_model=List[dict[str, Any]])
-def get_topologies(hns_topology_id: str, fmc_session: FMCSession = Depends(domain_dependency)) -> \
+def get_topologies(hns_topology_id: str, workspace: MergeWorkspace = Depends(workspace_dependency)) -> \
 list[dict]:
     """
     Get list of point-to-point topologies which can be merged into specified hub-and-spoke topology.
 
     :param hns_topology_id: ID of an existing topology to merge with the point-to-point topologies
-    :param fmc_session:
+    :param workspace:
     :return: List of point-to-point topology objects
     """
-    fmc_session.set_hns_topology_id(hns_topology_id)
-    return fmc_session.hns_p2p_topologies
+    return to_fmc_json(workspace.set_hns_topology_id(hns_topology_id))
 
 
 @app.get("/p2p-topologies", response_model=List[dict[str, Any]])
-def get_topologies(device_id: str = Query(...), fmc_session: FMCSession = Depends(device_domain_dependency)) -> list[
-    dict]:
+def get_topologies(device_id: str = Query(...), workspace: MergeWorkspace = Depends(device_workspace_dependency)) -> \
+list[dict]:
     """
     Get point-to-point topologies having specific device as one thier endpoint.
 
     :param device_id: The device ID of the endpoint.
-    :param fmc_session:
+    :param workspace:
     :return: The list of point-to-point topology objects
     """
-    return fmc_session.p2p_topologies[device_id]
+    return to_fmc_json(workspace.fmc_session.p2p_topologies[device_id])
 
 
 @app.post("/conflicts")
-def get_conflicts(fmc_session: FMCSession = Depends(domain_dependency),
+def get_conflicts(workspace: MergeWorkspace = Depends(workspace_dependency),
                   topology_ids: list[str] = Body(..., embed=True)) -> dict[str, Any]:
     """
     Get topology conflicts for a set of point-to-point topologies to be merged.
 
-    :param fmc_session:
+    :param workspace:
     :param topology_ids: List of topologies to be merged
     :return: Conflicts for each merged topology (currently single merged topology returned)
     """
-    return fmc_session.get_topology_conflicts(topology_ids)
+    return workspace.get_topology_conflicts(topology_ids)
 
 
 @app.post("/hns-topology", response_model=List[dict])
-def create_hns_topologies(fmc_session: FMCSession = Depends(domain_dependency),
+def create_hns_topologies(workspace: MergeWorkspace = Depends(workspace_dependency),
                           override: Optional[dict[str, Any]] = Body(None),
                           hns_topology_id: Optional[str] = Body(None),
-                          p2p_topology_ids: list[str] = Body(..., embed=True)) -> list[dict]:
+                          p2p_topology_ids: list[str] = Body(..., embed=True),
+                          topology_type: str = Body("HUB_AND_SPOKE")) -> list[dict]:
     """
     Create merged topology with specified parameters overriden (obtained after resolving conflicts).
 
-    :param fmc_session:
+    :param workspace:
     :param override: The subtree object whose _leaf_ values override the default values in case of conflicts
     :param hns_topology_id: The id of hub and spoke topology if merging into and existing topology
     :param p2p_topology_ids: List of point-to-point topologies to merge
+    :param topology_type: "HUB_AND_SPOKE" or "FULL_MESH" (ignored when merging into existing topology)
     :return: Merged topology objects
     """
-    return [fmc_session.create_hns_topology("HNS-" + token_urlsafe(2), p2p_topology_ids, override or {}, hns_topology_id)]
+    if topology_type not in MERGED_TOPOLOGY_TYPES:
+        raise HTTPException(status_code=422, detail=f"Topology type must be one of {MERGED_TOPOLOGY_TYPES}")
+    prefix = "MESH-" if topology_type == "FULL_MESH" else "HNS-"
+    return [workspace.create_hns_topology(prefix + token_urlsafe(2), p2p_topology_ids, override or {}, hns_topology_id,
+                                          topology_type=topology_type)]
+
+
+@app.get("/merge-journals", response_model=List[dict[str, Any]])
+def get_merge_journals(fmc_session: FMCSession = Depends(domain_dependency)) -> list[dict]:
+    """
+    Get the merges in the domain which failed partway (neither completed nor rolled back). Survives backend restarts.
+
+    :param fmc_session:
+    :return: Progress summary of each unfinished merge
+    """
+    return [journal.get_summary() for journal in MergeJournal.get_unfinished(fmc_session.fmc.host, fmc_session.fmc.uuid)]
+
+
+@app.post("/merge-journals/{merge_id}/resume", response_model=List[dict])
+def resume_merge(merge_id: str, workspace: MergeWorkspace = Depends(workspace_dependency)) -> list[dict]:
+    """
+    Resume a failed merge from its last completed step.
+
+    :param merge_id: Merge ID from `/merge-journals`
+    :param workspace:
+    :return: Merged topology objects
+    """
+    try:
+        return [workspace.resume_merge(merge_id)]
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Merge journal not found")
+
+
+@app.post("/merge-journals/{merge_id}/rollback")
+def rollback_merge(merge_id: str, fmc_session: FMCSession = Depends(domain_dependency)) -> None:
+    """
+    Roll back the changes of a failed merge in parallel.
+
+    :param merge_id: Merge ID from `/merge-journals`
+    :param fmc_session:
+    """
+    try:
+        fmc_session.rollback_merge(merge_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Merge journal not found")
+
+
+@app.get("/batch-merge/plan", response_model=List[dict[str, Any]])
+def get_batch_merge_plan(min_topologies: int = Query(BATCH_MERGE_MIN_TOPOLOGIES),
+                         fmc_session: FMCSession = Depends(domain_dependency)) -> list[dict]:
+    """
+    Propose a merge for each hub device of the domain.
+
+    :param min_topologies: Minimum number of point-to-point topologies for a device to become a hub
+    :param fmc_session:
+    :return: Merge plans with the hub device and the point-to-point topology IDs
+    """
+    wait(fmc_session.pending_futures["topologies"])
+    return plan_batch_merge(fmc_session.p2p_topologies, min_topologies=min_topologies)
+
+
+@app.post("/batch-merge")
+def batch_merge(fmc_session: FMCSession = Depends(domain_dependency),
+                hub_device_ids: Optional[list[str]] = Body(None),
+                policy: str = Body("majority"),
+                override: Optional[dict[str, Any]] = Body(None),
+                parallel_hubs: int = Body(BATCH_MERGE_PARALLEL_HUBS),
+                min_topologies: int = Body(BATCH_MERGE_MIN_TOPOLOGIES),
+                deploy: bool = Body(False)) -> dict[str, Any]:
+    """
+    Merge the point-to-point topologies of every planned hub device with the conflicts resolved by a policy.
+
+    :param fmc_session:
+    :param hub_device_ids: Hub devices to merge (all planned hubs if not provided)
+    :param policy: "majority" to resolve each conflict by the most common value or "first" by the value of the first
+        topology of the hub
+    :param override: The subtree object whose _leaf_ values take precedence over the policy for every hub
+    :param parallel_hubs: Maximum number of hubs merged concurrently
+    :param min_topologies: Minimum number of point-to-point topologies for a device to become a hub
+    :param deploy: Queue a deployment of all merged hubs (streamed by "/deploy/status")
+    :return: Summary with throughput, failures, the result of each hub and the deployment job ID
+    """
+    if policy not in CONFLICT_POLICIES:
+        raise HTTPException(status_code=422, detail=f"Policy must be one of {CONFLICT_POLICIES}")
+    wait(fmc_session.pending_futures["topologies"])
+    plans = plan_batch_merge(fmc_session.p2p_topologies, hub_device_ids, min_topologies)
+    summary = run_batch_merge(fmc_session, plans, policy, override, parallel_hubs)
+    if deploy and summary["merged"]:
+        summary["job_id"] = submit_batch_deployment(fmc_session, summary["results"]).job_id
+    return summary
 
 
 @app.post("/deploy")
-def deploy(fmc_session: FMCSession = Depends(domain_dependency)):
+def deploy(workspace: MergeWorkspace = Depends(workspace_dependency)) -> dict[str, str]:
+    """
+    Queue the deployment of the created topology to the devices after deleting the existing point-to-point topologies.
+        The progress is streamed by "/deploy/status".
+
+    :param workspace:
+    :return: Deployment job ID
+    """
+    if workspace.hns_topology is None:
+        raise HTTPException(status_code=409, detail="No merged topology to deploy")
+    return {"job_id": workspace.deploy().job_id}
+
+
+@app.get("/workspaces", response_model=List[dict[str, Any]])
+def get_workspaces(fmc_session: FMCSession = Depends(domain_dependency)) -> list[dict]:
+    """
+    Get the merge workspaces of the session in the selected domain with their selection. Each workspace (`workspace`
+        query parameter of the merge routes, "default" if not provided) fetches, resolves and creates its merge
+        independently of the others. The workspaces are kept per domain: selecting another domain does not discard
+        them, they are listed again once their domain is selected (only the ones of the selected domain are shared
+        with the other worker processes).
+
+    :param fmc_session:
+    :return: Workspace name, selected hub device and HNS topology and the created topology ID
+    """
+    return [{"name": name, "hub_device_id": workspace.hub_device_id, "hns_topology_id": workspace.hns_topology_id,
+             "created_topology_id": workspace.hns_topology["id"] if workspace.hns_topology else None}
+            for name, workspace in list(fmc_session.workspaces.items())]
+
+
+@app.delete("/workspaces/{name}")
+def delete_workspace(name: str, fmc_session: FMCSession = Depends(domain_dependency)) -> None:
+    """
+    Discard a merge workspace of the session.
+
+    :param name: Workspace name
+    :param fmc_session:
+    """
+    if name not in fmc_session.workspaces:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+    fmc_session.remove_workspace(name)
+
+
+@app.get("/deploy/status")
+async def deployment_status(job_id: str = Query(...), token: str = Query(...)) -> "EventSourceResponse":
+    """
+    Listen for the deployment phase changes as [Server sent events](https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events):
+        "phase" for each change and finally "done" or "failed".
+
+    :param job_id: Deployment job ID returned by "/deploy"
+    :param token: The OAuth2 token issued during login
+    :return: Event stream listend by SSE listener on client side
+    """
+    if session_store.get_session_version(token) is None:
+        raise HTTPException(status_code=401, detail="Token SHA-256 hash invalid")
+    if job_id not in deployment_jobs and session_store.get_task_status(f"deployment:{job_id}") is None:
+        raise HTTPException(status_code=404, detail="Deployment job not found")
+    from sse_starlette.sse import EventSourceResponse
+    return EventSourceResponse(yield_deployment_phases(job_id))
+
+
+@app.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+def get_profile(profile_id: str, fmc_session: FMCSession = Depends(get_session)) -> str:
     """
-    Deploy the created topology to the device after deleting the existing point-to-point topologies.
+    Get a stored request profile as folded stacks (input of flamegraph.pl or speedscope). The profile is process-wide
+        i.e. it includes the concurrent requests of the worker process (root frame "process-wide").
 
+    :param profile_id: Profile ID from "X-Profile-Id" response header of the profiled request
     :param fmc_session:
+    :return: Folded stacks
     """
-    fmc_session.deploy()
+    if not is_admin_session(fmc_session):
+        raise HTTPException(status_code=403, detail="Profiles are only available to admins")
+    profile = load_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile["folded_stacks"]
 
 
 @app.get("/status")
-async def respond_when_ready(task: str = Query(...), token: str = Query(...)) -> EventSourceResponse:
+async def respond_when_ready(task: str = Query(...), token: str = Query(...), host: Optional[str] = Query(None),
+                             workspace: Optional[str] = Query(None)) -> "EventSourceResponse":
     """
     Listen for [Server sent event](https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events) "ready"
         when a specific _task_ finishes. Useful for tasks which take longer than hard timeout limit of HTTP request imposed by browsers.
 
     :param task: Task name (e.g. "topologies")
     :param token: The OAuth2 token issued during login
+    :param host: FMC host of the fleet member (needed with fleet token)
+    :param workspace: Merge workspace of the task (e.g. "device_p2p_topologies")
     :return: Event stream listend by SSE listener on client side
     """
     try:
-        fmc_session = sessions[token]
+        fmc_session = await run_in_threadpool(load_session, get_member_token(token, host))
     except KeyError:
         raise HTTPException(status_code=401, detail="Token SHA-256 hash invalid")
-    ready_event_generator = yield_when_task_done(task, fmc_session)
-    return EventSourceResponse(ready_event_generator)
+    ready_event_generator = yield_when_task_done(task, fmc_session, workspace)
+    from sse_starlette.sse import EventSourceResponse
+    return EventSourceResponse(ready_event_generator, ping=STATUS_HEARTBEAT_SECONDS)
 
 # app.mount("/static", StaticFiles(directory="../build", html=True), name="home")
@@ -1,30 +1,136 @@
-from concurrent.futures import wait
+import asyncio
+import json
+from concurrent.futures import Future
+from concurrent.futures.thread import ThreadPoolExecutor
 from secrets import token_urlsafe
-from typing import Union
+from types import SimpleNamespace
+from typing import Union, AsyncIterator, Optional
 
-from fastapi import Depends, HTTPException, Query
+from fastapi import Depends, HTTPException, Query, Request
 from fastapi.security import OAuth2PasswordBearer
+from starlette.concurrency import run_in_threadpool
 
-from app.fmc_session import FMCSession
-from recreate import recreate_test_topologies
+from app.constants import STATUS_TIMEOUT_SECONDS, PROFILE_ADMIN_USERS, FLEET_TOKEN_PREFIX, SESSION_STORE_POLL_SECONDS
+from app.deployment import deployment_jobs, aiter_stored_phases
+from app.fmc_session import FMCSession, MergeWorkspace
+from app.models import FleetMember
+from app.session_store import session_store
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-sessions = {}
+# Sessions restored in this worker process and the version of their stored state
+sessions: dict[str, FMCSession] = {}
 
+session_versions: dict[str, int] = {}
 
-def get_session(token: str = Depends(oauth2_scheme)):
+# Fleet token and its FMC host and session token map
+fleets: dict[str, dict[str, str]] = {}
+
+# Completion event (and the task setting it) shared by the listeners of the same pending futures
+task_events: dict[tuple, tuple[asyncio.Event, asyncio.Task]] = {}
+
+
+def load_session(token: str) -> FMCSession:
     """
-    Used to ensure the token validity. Gets the FMC session associated by the token.
+    Get the FMC session of the token, restoring it from the session store if logged in through other worker process
+        or catching up with the changes saved by them.
 
     :param token: OAuth2 token
     :return: FMC session
     """
-    if token not in sessions:
-        raise HTTPException(status_code=401, detail="X-Token header invalid")
+    version = session_store.get_session_version(token)
+    if version is None:
+        raise KeyError(token)
+    if session_versions.get(token) != version:
+        state, version = session_store.load_session(token)
+        if token in sessions:
+            sessions[token].apply_state(state)
+        else:
+            sessions[token] = FMCSession(token, state=state)
+        session_versions[token] = version
     return sessions[token]
 
 
+def save_session(fmc_session: FMCSession) -> None:
+    """
+    Store the session state for the other worker processes if changed.
+
+    :param fmc_session:
+    """
+    state = fmc_session.get_state()
+    if state != fmc_session.saved_state:
+        session_versions[fmc_session.token] = session_store.save_session(fmc_session.token, state)
+        fmc_session.saved_state = state
+
+
+def load_fleet(token: str) -> dict[str, str]:
+    """
+    :param token: Fleet token
+    :return: FMC host and session token map of the fleet
+    """
+    if token not in fleets:
+        stored = session_store.load_session(token)
+        if stored is None or "fleet" not in stored[0]:
+            raise KeyError(token)
+        fleets[token] = stored[0]["fleet"]
+    return fleets[token]
+
+
+def get_member_token(token: str, host: Optional[str]) -> str:
+    """
+    :param token: OAuth2 token or fleet token
+    :param host: FMC host of the fleet member
+    :return: Session token of the fleet member (the token itself if not a fleet token)
+    """
+    if not token.startswith(FLEET_TOKEN_PREFIX):
+        return token
+    if host is None:
+        raise HTTPException(status_code=400, detail="Host is needed with fleet token")
+    try:
+        return load_fleet(token)[host]
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Host not found in the fleet")
+
+
+def get_session(request: Request, token: str = Depends(oauth2_scheme), host: Optional[str] = Query(None)):
+    """
+    Used to ensure the token validity. Gets the FMC session associated by the token. The session state is saved after
+        the request (see `save_session_state` middleware).
+
+    :param request:
+    :param token: OAuth2 token or fleet token
+    :param host: FMC host of the fleet member (needed with fleet token)
+    :return: FMC session
+    """
+    try:
+        fmc_session = load_session(get_member_token(token, host))
+    except KeyError:
+        raise HTTPException(status_code=401, detail="X-Token header invalid")
+    request.state.fmc_session = fmc_session
+    return fmc_session
+
+
+def is_admin_session(fmc_session: FMCSession) -> bool:
+    """
+    :param fmc_session:
+    :return: Is the session logged in by one of `PROFILE_ADMIN_USERS`?
+    """
+    return fmc_session.fmc.username in PROFILE_ADMIN_USERS
+
+
+def is_admin_token(token: str) -> bool:
+    """
+    :param token: OAuth2 token
+    :return: Is the token of an admin session?
+    """
+    if not PROFILE_ADMIN_USERS or not token:
+        return False
+    try:
+        return is_admin_session(load_session(token))
+    except KeyError:
+        return False
+
+
 def domain_dependency(domain_id: str = Query(...), fmc_session: FMCSession = Depends(get_session)):
     """
     Used to ensure domain ID is provided and depends on auth dependency.
@@ -37,16 +143,29 @@ def domain_dependency(domain_id: str = Query(...), fmc_session: FMCSession = Dep
     return fmc_session
 
 
-def device_domain_dependency(device_id: str = Query(...), fmc_session: FMCSession = Depends(domain_dependency)) -> FMCSession:
+def workspace_dependency(workspace: str = Query("default"),
+                         fmc_session: FMCSession = Depends(domain_dependency)) -> MergeWorkspace:
     """
-    Used to ensure device ID is provided. Depends on domain ID and auth dependency.
+    Used to select the merge workspace of the session. Depends on domain ID and auth dependency.
 
-    :param device_id: FMC device ID
+    :param workspace: Merge workspace name (merges in different workspaces run independently)
     :param fmc_session:
-    :return: FMC session
+    :return: Merge workspace
     """
-    fmc_session.set_hub_device_id(device_id)
-    return fmc_session
+    return fmc_session.get_workspace(workspace)
+
+
+def device_workspace_dependency(device_id: str = Query(...),
+                                workspace: MergeWorkspace = Depends(workspace_dependency)) -> MergeWorkspace:
+    """
+    Used to ensure device ID is provided. Depends on the workspace, domain ID and auth dependency.
+
+    :param device_id: FMC device ID
+    :param workspace:
+    :return: Merge workspace
+    """
+    workspace.set_hub_device_id(device_id)
+    return workspace
 
 
 def get_login_response(creds) -> dict[str, Union[str, list]]:
@@ -56,21 +175,124 @@ def get_login_response(creds) -> dict[str, Union[str, list]]:
     :param creds:
     :return: OAuth2 token in `access_token` field
     """
-    fmc_session = FMCSession(creds)
-    # recreate_test_p2p_topologies(fmc_session.fmc, fmc_session.api_pool, 5)
     token = token_urlsafe(32)
+    fmc_session = FMCSession(token, creds)
+    # recreate_test_p2p_topologies(fmc_session.fmc, fmc_session.api_pool, 5)
     sessions[token] = fmc_session
+    save_session(fmc_session)
+    fmc_session.prefetch_domains()
     return {"access_token": token, "token_type": "bearer", "domains": fmc_session.domains}
 
 
-def yield_when_task_done(task: str, fmc_session: FMCSession) -> dict[str, str]:
+def get_task_event(key: tuple, futures: list[Future]) -> asyncio.Event:
+    """
+    Get the event set (in the event loop) when all the futures complete. Listeners of the same futures share one event.
+
+    :param key: Key of the futures
+    :param futures: Pending futures
+    :return: Completion event
+    """
+    if key not in task_events:
+        event = asyncio.Event()
+
+        async def notify():
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+            event.set()
+            task_events.pop(key)
+
+        task_events[key] = event, asyncio.create_task(notify())
+    return task_events[key][0]
+
+
+def fleet_dependency(token: str = Depends(oauth2_scheme)) -> dict[str, FMCSession]:
+    """
+    Used to ensure the fleet token validity.
+
+    :param token: Fleet token
+    :return: FMC host and session map of the fleet
+    """
+    try:
+        return {host: load_session(member_token) for host, member_token in load_fleet(token).items()}
+    except KeyError:
+        raise HTTPException(status_code=401, detail="X-Token header invalid")
+
+
+def get_fleet_login_response(members: list[FleetMember]) -> dict[str, Union[str, dict]]:
+    """
+    Login to the FMC hosts of the fleet in parallel and start fetching the inventories of all their domains (each host
+        under its own rate limit).
+
+    :param members: FMC hosts with their credentials
+    :return: Fleet token in `access_token` field, the domains of each host and the login errors
+    """
+    def login_member(member: FleetMember) -> FMCSession:
+        creds = SimpleNamespace(username=f"{member.host} {member.username}", password=member.password)
+        return FMCSession(token_urlsafe(32), creds)
+
+    with ThreadPoolExecutor(max_workers=len(members)) as login_pool:
+        futures = {member.host: login_pool.submit(login_member, member) for member in members}
+    fleet, domains, failed = {}, {}, {}
+    for host, future in futures.items():
+        try:
+            fmc_session = future.result()
+        except Exception as e:
+            failed[host] = repr(e)
+            continue
+        sessions[fmc_session.token] = fmc_session
+        save_session(fmc_session)
+        fmc_session.prefetch_domains(low_priority=False)
+        fleet[host], domains[host] = fmc_session.token, fmc_session.domains
+    if not fleet:
+        raise HTTPException(status_code=404, detail=f"Could not login to any FMC: {failed}")
+    token = FLEET_TOKEN_PREFIX + token_urlsafe(32)
+    fleets[token] = fleet
+    session_store.save_session(token, {"fleet": fleet})
+    return {"access_token": token, "token_type": "bearer", "domains": domains, "failed": failed}
+
+
+async def yield_when_task_done(task: str, fmc_session: FMCSession,
+                               workspace: Optional[str] = None) -> AsyncIterator[dict[str, str]]:
     """
     Generator function which yields a "ready" [Server sent event](https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events) when the specified task (e.g. "topologies") finish.
+        The listener is answered right away if the task is already done and with "timeout" after `STATUS_TIMEOUT_SECONDS`.
+        The task status is read from the session store since the task may run in other worker process. The futures of
+        a task running in this process wake the listener without polling.
 
     :param task: Task name
     :param fmc_session:
+    :param workspace: Merge workspace of the task (the session's tasks if None)
     :return: Object used for SSE on client side
     """
-    wait(fmc_session.pending_futures[task])
-    fmc_session.pending_futures.pop(task)
+    pending_futures = fmc_session.pending_futures
+    if workspace is not None and workspace in fmc_session.workspaces:
+        pending_futures = fmc_session.workspaces[workspace].pending_futures
+    deadline = asyncio.get_running_loop().time() + STATUS_TIMEOUT_SECONDS
+    futures = [future for future in list(pending_futures.get(task, [])) if not future.done()]
+    if futures:
+        event = get_task_event((fmc_session.token, task, *map(id, futures)), futures)
+        try:
+            await asyncio.wait_for(event.wait(), STATUS_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            yield {"event": "timeout", "data": ""}
+            return
+    task_key = fmc_session.get_task_key(task, fmc_session.fmc.uuid, workspace)
+    while (await run_in_threadpool(session_store.get_task_status, task_key) or ("done",))[0] == "pending":
+        if asyncio.get_running_loop().time() > deadline:
+            yield {"event": "timeout", "data": ""}
+            return
+        await asyncio.sleep(SESSION_STORE_POLL_SECONDS)
     yield {"event": "ready", "data": ""}
+
+
+async def yield_deployment_phases(job_id: str) -> AsyncIterator[dict[str, str]]:
+    """
+    Generator function which yields a "phase" [Server sent event](https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events) for each phase change of the deployment
+        job followed by the final "done" or "failed" event. The job may run in other worker process.
+
+    :param job_id: Deployment job ID
+    :return: Object used for SSE on client side
+    """
+    phases = deployment_jobs[job_id].aiter_phases() if job_id in deployment_jobs else aiter_stored_phases(job_id)
+    async for phase in phases:
+        event = {"deployed": "done", "failed": "failed"}.get(phase["phase"], "phase")
+        yield {"event": event, "data": json.dumps(phase)}
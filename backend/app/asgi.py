@@ -0,0 +1,82 @@
+import asyncio
+import json
+from importlib import import_module
+from typing import Any, Callable, Optional
+
+
+class LazyApp:
+    """
+    ASGI application serving right after the server starts while the backend (FastAPI routes, fmcapi...) is imported in
+        background. Until loaded, "/health" answers 200 and every other request 503 so that the readiness probe
+        ("/ready") passes only once the routes are served, websocket connections are closed. The startup and shutdown
+        handlers of the loaded application run as usual, the shutdown handlers even if the startup failed.
+    """
+
+    def __init__(self, app_path: str):
+        """
+        :param app_path: Application import path (e.g. "app.api:app")
+        """
+        self.app_path = app_path
+        self.app: Optional[Any] = None
+        # Imported application, possibly with failed startup
+        self.imported_app: Optional[Any] = None
+        self.load_task: Optional[asyncio.Task] = None
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif self.app is not None:
+            await self.app(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await receive()
+            # Try again later
+            await send({"type": "websocket.close", "code": 1013})
+        elif scope["type"] == "http":
+            body = {"ready": False}
+            status = 200 if scope["path"] == "/health" else 503
+            load_error = self.get_load_error()
+            if load_error is not None:
+                body["error"] = repr(load_error)
+                status = 500
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")]})
+            await send({"type": "http.response.body", "body": json.dumps(body).encode()})
+
+    def get_load_error(self) -> Optional[BaseException]:
+        """
+        :return: Exception of the failed (or cancelled) load, None while loading or once loaded
+        """
+        if self.load_task is None or not self.load_task.done():
+            return None
+        if self.load_task.cancelled():
+            return asyncio.CancelledError("Loading cancelled")
+        return self.load_task.exception()
+
+    async def load(self) -> None:
+        """
+        Import the application (in a thread, not to block the event loop) and run its startup handlers.
+        """
+        module_name, app_name = self.app_path.split(":")
+        module = await asyncio.get_running_loop().run_in_executor(None, import_module, module_name)
+        self.imported_app = app = getattr(module, app_name)
+        await app.router.startup()
+        self.app = app
+
+    async def lifespan(self, receive: Callable, send: Callable) -> None:
+        """
+        Complete the server startup right away and load the application in background.
+        """
+        await receive()
+        self.load_task = asyncio.create_task(self.load())
+        await send({"type": "lifespan.startup.complete"})
+        await receive()
+        try:
+            # Failures are reported by the requests
+            await asyncio.wait([self.load_task])
+            if self.imported_app is not None:
+                await self.imported_app.router.shutdown()
+        finally:
+            await send({"type": "lifespan.shutdown.complete"})
+
+
+app = LazyApp("app.api:app")
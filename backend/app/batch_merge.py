@@ -0,0 +1,210 @@
+import re
+from collections import Counter
+from concurrent.futures import as_completed
+from concurrent.futures.thread import ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, Optional
+
+from app.constants import BATCH_MERGE_MIN_TOPOLOGIES, BATCH_MERGE_PARALLEL_HUBS
+from app.deployment import DeploymentJob, submit_deployment
+from app.fmc_session import FMCSession
+from app.fmc_utils import get_topology_ike_settings, get_topologies_from_ids
+from app.inventory import to_fmc_json
+from app.merge_journal import MergeJournal
+
+CONFLICT_POLICIES = ("majority", "first")
+
+
+def plan_batch_merge(p2p_topologies: dict[str, list[dict]], hub_device_ids: Optional[list[str]] = None,
+                     min_topologies: int = BATCH_MERGE_MIN_TOPOLOGIES) -> list[dict[str, Any]]:
+    """
+    Propose a merge for each hub device. The devices with the most point-to-point topologies become the hubs first and
+        every topology is merged only once i.e. into the first hub among its devices.
+
+    :param p2p_topologies: The device id and p2p topology list map
+    :param hub_device_ids: Hub devices to merge in order (all devices if None)
+    :param min_topologies: Minimum number of (not yet planned) topologies for a device to become a hub
+    :return: Merge plans with the hub device and the topology IDs
+    """
+    if hub_device_ids is None:
+        hub_device_ids = sorted(p2p_topologies, key=lambda device_id: len(p2p_topologies[device_id]), reverse=True)
+    planned_topology_ids = set()
+    plans = []
+    for device_id in hub_device_ids:
+        topology_ids = [topology["id"] for topology in p2p_topologies.get(device_id, [])
+                        if topology["id"] not in planned_topology_ids]
+        if len(topology_ids) < min_topologies:
+            continue
+        planned_topology_ids.update(topology_ids)
+        plans.append({"hub_device_id": device_id, "hub_device_name": get_device_name(p2p_topologies, device_id),
+                      "p2p_topology_ids": topology_ids})
+    return plans
+
+
+def get_device_name(p2p_topologies: dict[str, list[dict]], device_id: str) -> str:
+    """
+    :param p2p_topologies: The device id and p2p topology list map
+    :param device_id: Device UUID
+    :return: Device name from the endpoints of its topologies (the ID if unnamed)
+    """
+    for endpoint in p2p_topologies[device_id][0]["endpoints"]:
+        if not endpoint["extranet"] and endpoint["device"]["id"] == device_id:
+            return endpoint["device"].get("name", device_id)
+    return device_id
+
+
+def get_topology_names(fmc_session: FMCSession) -> set[str]:
+    """
+    :param fmc_session:
+    :return: Names of the topologies in the inventory and of the topologies created by the journaled merges of the
+        domain (not rolled back), which may be missing from the inventory until it is fetched again
+    """
+    names = {topology["name"] for topologies in fmc_session.p2p_topologies.values() for topology in topologies}
+    names.update(topology["name"] for topology in fmc_session.get_merge_targets())
+    names.update(journal.parameters["topology_name"]
+                 for journal in MergeJournal.get_all(fmc_session.fmc.host, fmc_session.fmc.uuid)
+                 if journal.parameters.get("hns_topology_id") is None and not journal.is_done("rolled_back"))
+    return names
+
+
+def get_unique_topology_name(name: str, taken_names: set[str]) -> str:
+    """
+    Suffix the name with the lowest free number if it is taken (e.g. "HNS-hub-2") and reserve it.
+
+    :param name: Topology name
+    :param taken_names: Names already used, updated with the returned name
+    :return: Unused topology name
+    """
+    unique_name, number = name, 1
+    while unique_name in taken_names:
+        number += 1
+        unique_name = f"{name}-{number}"
+    taken_names.add(unique_name)
+    return unique_name
+
+
+def get_majority_override(topologies: list[dict], conflicts: dict[str, Any]) -> dict[str, Any]:
+    """
+    Resolve each conflicting parameter by the most common value among the topologies (the first one on tie). The
+        conflicting lists are resolved by their union.
+
+    :param topologies: The conflicting topologies (or their sub-objects)
+    :param conflicts: Conflicts as returned by `get_dict_diff`
+    :return: Override object in the structure of the topology
+    """
+    override = {}
+    for key, conflict in conflicts.items():
+        values = [topology[key] for topology in topologies if key in topology]
+        if isinstance(conflict, dict):
+            override[key] = get_majority_override(values, conflict)
+        elif isinstance(conflict, list):
+            override[key] = to_fmc_json(conflict[0])
+        else:
+            override[key] = Counter(values).most_common(1)[0][0]
+    return override
+
+
+def get_merged_override(override: dict[str, Any], patch: dict[str, Any]) -> dict[str, Any]:
+    """
+    :param override: Override object
+    :param patch: Override object taking precedence
+    :return: New override object with values of both
+    """
+    merged = dict(override)
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = get_merged_override(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def merge_hub(fmc_session: FMCSession, plan: dict[str, Any], policy: str, override: dict[str, Any]) -> dict[str, Any]:
+    """
+    Merge the point-to-point topologies of a hub: fetch their IKE settings, resolve the conflicts and create the hub and
+        spoke topology.
+
+    :param fmc_session:
+    :param plan: Merge plan of the hub with its unique "topology_name"
+    :param policy: Conflict policy, "majority" for the most common values or "first" for the values of the first
+        topology
+    :param override: Values taking precedence over the policy
+    :return: Merge result
+    """
+    hub_device_id, topology_ids = plan["hub_device_id"], plan["p2p_topology_ids"]
+    result = {**plan, "status": "failed", "merge_id": None, "endpoints": 0}
+    try:
+        topologies = get_topologies_from_ids(fmc_session.p2p_topologies, hub_device_id, topology_ids, [])
+        unfetched_topologies = [topology for topology in topologies if "links" in topology["ikeSettings"]]
+        for topology, ike_settings in zip(unfetched_topologies, fmc_session.api_pool.map(
+                lambda topology: get_topology_ike_settings(fmc_session.fmc, topology), unfetched_topologies)):
+            topology["ikeSettings"] = ike_settings
+        conflicts = fmc_session.get_topology_conflicts(topology_ids, hub_device_id)
+        resolution = get_majority_override(topologies, conflicts) if policy == "majority" else {}
+        resolution = get_merged_override(resolution, override)
+        topology_name = plan["topology_name"]
+        journal = fmc_session.begin_merge_journal(topology_name, topology_ids, resolution, None, hub_device_id)
+        result["merge_id"] = journal.merge_id
+        hns_topology = fmc_session.merge_hns_topology(topology_name, topology_ids, resolution, None, hub_device_id,
+                                                      journal)
+        result.update(status="merged", hns_topology_id=hns_topology["id"], endpoints=len(hns_topology["endpoints"]),
+                      verification=hns_topology["verification"], round_trips=hns_topology["round_trips"])
+    except Exception as e:
+        result["error"] = repr(e)
+    return result
+
+
+def run_batch_merge(fmc_session: FMCSession, plans: list[dict[str, Any]], policy: str = "majority",
+                    override: Optional[dict[str, Any]] = None,
+                    parallel_hubs: int = BATCH_MERGE_PARALLEL_HUBS) -> dict[str, Any]:
+    """
+    Merge the planned hubs as a pipeline with bounded parallelism across hubs. The FMC API calls of all hubs share
+        the session's API thread pool (and the rate limit of the host). Failed merges are journaled and can be resumed
+        or rolled back through the merge journals.
+
+    :param fmc_session:
+    :param plans: Merge plans from `plan_batch_merge`
+    :param policy: Conflict policy ("majority" or "first")
+    :param override: Values taking precedence over the policy for every hub
+    :param parallel_hubs: Maximum number of hubs merged concurrently
+    :return: Summary with throughput, failures, merges not matching FMC ("unverified"), FMC round trips on the
+        critical paths of the merges and saved by them (see `FMCSession.merge_hns_topology`) and the result of each hub
+    """
+    start = perf_counter()
+    # Named upfront so that re-runs and hubs with similar names don't collide with the existing topologies
+    taken_names = get_topology_names(fmc_session)
+    plans = [{**plan, "topology_name": get_unique_topology_name(
+        "HNS-" + re.sub(r"[^\w.\-]", "_", plan["hub_device_name"]), taken_names)} for plan in plans]
+    with ThreadPoolExecutor(max_workers=parallel_hubs) as hub_pool:
+        futures = [hub_pool.submit(merge_hub, fmc_session, plan, policy, override or {}) for plan in plans]
+        results = [future.result() for future in as_completed(futures)]
+    seconds = perf_counter() - start
+    merged = [result for result in results if result["status"] == "merged"]
+    merged_topologies = sum(len(result["p2p_topology_ids"]) for result in merged)
+    return {"hubs": len(plans), "merged": len(merged), "failed": len(results) - len(merged),
+            "unverified": sum(not result["verification"]["verified"] for result in merged),
+            "merged_topologies": merged_topologies,
+            "created_endpoints": sum(result["endpoints"] for result in merged),
+            "critical_path_round_trips": sum(result["round_trips"]["critical_path"] for result in merged),
+            "round_trips_saved": sum(result["round_trips"]["saved"] for result in merged), "seconds": seconds,
+            "hubs_per_minute": len(merged) * 60 / seconds if seconds else 0,
+            "topologies_per_second": merged_topologies / seconds if seconds else 0, "results": results}
+
+
+def submit_batch_deployment(fmc_session: FMCSession, results: list[dict[str, Any]]) -> DeploymentJob:
+    """
+    Queue a single deployment deleting the merged point-to-point topologies of all merged hubs.
+
+    :param fmc_session:
+    :param results: Merge results from `run_batch_merge`
+    :return: The deployment job
+    """
+    p2p_topology_ids, device_ids = [], set()
+    for result in results:
+        if result["status"] != "merged":
+            continue
+        p2p_topology_ids.extend(result["p2p_topology_ids"])
+        for topology in get_topologies_from_ids(fmc_session.p2p_topologies, result["hub_device_id"],
+                                                result["p2p_topology_ids"], []):
+            device_ids.update(endpoint["device"]["id"] for endpoint in topology["endpoints"] if not endpoint["extranet"])
+    return submit_deployment(fmc_session.fmc, fmc_session.api_pool, p2p_topology_ids, device_ids)
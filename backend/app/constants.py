@@ -1,2 +1,57 @@
+from os import environ, path
+
 RATE_LIMIT_WAIT_SECONDS = 10
 BULK_POST_BYTE_LIMIT = 2048000 * 0.9
+BULK_POST_ITEM_LIMIT = 1000
+# Items per page of the FMC API lists
+FMC_PAGE_LIMIT = 1000
+
+FMC_RECORD_PATH = environ.get("FMC_RECORD_PATH")
+FMC_REPLAY_PATH = environ.get("FMC_REPLAY_PATH")
+FMC_REPLAY_LATENCY_SCALE = float(environ.get("FMC_REPLAY_LATENCY_SCALE", 1))
+RECORD_SECRET_HEADERS = {"authorization", "x-auth-access-token", "x-auth-refresh-token", "cookie", "set-cookie"}
+RECORD_SECRET_KEYS = {"manualPreSharedKey", "password", "pre_shared_key", "preSharedKey"}
+COMPACT_DROPPED_KEYS = {"links", "metadata"}
+FMC_REQUESTS_PER_MINUTE = int(environ.get("FMC_REQUESTS_PER_MINUTE", 120))
+FMC_REQUEST_BURST = 10
+# Worker processes of the server (set by main.py), each gets its share of the FMC rate limit
+WORKER_PROCESSES = int(environ.get("WORKER_PROCESSES", 1))
+DEPLOY_COALESCE_SECONDS = 5
+DEPLOY_POLL_INITIAL_SECONDS = 2
+DEPLOY_POLL_MAX_SECONDS = 30
+DEPLOY_TIMEOUT_SECONDS = 3600
+DEPLOYMENT_SUCCESS_STATUSES = {"Deployed", "DEPLOYED", "Succeeded", "SUCCEEDED", "Success", "SUCCESS"}
+DEPLOYMENT_FAILURE_STATUSES = {"Failed", "FAILED", "Deployment Failed", "DEPLOYMENT_FAILED", "Cancelled",
+                               "CANCELLED"}
+# Private (0700) directory of the session store and the merge journals
+DATA_DIR = environ.get("FMCTOOL_DATA_DIR", path.join(path.expanduser("~"), ".fmctool"))
+SESSION_STORE_PATH = environ.get("SESSION_STORE_PATH", path.join(DATA_DIR, "sessions.sqlite3"))
+# Journals hold the settings needed for rollback, including the pre-shared keys, so they stay private (0600)
+MERGE_JOURNAL_DIR = environ.get("MERGE_JOURNAL_DIR", path.join(DATA_DIR, "merge-journals"))
+SESSION_STORE_TTL_SECONDS = 24 * 60 * 60
+SESSION_STORE_POLL_SECONDS = 0.5
+INVENTORY_FETCH_TIMEOUT_SECONDS = 30 * 60
+BATCH_MERGE_MIN_TOPOLOGIES = 2
+BATCH_MERGE_PARALLEL_HUBS = 4
+MERGED_TOPOLOGY_TYPES = ("HUB_AND_SPOKE", "FULL_MESH")
+PREFETCH_REQUESTS_PER_MINUTE = int(environ.get("PREFETCH_REQUESTS_PER_MINUTE", 30))
+PREFETCH_REQUEST_BURST = 2
+PREFETCH_PARALLEL_DOMAINS = 2
+PREFETCH_API_POOL_SIZE = 2
+STATUS_HEARTBEAT_SECONDS = 15
+STATUS_TIMEOUT_SECONDS = 30 * 60
+FMC_GET_TIMEOUT_SECONDS = 30
+FMC_GET_RETRIES = 2
+FMC_GET_RETRY_BACKOFF_SECONDS = 1
+HEDGE_PERCENTILE = 95
+HEDGE_LATENCY_WINDOW = 500
+HEDGE_MIN_SAMPLES = 20
+# Maximum number of concurrent GET attempts to a FMC host (the API pool size and the hedged requests)
+HEDGE_POOL_SIZE = 16
+STREAM_CHUNK_SIZE = 64 * 1024
+PROFILE_ADMIN_USERS = set(filter(None, environ.get("PROFILE_ADMIN_USERS", "").split(",")))
+PROFILE_SAMPLE_SECONDS = 0.005
+FLEET_TOKEN_PREFIX = "fleet."
+DEVICE_CACHE_TTL_SECONDS = 5 * 60
+CONFLICT_IGNORED_KEYS = {"metadata", "id", "description", "links", "topologyType", "endpoints", "name"}
+VERIFY_IGNORED_KEYS = {"id", "name", "version"}
@@ -0,0 +1,247 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures.thread import ThreadPoolExecutor
+from secrets import token_urlsafe
+from threading import Condition, Lock, Thread
+from time import sleep, time, monotonic
+from typing import Iterator, Optional, AsyncIterator
+
+from fmcapi import FMC
+
+from app.constants import DEPLOY_COALESCE_SECONDS, DEPLOY_POLL_INITIAL_SECONDS, DEPLOY_POLL_MAX_SECONDS, \
+    DEPLOY_TIMEOUT_SECONDS, DEPLOYMENT_SUCCESS_STATUSES, DEPLOYMENT_FAILURE_STATUSES, SESSION_STORE_POLL_SECONDS
+from app.fmc_utils import delete_p2p_topology_ids, start_deployment, get_deployment_status
+from app.session_store import session_store
+
+
+class DeploymentJob:
+    """
+    Background deployment of a merge: deleting the merged P2P topologies and deploying the changes to the devices.
+        Listeners follow the phase changes through `iter_phases` (threads) or `aiter_phases` (event loop). The phases
+        are also stored for the listeners in the other worker processes (see `aiter_stored_phases`).
+    """
+
+    def __init__(self, fmc: FMC, api_pool: ThreadPoolExecutor, p2p_topology_ids: list[str], device_ids: set[str]):
+        self.job_id = token_urlsafe(8)
+        self.fmc = fmc
+        self.api_pool = api_pool
+        self.p2p_topology_ids = p2p_topology_ids
+        self.device_ids = device_ids
+        self.phases: list[dict] = []
+        self.done = False
+        self.condition = Condition()
+        # Event loop and the event of each asynchronous listener
+        self.listeners: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self.set_phase("queued")
+
+    def set_phase(self, phase: str, detail: str = "", done: bool = False) -> None:
+        """
+        Record a phase change and notify the listeners.
+
+        :param phase: Phase name ("queued", "deleting", "deploying", FMC task status and the final "deployed" or
+            "failed")
+        :param detail: Additional information (e.g. error)
+        :param done: Is it the final phase?
+        """
+        with self.condition:
+            self.phases.append({"phase": phase, "detail": detail, "time": time()})
+            self.done = done
+            session_store.set_task_status(f"deployment:{self.job_id}", "done" if done else "pending", self.phases)
+            self.condition.notify_all()
+            for loop, event in self.listeners:
+                loop.call_soon_threadsafe(event.set)
+
+    def iter_phases(self, timeout: float = DEPLOY_TIMEOUT_SECONDS) -> Iterator[dict]:
+        """
+        Generator of the phases (past ones first) until the job is done.
+
+        :param timeout: Seconds to wait for the next phase
+        :return: Phase objects
+        """
+        sent = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.phases) > sent, timeout)
+                phases, done = self.phases[sent:], self.done
+            if not phases:
+                return
+            sent += len(phases)
+            yield from phases
+            if done:
+                return
+
+    async def aiter_phases(self, timeout: float = DEPLOY_TIMEOUT_SECONDS) -> AsyncIterator[dict]:
+        """
+        Asynchronous generator of the phases (past ones first) until the job is done. The listener awaits the phase
+            changes in the event loop instead of holding a thread.
+
+        :param timeout: Seconds to wait for the next phase
+        :return: Phase objects
+        """
+        listener = asyncio.get_running_loop(), asyncio.Event()
+        with self.condition:
+            self.listeners.add(listener)
+        try:
+            sent = 0
+            while True:
+                listener[1].clear()
+                with self.condition:
+                    phases, done = self.phases[sent:], self.done
+                sent += len(phases)
+                for phase in phases:
+                    yield phase
+                if done:
+                    return
+                try:
+                    await asyncio.wait_for(listener[1].wait(), timeout)
+                except asyncio.TimeoutError:
+                    return
+        finally:
+            with self.condition:
+                self.listeners.discard(listener)
+
+
+async def aiter_stored_phases(job_id: str) -> AsyncIterator[dict]:
+    """
+    Asynchronous generator of the phases of a deployment job running in any worker process until the job is done.
+
+    :param job_id: Deployment job ID
+    :return: Phase objects
+    """
+    sent = 0
+    while True:
+        task_status = await asyncio.to_thread(session_store.get_task_status, f"deployment:{job_id}")
+        if task_status is None:
+            return
+        status, phases = task_status
+        for phase in phases[sent:]:
+            yield phase
+        sent = len(phases)
+        if status == "done":
+            return
+        await asyncio.sleep(SESSION_STORE_POLL_SECONDS)
+
+
+class DeploymentQueue:
+    """
+    Deployment queue of a FMC domain. Jobs of the same FMC user submitted within the coalescing window (and while a
+        deployment is running) are combined into a single deployment of all their devices.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending_jobs: list[DeploymentJob] = []
+        self.worker: Optional[Thread] = None
+
+    def submit(self, job: DeploymentJob) -> DeploymentJob:
+        """
+        Queue a job and start the worker if idle.
+
+        :param job: Deployment job
+        :return: The job
+        """
+        with self.lock:
+            self.pending_jobs.append(job)
+            if self.worker is None:
+                self.worker = Thread(target=self.run, daemon=True)
+                self.worker.start()
+        return job
+
+    def run(self) -> None:
+        """
+        Worker deploying the queued jobs in batches until the queue is empty.
+        """
+        while True:
+            sleep(DEPLOY_COALESCE_SECONDS)
+            with self.lock:
+                jobs, self.pending_jobs = self.pending_jobs, []
+                if not jobs:
+                    self.worker = None
+                    return
+            deploy_jobs(jobs)
+
+
+def deploy_jobs(jobs: list[DeploymentJob]) -> None:
+    """
+    Delete the merged P2P topologies of each job with its own FMC session (in parallel under the rate limit), then
+        deploy the jobs of each FMC user together. A session never acts with the credentials of another user.
+
+    :param jobs: Queued deployment jobs
+    """
+    user_jobs = defaultdict(list)
+    for job in jobs:
+        try:
+            job.set_phase("deleting", f"{len(job.p2p_topology_ids)} point-to-point topologies")
+            delete_p2p_topology_ids(job.p2p_topology_ids, job.fmc, job.api_pool)
+        except Exception as e:
+            job.set_phase("failed", repr(e), True)
+            continue
+        user_jobs[job.fmc.username].append(job)
+    for combined_jobs in user_jobs.values():
+        deploy_combined_jobs(combined_jobs)
+
+
+def deploy_combined_jobs(jobs: list[DeploymentJob]) -> None:
+    """
+    Start a single deployment of the devices of the jobs and poll its status with backoff.
+
+    :param jobs: Deployment jobs of the same FMC user (with deleted P2P topologies)
+    """
+    def set_phase(phase: str, detail: str = "", done: bool = False):
+        for job in jobs:
+            job.set_phase(phase, detail, done)
+
+    fmc = jobs[-1].fmc
+    try:
+        device_ids = set().union(*(job.device_ids for job in jobs))
+        set_phase("deploying", f"{len(device_ids)} devices, {len(jobs)} merges")
+        task_id = start_deployment(fmc, device_ids)
+        if task_id is None:
+            set_phase("deployed", "No changes to deploy", True)
+            return
+        status = None
+        poll_seconds = DEPLOY_POLL_INITIAL_SECONDS
+        deadline = monotonic() + DEPLOY_TIMEOUT_SECONDS
+        while monotonic() < deadline:
+            sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, DEPLOY_POLL_MAX_SECONDS)
+            new_status = get_deployment_status(fmc, task_id)
+            if new_status == status:
+                continue
+            status = new_status
+            if status in DEPLOYMENT_SUCCESS_STATUSES:
+                set_phase("deployed", status, True)
+                return
+            if status in DEPLOYMENT_FAILURE_STATUSES:
+                set_phase("failed", status, True)
+                return
+            set_phase(str(status))
+        set_phase("failed", "Timed out waiting for the deployment", True)
+    except Exception as e:
+        set_phase("failed", repr(e), True)
+
+
+deployment_queues: dict[tuple[str, str], DeploymentQueue] = {}
+
+deployment_jobs: dict[str, DeploymentJob] = {}
+
+_registry_lock = Lock()
+
+
+def submit_deployment(fmc: FMC, api_pool: ThreadPoolExecutor, p2p_topology_ids: list[str],
+                      device_ids: set[str]) -> DeploymentJob:
+    """
+    Queue the deployment of a merge in its FMC domain.
+
+    :param fmc: The FMC API object
+    :param api_pool: Thread pool used to execute FMC API calls
+    :param p2p_topology_ids: Merged P2P topologies to delete
+    :param device_ids: Devices to deploy
+    :return: The deployment job
+    """
+    job = DeploymentJob(fmc, api_pool, p2p_topology_ids, device_ids)
+    with _registry_lock:
+        deployment_jobs[job.job_id] = job
+        queue = deployment_queues.setdefault((fmc.host, fmc.uuid), DeploymentQueue())
+    return queue.submit(job)
+
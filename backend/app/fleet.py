@@ -0,0 +1,59 @@
+from typing import Any, Iterator, Optional
+
+from app.batch_merge import get_device_name
+from app.fmc_session import FMCSession
+
+
+def iter_fleet_inventories(fleet_sessions: dict[str, FMCSession]) -> Iterator[tuple[str, str, str, Optional[dict]]]:
+    """
+    Generator of the inventories of every domain of every FMC host of a fleet. Starts fetching the inventories of the
+        sessions without a fetch yet (e.g. restored from other worker process, the stored snapshots are reused).
+
+    :param fleet_sessions: FMC host and session map
+    :return: Host, domain UUID, domain name and the inventory (None if not fetched yet)
+    """
+    for host, fmc_session in fleet_sessions.items():
+        if not fmc_session.prefetch_futures:
+            fmc_session.prefetch_domains(low_priority=False)
+        for domain_id, domain_name in fmc_session.domains.items():
+            yield host, domain_id, domain_name, fmc_session.inventories.get(domain_id)
+
+
+def get_fleet_devices(fleet_sessions: dict[str, FMCSession]) -> dict[str, list[dict[str, Any]]]:
+    """
+    Cross-FMC device view: the devices of the point-to-point topologies of all hosts and domains.
+
+    :param fleet_sessions: FMC host and session map
+    :return: Devices with their host, domain and number of P2P topologies and the (host, domain) still being fetched
+    """
+    devices, pending = [], []
+    for host, domain_id, domain_name, inventory in iter_fleet_inventories(fleet_sessions):
+        if inventory is None:
+            pending.append({"host": host, "domain_id": domain_id, "domain": domain_name})
+            continue
+        p2p_topologies = inventory["p2p_topologies"]
+        devices.extend({"host": host, "domain_id": domain_id, "domain": domain_name, "device_id": device_id,
+                        "name": get_device_name(p2p_topologies, device_id), "p2p_topologies": len(topologies)}
+                       for device_id, topologies in p2p_topologies.items())
+    return {"devices": devices, "pending": pending}
+
+
+def get_fleet_topologies(fleet_sessions: dict[str, FMCSession]) -> dict[str, list[dict[str, Any]]]:
+    """
+    Cross-FMC topology view: the topologies of all hosts and domains.
+
+    :param fleet_sessions: FMC host and session map
+    :return: Topology summaries with their host and domain and the (host, domain) still being fetched
+    """
+    topologies, pending = [], []
+    for host, domain_id, domain_name, inventory in iter_fleet_inventories(fleet_sessions):
+        if inventory is None:
+            pending.append({"host": host, "domain_id": domain_id, "domain": domain_name})
+            continue
+        p2p_topologies = {topology["id"]: topology for device_topologies in inventory["p2p_topologies"].values()
+                          for topology in device_topologies}
+        for topology in [*p2p_topologies.values(), *inventory["hns_topologies"], *inventory["mesh_topologies"]]:
+            topologies.append({"host": host, "domain_id": domain_id, "domain": domain_name, "id": topology["id"],
+                               "name": topology["name"], "topologyType": topology["topologyType"],
+                               "endpoints": len(topology["endpoints"])})
+    return {"topologies": topologies, "pending": pending}
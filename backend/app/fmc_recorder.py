@@ -0,0 +1,271 @@
+import json
+from collections import defaultdict, deque
+from hashlib import sha256
+from io import BytesIO
+from secrets import token_bytes
+from threading import Lock
+from time import perf_counter, sleep
+from typing import Any, Optional, Union
+from urllib.parse import urlsplit, parse_qs
+
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError
+from requests.models import PreparedRequest, Response
+from requests.sessions import Session
+from requests.structures import CaseInsensitiveDict
+
+from app.constants import RECORD_SECRET_HEADERS, RECORD_SECRET_KEYS, FMC_RECORD_PATH, FMC_REPLAY_PATH, \
+    FMC_REPLAY_LATENCY_SCALE
+
+REDACTED = "REDACTED"
+
+# Recorder or replay adapter started for the whole process
+active_capture: Optional[Union["FMCTrafficRecorder", "FMCReplayAdapter"]] = None
+
+
+def get_request_path(url: str) -> str:
+    """
+    Strip scheme and host from the URL so that recordings can be replayed against any FMC host.
+
+    :param url: Full request URL
+    :return: Path with query string
+    """
+    split_url = urlsplit(url)
+    return f"{split_url.path}?{split_url.query}" if split_url.query else split_url.path
+
+
+def get_cassette_entry(method: str, path: str, body: Any, status: int = 200, headers: Optional[dict] = None,
+                       elapsed: float = 0.0, started: float = 0.0, repeatable: bool = False) -> dict:
+    """
+    Create a cassette entry for a synthetic response (e.g. generated inventory served by the replay adapter).
+
+    :param method: HTTP method
+    :param path: Request path with query string
+    :param body: JSON response body
+    :param status: HTTP status code
+    :param headers: Response headers
+    :param elapsed: Simulated round trip time in seconds
+    :param started: Seconds since the start of the recording
+    :param repeatable: Serve the response to any number of requests (e.g. FMC stand-in)? Otherwise it is served once.
+    :return: Cassette entry
+    """
+    return {"method": method, "path": path, "body_digest": None, "request_body": None, "status": status,
+            "headers": headers or {"Content-Type": "application/json"}, "body": json.dumps(body), "started": started,
+            "elapsed": elapsed, "repeatable": repeatable}
+
+
+def redact_json(value: Any, redact_value) -> Any:
+    """
+    Replace the values of secret keys (pre-shared keys, passwords) in a JSON object.
+
+    :param value: JSON object
+    :param redact_value: Function mapping a secret value to its replacement
+    :return: Redacted copy of the JSON object
+    """
+    if isinstance(value, dict):
+        return {key: redact_value(item) if key in RECORD_SECRET_KEYS else redact_json(item, redact_value)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact_json(item, redact_value) for item in value]
+    return value
+
+
+def get_body_digest(body: Optional[bytes]) -> Optional[str]:
+    """
+    Digest of the request body with secrets masked. Used to pick the matching recorded response during replay.
+
+    :param body: Raw request body
+    :return: Hex digest or None if there is no body
+    """
+    if not body:
+        return None
+    try:
+        masked_body = json.dumps(redact_json(json.loads(body), lambda _: REDACTED), sort_keys=True)
+    except ValueError:
+        masked_body = body.decode(errors="replace") if isinstance(body, bytes) else body
+    return sha256(masked_body.encode()).hexdigest()
+
+
+class FMCTrafficRecorder:
+    """
+    Records every FMC request/response pair with its timing into a JSON lines _cassette_. Secret headers are dropped
+        and secret JSON values are replaced by salted digests so that equal secrets (e.g. conflicting pre-shared keys)
+        stay equal in the recording.
+    """
+
+    def __init__(self, cassette_path: str):
+        self.cassette_path = cassette_path
+        self.salt = token_bytes(16)
+        self.lock = Lock()
+        self.start_time = None
+        self.cassette = None
+        self.orig_send = None
+
+    def redact_value(self, value: Any) -> str:
+        """
+        Replace a secret with a salted digest preserving equality within the recording.
+
+        :param value: Secret value
+        :return: Redacted value
+        """
+        return f"{REDACTED}-{sha256(self.salt + str(value).encode()).hexdigest()[:12]}"
+
+    def redact_body(self, body: Optional[str]) -> Optional[str]:
+        """
+        Redact secret values from the JSON request or response body.
+
+        :param body: Body text
+        :return: Redacted body text
+        """
+        if not body:
+            return body
+        try:
+            return json.dumps(redact_json(json.loads(body), self.redact_value))
+        except ValueError:
+            return body
+
+    def record(self, request: PreparedRequest, response: Response, started: float, elapsed: float) -> None:
+        """
+        Append a request/response pair to the cassette.
+
+        :param request: Sent request
+        :param response: Received response
+        :param started: Seconds since the recording started
+        :param elapsed: Round trip time in seconds
+        """
+        request_body = request.body.decode(errors="replace") if isinstance(request.body, bytes) else request.body
+        entry = {
+            "method": request.method,
+            "path": get_request_path(request.url),
+            "body_digest": get_body_digest(request.body),
+            "request_body": self.redact_body(request_body),
+            "status": response.status_code,
+            "headers": {key: REDACTED if key.lower() in RECORD_SECRET_HEADERS else value
+                        for key, value in response.headers.items()},
+            "body": self.redact_body(response.text),
+            "started": started,
+            "elapsed": elapsed,
+        }
+        with self.lock:
+            self.cassette.write(json.dumps(entry) + "\n")
+            self.cassette.flush()
+
+    def __enter__(self):
+        self.cassette = open(self.cassette_path, "a")
+        self.start_time = perf_counter()
+        self.orig_send = orig_send = Session.send
+        recorder = self
+
+        def send(session, request, **kwargs):
+            started = perf_counter()
+            response = orig_send(session, request, **kwargs)
+            recorder.record(request, response, started - recorder.start_time, perf_counter() - started)
+            return response
+
+        Session.send = send
+        return self
+
+    def __exit__(self, *args):
+        Session.send = self.orig_send
+        self.cassette.close()
+
+
+class FMCReplayAdapter(BaseAdapter):
+    """
+    Transport adapter serving the responses of a recorded cassette instead of contacting FMC. Requests are matched on
+        method, path with query string (i.e. the page `offset` and `limit`) and (if possible) body. Entries without
+        query string match any query of the first page on the same path. Each entry is served once unless repeatable,
+        a request without unused entry fails as if FMC was unreachable.
+    """
+
+    def __init__(self, cassette_path: str, latency_scale: float = 1.0, latency: Optional[float] = None):
+        """
+        :param cassette_path: Path of the cassette written by `FMCTrafficRecorder`
+        :param latency_scale: Multiplier of the recorded latency (0 replays instantly)
+        :param latency: Fixed latency in seconds used instead of the recorded one
+        """
+        super().__init__()
+        self.latency_scale = latency_scale
+        self.latency = latency
+        self.lock = Lock()
+        self.entries: dict[tuple[str, str], deque[dict]] = defaultdict(deque)
+        # Method and path of the served requests and the last served entry
+        self.last_served: dict[tuple[str, str], dict] = {}
+        with open(cassette_path) as cassette:
+            for line in cassette:
+                entry = json.loads(line)
+                self.entries[(entry["method"], entry["path"])].append(entry)
+        self.orig_get_adapter = None
+
+    def pop_entry(self, request: PreparedRequest) -> dict:
+        """
+        Get the recorded entry for the request. Prefers the first unused entry with identical body.
+
+        :param request: Request to serve
+        :return: Recorded entry
+        """
+        key = (request.method, get_request_path(request.url))
+        body_digest = get_body_digest(request.body)
+        with self.lock:
+            split_url = urlsplit(request.url)
+            if key not in self.entries and int(parse_qs(split_url.query).get("offset", ["0"])[0]) == 0:
+                key = (request.method, split_url.path)
+            entries = self.entries.get(key)
+            if entries:
+                for entry in entries:
+                    if entry["body_digest"] == body_digest:
+                        break
+                else:
+                    entry = entries[0]
+                if not entry.get("repeatable"):
+                    entries.remove(entry)
+                self.last_served[key] = entry
+                return entry
+        raise ConnectionError(f"No recorded response for {request.method} {key[1]}", request=request)
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        entry = self.pop_entry(request)
+        sleep(self.latency if self.latency is not None else entry["elapsed"] * self.latency_scale)
+        response = Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = (entry["body"] or "").encode()
+        # Read by the streamed requests
+        response.raw = BytesIO(response._content)
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        self.orig_get_adapter = Session.get_adapter
+        Session.get_adapter = lambda session, url: self
+        return self
+
+    def __exit__(self, *args):
+        Session.get_adapter = self.orig_get_adapter
+
+
+def start_fmc_traffic_capture() -> None:
+    """
+    Start recording or replaying FMC traffic for the whole process if configured through the environment
+        (`FMC_RECORD_PATH`, `FMC_REPLAY_PATH`, `FMC_REPLAY_LATENCY_SCALE`). Stopped by `stop_fmc_traffic_capture`.
+    """
+    global active_capture
+    if FMC_REPLAY_PATH:
+        active_capture = FMCReplayAdapter(FMC_REPLAY_PATH, FMC_REPLAY_LATENCY_SCALE).__enter__()
+    elif FMC_RECORD_PATH:
+        active_capture = FMCTrafficRecorder(FMC_RECORD_PATH).__enter__()
+
+
+def stop_fmc_traffic_capture() -> None:
+    """
+    Restore the requests transport and close the cassette of the capture started by `start_fmc_traffic_capture`.
+    """
+    global active_capture
+    if active_capture is not None:
+        active_capture.__exit__(None, None, None)
+        active_capture = None
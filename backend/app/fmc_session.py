@@ -1,53 +1,69 @@
-from collections import defaultdict
-from concurrent.futures import wait
+from collections import defaultdict, Counter
+from concurrent.futures import Future, wait
 from concurrent.futures.thread import ThreadPoolExecutor
 from functools import partial
-from threading import Thread
-from time import sleep
-from typing import Any
+from itertools import islice
+from threading import Thread, Lock
+from time import sleep, monotonic
+from typing import Any, Optional
 
 from fastapi.security import OAuth2PasswordRequestForm
-from fmcapi import FMC, DeviceRecords, AdvancedSettings, IPSecSettings, FTDS2SVPNs
+from fmcapi import DeviceRecords, AdvancedSettings, IPSecSettings, FTDS2SVPNs, FMC, IKESettings, Endpoints
 
-from app.constants import RATE_LIMIT_WAIT_SECONDS
-from app.fmc_utils import delete_p2p_topology_ids, get_topologies_from_ids, get_topology_api, \
+from app.fmc_utils import delete_p2p_topology_ids, get_topologies_from_ids, create_topology, \
     get_ike_settings, set_endpoints_future, get_base_hns_topology, fetch_to_device_p2p_topologies, \
-    post_topology_settings, get_topology_endpoints, get_topologies_with_their_endpoints, fetch_to_hns_p2p_topologies
-from app.utils import get_task_callback_setup, get_dict_diff
+    post_topology_settings, get_topology_endpoints, get_topologies_with_their_endpoints, fetch_to_hns_p2p_topologies, \
+    rollback_merge, limit_fmc_rate, get_fmc, get_fmc_state, restore_fmc, get_topologies_from_snapshot, \
+    get_domain_fmc, hedge_fmc_gets, iter_fmc_items, get_endpoint_key, get_verification_digest, verify_topology
+from app.constants import INVENTORY_FETCH_TIMEOUT_SECONDS, PREFETCH_REQUESTS_PER_MINUTE, PREFETCH_REQUEST_BURST, \
+    PREFETCH_PARALLEL_DOMAINS, PREFETCH_API_POOL_SIZE, DEVICE_CACHE_TTL_SECONDS, CONFLICT_IGNORED_KEYS
+from app.deployment import DeploymentJob, submit_deployment
+from app.inventory import to_fmc_json, TopologyRecord
+from app.merge_journal import MergeJournal
+from app.session_store import session_store, get_token_hash
+from app.utils import get_task_callback_setup, get_dict_diff, RateLimiter, get_conflict_signature
 
 
-class FMCSession:
-    def __init__(self, creds: OAuth2PasswordRequestForm):
-        host, username = creds.username.split(" ", 1)
-        self.fmc = FMC(host=host, username=username, password=creds.password, autodeploy=True,
-                       file_logging="/tmp/log.txt", domain=None, debug=False, limit=1000, timeout=180,
-                       check_server_version=False)
-        self.fmc.TOO_MANY_CONNECTIONS_TIMEOUT = RATE_LIMIT_WAIT_SECONDS
-        self.fmc.__enter__()
-        self.domains: dict[str, str] = {domain["uuid"]: domain["name"] for domain in self.fmc.mytoken.all_domain}
-        self.fmc.uuid = None
+class MergeWorkspace:
+    """
+    Selection, conflict state and pending tasks of one merge of a session. The workspaces of a session share the
+        (read-only) inventory of the domain so that several merges are fetched, resolved and created in parallel.
+    """
+
+    def __init__(self, fmc_session: "FMCSession", name: str):
+        """
+        :param fmc_session: Session of the workspace
+        :param name: Workspace name
+        """
+        self.fmc_session = fmc_session
+        self.name = name
         self.hub_device_id = None
         self.hns_topology_id = None
-        self.api_pool = ThreadPoolExecutor(max_workers=8)  # max FMC limit 10
-        self.max_topologies = 500
-        self.pending_futures = defaultdict(list)
         self.hns_topology = None
         self.orig_hns_p2p_topology_ids = None
-        self.p2p_topologies = None
-        self.hns_topologies = None
         self.hns_p2p_topologies = []
+        self.pending_futures = defaultdict(list)
+        # The fetch of the domain's topologies is shared with the session
+        self.pending_futures["topologies"] = fmc_session.pending_futures["topologies"]
 
-    def set_domain(self, domain_id: str) -> None:
+    def get_state(self) -> dict[str, Any]:
+        """
+        :return: JSON serializable workspace state
         """
-        - Set the domain UUID for the FMC session
-        - trigger fetching all topologies in background thread.
+        return {"hub_device_id": self.hub_device_id, "hns_topology_id": self.hns_topology_id,
+                "hns_topology": to_fmc_json(self.hns_topology),
+                "orig_hns_p2p_topology_ids": self.orig_hns_p2p_topology_ids}
 
-        :param domain_id: Domain UUID
+    def apply_state(self, state: dict[str, Any]) -> None:
         """
-        if domain_id != self.fmc.uuid:
-            self.fmc.uuid = domain_id
-            self.fmc.domain = self.fmc.mytoken.__domain = self.domains[domain_id]
-            Thread(target=self.fetch_topologies).start()
+        :param state: Stored workspace state
+        """
+        if state["hub_device_id"] is not None:
+            self.set_hub_device_id(state["hub_device_id"])
+        if state["hns_topology_id"] is not None:
+            self.set_hns_topology_id(state["hns_topology_id"])
+        self.hns_topology = state["hns_topology"]
+        self.orig_hns_p2p_topology_ids = state["orig_hns_p2p_topology_ids"]
 
     def set_hns_topology_id(self, hns_topology_id: str) -> list[dict]:
         """
@@ -56,126 +72,566 @@ class FMCSession:
             a background thread.
 
         :param hns_topology_id: HNS topology UUID
+        :return: The p2p topologies which can be merged into the HNS topology
         """
         if self.hns_topology_id != hns_topology_id:
             self.hns_topology_id = hns_topology_id
-            assert self.p2p_topologies
-            for topology in self.hns_topologies:
+            fmc_session = self.fmc_session
+            assert fmc_session.p2p_topologies
+            for topology in fmc_session.get_merge_targets():
                 if topology["id"] == hns_topology_id:
                     hns_topology = topology
                     break
-            fetch_to_hns_p2p_topologies(self.pending_futures, self.p2p_topologies, hns_topology,
-                                        self.api_pool,
-                                        self.fmc, self.hns_p2p_topologies)
+            # Only the p2p topologies of the selected HNS topology, not the previously selected ones
+            self.hns_p2p_topologies = []
+            task_key = fmc_session.get_task_key("hns_p2p_topologies", fmc_session.fmc.uuid, self.name)
+            session_store.set_task_status(task_key, "pending")
+            try:
+                fetch_to_hns_p2p_topologies(self.pending_futures, fmc_session.p2p_topologies, hns_topology,
+                                            fmc_session.api_pool, fmc_session.fmc, self.hns_p2p_topologies)
+            finally:
+                session_store.set_task_status(task_key, "done")
         return self.hns_p2p_topologies
 
-    def set_hub_device_id(self, device_id: str) -> None:
+    def set_hub_device_id(self, device_id: Optional[str]) -> None:
         """
         - Set the UUID of device used as hub.
         - Trigger fetching IKE settings for the topologies containing that device in a background thread.
 
-        :param device_id: Device UUID
+        :param device_id: Device UUID (None if merging into existing topology)
         """
         if self.hub_device_id != device_id:
             self.hub_device_id = device_id
+            if device_id is None:
+                return
+            fmc_session = self.fmc_session
             wait(self.pending_futures["topologies"])
-            assert self.p2p_topologies
-            fetch_to_device_p2p_topologies(self.pending_futures, self.p2p_topologies, self.hub_device_id, self.api_pool,
-                                           self.fmc)
+            assert fmc_session.p2p_topologies
+            task_key = fmc_session.get_task_key("device_p2p_topologies", fmc_session.fmc.uuid, self.name)
+            session_store.set_task_status(task_key, "pending")
+            try:
+                fetch_to_device_p2p_topologies(self.pending_futures, fmc_session.p2p_topologies, device_id,
+                                               fmc_session.api_pool, fmc_session.fmc)
+            finally:
+                session_store.set_task_status(task_key, "done")
+
+    def get_topology_conflicts(self, topology_ids: list[str]) -> dict[str, Any]:
+        """
+        Get the conflicting parameters among the topologies of the selected hub device (or HNS topology).
+
+        :param topology_ids: List of topology UUIDs.
+        :return: Parameters with the list of conflicting values. Data structures corresponds the GET ftds2svpns response.
+        """
+        return self.fmc_session.get_topology_conflicts(topology_ids, self.hub_device_id, self.hns_p2p_topologies)
+
+    def create_hns_topology(self, topology_name: str, p2p_topology_ids: list[str], override: dict[str, Any],
+                            existing_hns_topology_id: str, journal: Optional[MergeJournal] = None,
+                            topology_type: str = "HUB_AND_SPOKE", verify: bool = True) -> dict:
+        """
+        Create new Hub and Spoke (or Full Mesh) topology on the selected hub device from Point to Point topologies if hns
+            topology ID is not provided or merge into existing one. The merged topology is kept for the deployment.
+
+        :param existing_hns_topology_id: Existing HNS topology UUID to merge into (None if new topology)
+        :param topology_name: Name of topology if creating new one
+        :param p2p_topology_ids: The UUID list of point to point topologies being merged.
+        :param override: The overriding parameter values used for conflicts. Data structure corresponds to the GET
+            topology response.
+        :param journal: Journal of the merge being resumed (None to start a new one)
+        :param topology_type: Type of new topology ("HUB_AND_SPOKE" or "FULL_MESH")
+        :param verify: Verify the merged topology against FMC (see `FMCSession.merge_hns_topology`)?
+        :return: Hub and spoke topology parameters corresponding to the GET `ftds2svpns` response
+        """
+        self.hns_topology = self.fmc_session.merge_hns_topology(topology_name, p2p_topology_ids, override,
+                                                                existing_hns_topology_id, self.hub_device_id, journal,
+                                                                topology_type, self.hns_p2p_topologies, verify)
+        self.orig_hns_p2p_topology_ids = p2p_topology_ids
+        return self.hns_topology
+
+    def resume_merge(self, merge_id: str) -> dict:
+        """
+        Resume a failed merge from its last completed step.
+
+        :param merge_id: Merge ID
+        :return: Hub and spoke topology parameters corresponding to the GET `ftds2svpns` response
+        """
+        journal = self.fmc_session.get_merge_journal(merge_id)
+        parameters = journal.parameters
+        if parameters["hns_topology_id"] is not None:
+            self.set_hns_topology_id(parameters["hns_topology_id"])
+        self.set_hub_device_id(parameters["hub_device_id"])
+        return self.create_hns_topology(parameters["topology_name"], parameters["p2p_topology_ids"],
+                                        parameters["override"], parameters["hns_topology_id"], journal,
+                                        parameters.get("topology_type", "HUB_AND_SPOKE"))
+
+    def deploy(self) -> DeploymentJob:
+        """
+        Queue the deletion of the merged P2P topologies and the deployment of the changes to the involved devices. The
+            deployment runs in background and may be combined with other merges of the domain.
+
+        :return: The deployment job
+        """
+        fmc_session = self.fmc_session
+        p2p_topology_ids = self.orig_hns_p2p_topology_ids or []
+        device_ids = {endpoint["device"]["id"] for endpoint in self.hns_topology["endpoints"]
+                      if not endpoint["extranet"]}
+        for topology in {id(topology): topology for topologies in fmc_session.p2p_topologies.values()
+                         for topology in topologies if topology["id"] in p2p_topology_ids}.values():
+            device_ids.update(endpoint["device"]["id"] for endpoint in topology["endpoints"] if not endpoint["extranet"])
+        # Deleted with the deployment
+        self.orig_hns_p2p_topology_ids = None
+        return submit_deployment(fmc_session.fmc, fmc_session.api_pool, p2p_topology_ids, device_ids)
+
+
+class FMCSession:
+    def __init__(self, token: str, creds: Optional[OAuth2PasswordRequestForm] = None,
+                 state: Optional[dict[str, Any]] = None):
+        """
+        Login to FMC or restore a session logged in by other worker process.
+
+        :param token: OAuth2 token of the session
+        :param creds: FMC login credentials (for new session)
+        :param state: Stored session state (for restoring the session)
+        """
+        self.token = token
+        self.saved_state = None
+        if state is None:
+            host, username = creds.username.split(" ", 1)
+            self.fmc = get_fmc(host, username, creds.password)
+            self.fmc.__enter__()
+        else:
+            self.fmc = restore_fmc(state["fmc"])
+        limit_fmc_rate(self.fmc)
+        hedge_fmc_gets(self.fmc)
+        self.domains: dict[str, str] = {domain["uuid"]: domain["name"] for domain in self.fmc.mytoken.all_domain}
+        self.fmc.uuid = None
+        self.api_pool = ThreadPoolExecutor(max_workers=8)  # max FMC limit 10
+        self.max_topologies = 500
+        self.pending_futures = defaultdict(list)
+        self.p2p_topologies = None
+        self.hns_topologies = None
+        self.mesh_topologies = None
+        # Domain UUID and its merge workspace name and workspace map
+        self.domain_workspaces: dict[str, dict[str, MergeWorkspace]] = defaultdict(dict)
+        # Merge workspace name and workspace map of the current domain
+        self.workspaces: dict[str, MergeWorkspace] = {}
+        self.workspaces_lock = Lock()
+        # Domain UUID and its topologies ("p2p_topologies", "hns_topologies" and "mesh_topologies") map
+        self.inventories: dict[str, dict[str, Any]] = {}
+        self.prefetch_futures: dict[str, Future] = {}
+        self.prefetch_budget = RateLimiter(PREFETCH_REQUESTS_PER_MINUTE, PREFETCH_REQUEST_BURST)
+        # Domain UUID and the fetch time and list of its registered devices map
+        self.device_caches: dict[str, tuple[float, list[dict]]] = {}
+        if state is not None:
+            self.apply_state(state)
+
+    def get_state(self) -> dict[str, Any]:
+        """
+        Get the session metadata shared with the other worker processes through the session store.
+
+        :return: JSON serializable session state
+        """
+        return {"fmc": get_fmc_state(self.fmc), "domain_id": self.fmc.uuid,
+                "workspaces": {name: workspace.get_state() for name, workspace in list(self.workspaces.items())}}
+
+    def apply_state(self, state: dict[str, Any]) -> None:
+        """
+        Catch up with the session state saved by other worker process. The inventory snapshot of the domain is reused
+            instead of fetching the topologies again.
+
+        :param state: Stored session state
+        """
+        if state["domain_id"] is not None:
+            self.set_domain(state["domain_id"], blocking=True)
+        workspace_states = state.get("workspaces", {})
+        for name in set(self.workspaces) - set(workspace_states):
+            self.remove_workspace(name)
+        for name, workspace_state in workspace_states.items():
+            self.get_workspace(name).apply_state(workspace_state)
 
-    def get_registered_devices(self) -> list[dict]:
+    def set_domain(self, domain_id: str, blocking: bool = False) -> None:
         """
-        Get list of all devices registered on FMC
+        - Set the domain UUID for the FMC session and switch to the merge workspaces of the domain
+        - switch to the inventory of the domain if already fetched (or being prefetched)
+        - otherwise trigger fetching all topologies in background thread.
+
+        :param domain_id: Domain UUID
+        :param blocking: Fetch the topologies before returning instead
+        """
+        if domain_id != self.fmc.uuid:
+            self.fmc.uuid = domain_id
+            self.fmc.domain = self.fmc.mytoken.__domain = self.domains[domain_id]
+            self.fmc.build_urls()
+            # The workspaces of the previous domain are kept for when it is selected again
+            with self.workspaces_lock:
+                self.workspaces = self.domain_workspaces[domain_id]
+            # The prefetch switches to the inventory itself if it completes after the domain UUID is set
+            if domain_id in self.inventories:
+                self.use_inventory(domain_id)
+            elif domain_id in self.prefetch_futures and not self.prefetch_futures[domain_id].done():
+                self.pending_futures["topologies"].append(self.prefetch_futures[domain_id])
+                if blocking:
+                    self.prefetch_futures[domain_id].result()
+            elif blocking:
+                self.fetch_topologies(use_snapshot=True)
+            else:
+                Thread(target=self.fetch_topologies, kwargs={"use_snapshot": True}).start()
 
-        :return: List of device details
+    def prefetch_domains(self, low_priority: bool = True) -> None:
         """
-        device_api_response = DeviceRecords(fmc=self.fmc).get()
-        devices = device_api_response["items"]
+        Fetch the inventories of all domains in background with few parallel domains and connections.
+
+        :param low_priority: Limit the calls by the prefetch budget and give way to the interactive calls of the FMC
+            host? Otherwise only the rate limit of the host applies.
+        """
+        prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_PARALLEL_DOMAINS)
+        api_pool = ThreadPoolExecutor(max_workers=PREFETCH_API_POOL_SIZE)
+        for domain_id in self.domains:
+            if domain_id not in self.inventories:
+                self.prefetch_futures[domain_id] = prefetch_pool.submit(self.prefetch_domain, domain_id, api_pool,
+                                                                        low_priority)
+
+        def shutdown_pools():
+            # The API pool is used by the prefetches until they are done
+            prefetch_pool.shutdown()
+            api_pool.shutdown()
+
+        Thread(target=shutdown_pools, daemon=True).start()
+
+    def prefetch_domain(self, domain_id: str, api_pool: ThreadPoolExecutor, low_priority: bool = True) -> None:
+        """
+        Fetch the inventory of a domain unless fetched meanwhile.
+
+        :param domain_id: Domain UUID
+        :param api_pool: Thread pool of the prefetch calls
+        :param low_priority: Limit the calls by the prefetch budget?
+        """
+        if domain_id in self.inventories:
+            return
+        domain_fmc = get_domain_fmc(self.fmc, domain_id, self.prefetch_budget if low_priority else None)
+        self.set_topologies(domain_id, self.fetch_inventory(domain_fmc, api_pool, use_snapshot=True))
+
+    def get_task_key(self, task: str, domain_id: str, workspace: Optional[str] = None) -> str:
+        """
+        :param task: Task name ("topologies", "device_p2p_topologies" or "hns_p2p_topologies")
+        :param domain_id: Domain UUID
+        :param workspace: Merge workspace name (for the tasks of a workspace)
+        :return: Key of the task status in the session store (shared by the worker processes)
+        """
+        if task == "topologies":
+            return f"inventory:{get_token_hash(self.token)}:{domain_id}"
+        return f"{task}:{get_token_hash(self.token)}:{domain_id}:{workspace or 'default'}"
+
+    def get_workspace(self, name: str) -> MergeWorkspace:
+        """
+        :param name: Workspace name
+        :return: The merge workspace of the name (created if needed)
+        """
+        with self.workspaces_lock:
+            if name not in self.workspaces:
+                self.workspaces[name] = MergeWorkspace(self, name)
+            return self.workspaces[name]
+
+    def remove_workspace(self, name: str) -> None:
+        """
+        :param name: Workspace name
+        """
+        with self.workspaces_lock:
+            self.workspaces.pop(name, None)
+
+    def get_registered_devices(self, refresh: bool = False) -> list[dict]:
+        """
+        Get list of all devices registered on FMC with the VPN counts of each device. The devices of the domain are
+            cached for `DEVICE_CACHE_TTL_SECONDS`.
+
+        :param refresh: Fetch the devices even if cached
+        :return: List of device details. "vpn" has the number of the device's P2P topologies ("p2pTopologies"),
+            hub and spoke/full mesh memberships ("hnsTopologies") and distinct IKE/IPsec settings among its P2P
+            topologies ("conflictGroups", None until their IKE settings are fetched). The counts are None until the
+            topologies of the domain are fetched.
+        """
+        cached = self.device_caches.get(self.fmc.uuid)
+        if refresh or cached is None or monotonic() - cached[0] > DEVICE_CACHE_TTL_SECONDS:
+            cached = self.device_caches[self.fmc.uuid] = monotonic(), DeviceRecords(fmc=self.fmc).get()["items"]
+        p2p_topologies = self.p2p_topologies
+        merge_targets = self.get_merge_targets() if p2p_topologies is not None else []
+        memberships = Counter(endpoint["device"]["id"] for topology in merge_targets
+                              for endpoint in topology["endpoints"] if not endpoint["extranet"])
+        devices = []
+        for device in cached[1]:
+            topologies = p2p_topologies.get(device["id"], []) if p2p_topologies is not None else None
+            conflict_groups = None
+            if topologies and all("links" not in topology["ikeSettings"] for topology in topologies):
+                conflict_groups = len({get_conflict_signature(topology, CONFLICT_IGNORED_KEYS)
+                                       for topology in topologies})
+            devices.append({**device, "vpn": {
+                "p2pTopologies": len(topologies) if topologies is not None else None,
+                "hnsTopologies": memberships[device["id"]] if p2p_topologies is not None else None,
+                "conflictGroups": conflict_groups}})
         return devices
 
-    def get_topology_conflicts(self, topology_ids: list[str]) -> dict[str, Any]:
+    def get_topology_conflicts(self, topology_ids: list[str], hub_device_id: Optional[str],
+                               hns_p2p_topologies: Optional[list[dict]] = None) -> dict[str, Any]:
         """
         Get the conflicting parameters among the topologies.
 
         :param topology_ids: List of topology UUIDs.
+        :param hub_device_id: Hub device of the topologies (None if merging into existing topology)
+        :param hns_p2p_topologies: List of p2p topologies for merging into existing hns topology
         :return: Parameters with the list of conflicting values. Data structures corresponds the GET ftds2svpns response.
         """
-        topologies = get_topologies_from_ids(self.p2p_topologies, self.hub_device_id, topology_ids, self.hns_p2p_topologies)
-        ignored_keys = {"metadata", "id", "description", "links", "topologyType", "endpoints", "name"}
-        conflicts = get_dict_diff(topologies, ignored_keys)
+        topologies = get_topologies_from_ids(self.p2p_topologies, hub_device_id, topology_ids, hns_p2p_topologies or [])
+        conflicts = get_dict_diff(topologies, CONFLICT_IGNORED_KEYS)
         return conflicts
 
-    def create_hns_topology(self, topology_name: str, p2p_topology_ids: list[str], override: dict[str, Any], existing_hns_topology_id: str) -> dict:
+    def get_merge_targets(self) -> list[dict]:
+        """
+        :return: Existing topologies which point-to-point topologies can be merged into (hub and spoke, full mesh)
+        """
+        return self.hns_topologies + self.mesh_topologies
+
+    def merge_hns_topology(self, topology_name: str, p2p_topology_ids: list[str], override: dict[str, Any],
+                           existing_hns_topology_id: Optional[str], hub_device_id: Optional[str],
+                           journal: Optional[MergeJournal] = None, topology_type: str = "HUB_AND_SPOKE",
+                           hns_p2p_topologies: Optional[list[dict]] = None, verify: bool = True) -> dict:
         """
         Create new Hub and Spoke topology on the device from Point to Point topologies if hns topology ID is not provided or merge into existing one.
+            Every completed step is recorded in the merge journal. The steps already recorded in the supplied journal
+            are skipped (when resuming a failed merge).
+            With "FULL_MESH" type every distinct endpoint of the merged topologies becomes a peer of the new topology (or
+            the existing full mesh topology).
+            With `verify` the digests of the intended endpoints and settings are compared with the ones read back from
+            FMC and the result is returned in "verification" (see `verify_topology`).
+            The FMC round trips on the critical path of the merge (sequential writes, not counting the verification)
+            and the ones saved compared with reading the topology back after posting the settings along with the
+            endpoints are returned in "round_trips".
 
         :param existing_hns_topology_id: Existing HNS topology UUID to merge into (None if new topology)
         :param topology_name: Name of topology if creating new one
         :param p2p_topology_ids: The UUID list of point to point topologies being merged.
         :param override: The overriding parameter values used for conflicts. Data structure corresponds to the GET
             topology response.
+        :param hub_device_id: The device of the hub of new topology (None if merging into existing one)
+        :param journal: Journal of the merge being resumed (None to start a new one)
+        :param topology_type: Type of new topology ("HUB_AND_SPOKE" or "FULL_MESH"). The type of the existing topology
+            is used when merging into one.
+        :param hns_p2p_topologies: List of p2p topologies for merging into existing hns topology
+        :param verify: Verify the merged topology against FMC?
         :return: Hub and spoke topology parameters corresponding to the GET `ftds2svpns` response
         """
-        base_hns_topology = get_base_hns_topology(self.p2p_topologies, self.hub_device_id, override, topology_name, existing_hns_topology_id, self.hns_topologies)
-        hns_topology_api = get_topology_api(base_hns_topology, self.fmc)
-        hns_topology_id = hns_topology_api.id
+        merge_targets = self.get_merge_targets()
+        if existing_hns_topology_id is not None:
+            topology_type = next(topology["topologyType"] for topology in merge_targets
+                                 if topology["id"] == existing_hns_topology_id)
+        if journal is None:
+            journal = self.begin_merge_journal(topology_name, p2p_topology_ids, override, existing_hns_topology_id,
+                                               hub_device_id, topology_type)
+        base_hns_topology = get_base_hns_topology(self.p2p_topologies, hub_device_id, p2p_topology_ids, override,
+                                                  topology_name, existing_hns_topology_id, merge_targets,
+                                                  topology_type)
+        critical_path = 0
+        if journal.is_done("topology"):
+            topology_step = journal.get("topology")
+            hns_topology = topology_step.get("topology")
+            if hns_topology is None:
+                # Journals written before the created topology was recorded
+                hns_topology = FTDS2SVPNs(fmc=self.fmc, id=topology_step["topology_id"]).get()
+                critical_path += 1
+        else:
+            hns_topology = create_topology(base_hns_topology, self.fmc)
+            critical_path += 1
+            journal.record("topology", topology_id=hns_topology["id"], created=existing_hns_topology_id is None,
+                           topology=hns_topology)
+        hns_topology_id = hns_topology["id"]
+
+        # Only the endpoints depend on the IKE settings, the other settings are created while they are posted
+        submit_task, run_callbacks = get_task_callback_setup(self.api_pool)
+        created_settings = {}
+        settings_posted = False
+        for key_name, policy_service in (("ipsecSettings", IPSecSettings), ("advancedSettings", AdvancedSettings)):
+            if journal.is_done(key_name):
+                created_settings[key_name] = journal.get(key_name).get("settings") or base_hns_topology[key_name]
+            else:
+                def set_settings(settings, step=key_name):
+                    journal.record(step, settings=settings)
+                    created_settings[step] = settings
+
+                submit_task(post_topology_settings, self.fmc, hns_topology_id, base_hns_topology, key_name,
+                            policy_service, callback=set_settings)
+                settings_posted = True
 
         # Must set IKE settings before endpoints to override the default automatic pre-shared key setting else FMC API complains
-        created_ike_settings = get_ike_settings(self.fmc, hns_topology_id, base_hns_topology)
+        if journal.is_done("ikeSettings"):
+            created_ike_settings = journal.get("ikeSettings")["settings"]
+        else:
+            try:
+                created_ike_settings = get_ike_settings(self.fmc, hns_topology_id, base_hns_topology)
+            except Exception:
+                # Journal the settings created meanwhile so that they are skipped when resuming
+                run_callbacks()
+                raise
+            journal.record("ikeSettings", settings=created_ike_settings)
+            critical_path += 1
 
-        submit_task, run_callbacks = get_task_callback_setup(self.api_pool)
-        created_endpoints = set_endpoints_future(self.p2p_topologies, self.hub_device_id, self.fmc,
-                                                 hns_topology_id, p2p_topology_ids, self.hns_p2p_topologies, self.api_pool, self.hns_topologies,
+        # The endpoints kept from the existing topology are expected as well
+        endpoint_digests = Counter(
+            (get_endpoint_key(endpoint), get_verification_digest(endpoint, Endpoints))
+            for topology in merge_targets if topology["id"] == existing_hns_topology_id
+            for endpoint in to_fmc_json(topology["endpoints"]))
+        resumed_endpoints = len(journal.created_endpoints)
+        created_endpoints = set_endpoints_future(self.p2p_topologies, hub_device_id, self.fmc,
+                                                 hns_topology_id, p2p_topology_ids, hns_p2p_topologies or [], self.api_pool, merge_targets,
                                                  True if existing_hns_topology_id is None else False,
-                                                 submit_task)
-        submit_task(lambda: post_topology_settings(self.fmc, hns_topology_id, base_hns_topology, "ipsecSettings",
-                                                   IPSecSettings))
-        submit_task(lambda: post_topology_settings(self.fmc, hns_topology_id, base_hns_topology, "advancedSettings",
-                                                   AdvancedSettings))
+                                                 submit_task, journal, topology_type, endpoint_digests)
         run_callbacks()
+        journal.record("complete")
+        # The endpoint chunks are posted in parallel
+        endpoints_posted = len(created_endpoints) > resumed_endpoints
+        critical_path += endpoints_posted
 
-        self.hns_topology = hns_topology_api.get()
-        self.hns_topology["endpoints"] = created_endpoints
-        self.hns_topology["ikeSettings"] = created_ike_settings
+        # Assembled from the write responses instead of reading the topology back
+        merged_topology = {**hns_topology, "endpoints": created_endpoints, "ikeSettings": created_ike_settings,
+                           **created_settings,
+                           # Previously the settings were posted with the endpoints and the topology was read back
+                           "round_trips": {"critical_path": critical_path,
+                                           "saved": 1 + (settings_posted and not endpoints_posted)}}
+        if verify:
+            settings_digests = {key_name: get_verification_digest(base_hns_topology[key_name], policy_service)
+                                for key_name, policy_service in (("ikeSettings", IKESettings),
+                                                                 ("ipsecSettings", IPSecSettings),
+                                                                 ("advancedSettings", AdvancedSettings))}
+            merged_topology["verification"] = verify_topology(self.fmc, self.api_pool, hns_topology_id,
+                                                              endpoint_digests, settings_digests)
+        return merged_topology
 
-        self.orig_hns_p2p_topology_ids = p2p_topology_ids
+    def begin_merge_journal(self, topology_name: str, p2p_topology_ids: list[str], override: dict[str, Any],
+                            existing_hns_topology_id: Optional[str], hub_device_id: Optional[str],
+                            topology_type: str = "HUB_AND_SPOKE") -> MergeJournal:
+        """
+        Start the journal of a merge with the parameters needed to resume or roll it back later.
 
-        return self.hns_topology
+        :param topology_name: Name of topology if creating new one
+        :param p2p_topology_ids: The UUID list of point to point topologies being merged.
+        :param override: The overriding parameter values used for conflicts.
+        :param existing_hns_topology_id: Existing HNS topology UUID to merge into (None if new topology)
+        :param hub_device_id: The device of the hub of new topology
+        :param topology_type: Type of the topology ("HUB_AND_SPOKE" or "FULL_MESH")
+        :return: The journal
+        """
+        previous_settings = {}
+        for topology in self.get_merge_targets() if existing_hns_topology_id else []:
+            if topology["id"] == existing_hns_topology_id:
+                previous_settings = {key_name: to_fmc_json(topology[key_name]) for key_name in
+                                     ("ikeSettings", "ipsecSettings", "advancedSettings") if key_name in topology}
+        return MergeJournal.begin(host=self.fmc.host, domain_id=self.fmc.uuid, hub_device_id=hub_device_id,
+                                  hns_topology_id=existing_hns_topology_id, topology_name=topology_name,
+                                  p2p_topology_ids=p2p_topology_ids, override=override,
+                                  previous_settings=previous_settings, topology_type=topology_type)
+
+    def get_merge_journal(self, merge_id: str) -> MergeJournal:
+        """
+        Get the journal of a merge in the current domain.
 
-    def deploy(self):
+        :param merge_id: Merge ID
+        :return: The journal
         """
-        Deploy the changes in the FMC configuration after deleting existing P2P topologies.
+        journal = MergeJournal.load(merge_id)
+        if journal.parameters["host"] != self.fmc.host or journal.parameters["domain_id"] != self.fmc.uuid:
+            raise KeyError(merge_id)
+        return journal
+
+    def rollback_merge(self, merge_id: str) -> None:
+        """
+        Roll back the FMC changes of a failed merge.
+
+        :param merge_id: Merge ID
         """
-        delete_p2p_topology_ids(self.orig_hns_p2p_topology_ids, self.fmc, self.api_pool)
-        self.fmc.__exit__()
+        journal = self.get_merge_journal(merge_id)
+        rollback_merge(self.fmc, self.api_pool, journal)
+        journal.record("rolled_back")
 
-    def fetch_topologies(self) -> None:
+    def fetch_topologies(self, use_snapshot: bool = False) -> None:
         """
-        Fetch all topologies using parallel connections. It adds the futures to FMC session's pending future list so that
-            related requests can "wait" for completion. (using "/status" endpoint)
+        Fetch all topologies of the current domain using parallel connections. It adds a future to FMC session's pending
+            future list so that related requests can "wait" for completion. (using "/status" endpoint)
+
+        :param use_snapshot: Load the stored inventory snapshot (waiting for the fetch in other worker) if available
         """
-        s2s_topologies = []
+        domain_id = self.fmc.uuid
         stop_sleep = False
         def sleep_forever():
             while not stop_sleep:
                 sleep(1)
         unending_future = ThreadPoolExecutor().submit(sleep_forever)
         self.pending_futures["topologies"].append(unending_future)
-        s2s_topologies.extend(FTDS2SVPNs(fmc=self.fmc).get()['items'][:self.max_topologies])
+        try:
+            self.set_topologies(domain_id, self.fetch_inventory(self.fmc, self.api_pool, use_snapshot))
+        finally:
+            self.pending_futures["topologies"].remove(unending_future)
+            stop_sleep = True
+
+    def fetch_inventory(self, fmc: FMC, api_pool: ThreadPoolExecutor,
+                        use_snapshot: bool = False) -> dict[str, list[dict]]:
+        """
+        Fetch all topologies of the domain of the FMC object. The fetched inventory is stored as the snapshot of the
+            session for the other worker processes.
+
+        :param fmc: The FMC API object of the domain
+        :param api_pool: Thread pool used to execute FMC API calls
+        :param use_snapshot: Load the stored inventory snapshot (waiting for the fetch in other worker) if available
+        :return: Topology type and list of topologies map
+        """
+        task_key = self.get_task_key("topologies", fmc.uuid)
+        snapshot = None
+        if use_snapshot:
+            session_store.wait_for_task(task_key, timeout=INVENTORY_FETCH_TIMEOUT_SECONDS)
+            snapshot = session_store.load_inventory(self.token, fmc.uuid)
+        if snapshot is not None:
+            return get_topologies_from_snapshot(snapshot, {})
+        session_store.set_task_status(task_key, "pending")
+        # Only needed while compacting the fetched topologies
+        shared_values = {}
+        # Streamed into compact records, the full list response is never held in memory
+        s2s_topologies = [TopologyRecord(topology, shared_values) for topology in
+                          islice(iter_fmc_items(fmc, FTDS2SVPNs(fmc=fmc).URL), self.max_topologies)]
         future_to_endpoints_topology_map = {
-            self.api_pool.submit(partial(get_topology_endpoints, self.fmc, topology)): topology
+            api_pool.submit(partial(get_topology_endpoints, fmc, topology)): topology
             for topology in s2s_topologies
         }
-        self.pending_futures["topologies"].extend(future_to_endpoints_topology_map)
-        fetched_topologies = get_topologies_with_their_endpoints(future_to_endpoints_topology_map)
-        p2p_topologies = fetched_topologies["POINT_TO_POINT"]
-        self.p2p_topologies = defaultdict(list)
-        for topology in p2p_topologies:
+        fetched_topologies = get_topologies_with_their_endpoints(future_to_endpoints_topology_map, shared_values)
+        s2s_topologies.clear()
+        future_to_endpoints_topology_map.clear()
+        session_store.save_inventory(self.token, fmc.uuid, [to_fmc_json(topology) for topologies in
+                                                            fetched_topologies.values() for topology in topologies])
+        session_store.set_task_status(task_key, "done")
+        return fetched_topologies
+
+    def set_topologies(self, domain_id: str, fetched_topologies: dict[str, list[dict]]) -> None:
+        """
+        Index the fetched point-to-point topologies by their devices and keep the inventory of the domain. Switch to the
+            inventory if it is of the current domain.
+
+        :param domain_id: Domain UUID
+        :param fetched_topologies: Topology type and list of topologies map
+        """
+        p2p_topologies = defaultdict(list)
+        for topology in fetched_topologies["POINT_TO_POINT"]:
             for endpoint in topology["endpoints"]:
                 if not endpoint["extranet"]:
-                    self.p2p_topologies[endpoint["device"]["id"]].append(topology)
-            self.p2p_topologies.default_factory = None
-        self.hns_topologies = fetched_topologies["HUB_AND_SPOKE"] if "HUB_AND_SPOKE" in fetched_topologies else []
-        self.pending_futures["topologies"].remove(unending_future)
-        stop_sleep = True
+                    p2p_topologies[endpoint["device"]["id"]].append(topology)
+        p2p_topologies.default_factory = None
+        self.inventories[domain_id] = {
+            "p2p_topologies": p2p_topologies,
+            "hns_topologies": fetched_topologies["HUB_AND_SPOKE"] if "HUB_AND_SPOKE" in fetched_topologies else [],
+            "mesh_topologies": fetched_topologies["FULL_MESH"] if "FULL_MESH" in fetched_topologies else []}
+        if domain_id == self.fmc.uuid:
+            self.use_inventory(domain_id)
+
+    def use_inventory(self, domain_id: str) -> None:
+        """
+        :param domain_id: Domain UUID of the fetched inventory
+        """
+        inventory = self.inventories[domain_id]
+        self.p2p_topologies = inventory["p2p_topologies"]
+        self.hns_topologies = inventory["hns_topologies"]
+        self.mesh_topologies = inventory["mesh_topologies"]
 
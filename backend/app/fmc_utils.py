@@ -1,16 +1,41 @@
-from collections import defaultdict
+from collections import defaultdict, Counter
 from concurrent.futures import Future
 from concurrent.futures import as_completed
 from concurrent.futures._base import wait
 from concurrent.futures.thread import ThreadPoolExecutor
-from copy import deepcopy
+from copy import copy
+from datetime import datetime
 from functools import partial
-from typing import Any, Callable
-
-from fmcapi import FTDS2SVPNs, IKESettings, Endpoints, FMC
+from random import uniform
+from threading import Lock
+from time import sleep, perf_counter
+from typing import Any, Callable, Optional, Iterator
+
+from fmcapi import FTDS2SVPNs, IKESettings, Endpoints, FMC, IPSecSettings, AdvancedSettings, DeployableDevices, \
+    DeploymentRequests, TaskStatuses
+from fmcapi.fmc import Token
+import requests
+from requests.exceptions import RequestException
 from requests.models import PreparedRequest
 
-from app.utils import execute_parallel_tasks, patch_dict, get_post_data_chunks
+from app.inventory import TopologyRecord, to_fmc_json
+from app.merge_journal import MergeJournal
+from app.constants import FMC_PAGE_LIMIT, FMC_REQUESTS_PER_MINUTE, FMC_REQUEST_BURST, RATE_LIMIT_WAIT_SECONDS, \
+    FMC_GET_TIMEOUT_SECONDS, FMC_GET_RETRIES, FMC_GET_RETRY_BACKOFF_SECONDS, HEDGE_PERCENTILE, HEDGE_LATENCY_WINDOW, \
+    HEDGE_MIN_SAMPLES, HEDGE_POOL_SIZE, STREAM_CHUNK_SIZE, WORKER_PROCESSES, VERIFY_IGNORED_KEYS, COMPACT_DROPPED_KEYS, \
+    RECORD_SECRET_KEYS
+from app.utils import execute_parallel_tasks, patch_dict, RateLimiter, iter_post_data_chunks, LatencyTracker, \
+    iter_json_array_items, get_canonical_digest
+
+rate_limiters: dict[str, RateLimiter] = {}
+
+# FMC host and the latencies of its GET calls
+get_latencies: dict[str, LatencyTracker] = {}
+
+# FMC host and the thread pool of its GET attempts, shared by the sessions of the host
+get_attempt_pools: dict[str, ThreadPoolExecutor] = {}
+
+_rate_limiters_lock = Lock()
 
 
 def delete_p2p_topology_ids(p2p_topology_ids: list[str], fmc: FMC, api_pool: ThreadPoolExecutor) -> None:
@@ -30,6 +55,332 @@ def delete_p2p_topology_ids(p2p_topology_ids: list[str], fmc: FMC, api_pool: Thr
     execute_parallel_tasks(delete_tasks, api_pool)
 
 
+def get_fmc(host: str, username: str, password: Optional[str]) -> FMC:
+    """
+    Create the FMC API object used by the sessions (not logged in yet).
+
+    :param host: FMC host
+    :param username: FMC username
+    :param password: FMC password (None when restoring the tokens of a logged in session)
+    :return: The FMC API object
+    """
+    fmc = FMC(host=host, username=username, password=password, autodeploy=False,
+              file_logging="/tmp/log.txt", domain=None, debug=False, limit=FMC_PAGE_LIMIT, timeout=180,
+              check_server_version=False)
+    fmc.TOO_MANY_CONNECTIONS_TIMEOUT = RATE_LIMIT_WAIT_SECONDS
+    return fmc
+
+
+def get_fmc_state(fmc: FMC) -> dict[str, Any]:
+    """
+    Get the login state of the FMC API object (tokens, not the password) for restoring it in other worker process.
+
+    :param fmc: Logged in FMC API object
+    :return: JSON serializable login state
+    """
+    token = fmc.mytoken
+    return {"host": fmc.host, "username": fmc.username, "access_token": token.access_token,
+            "refresh_token": token.refresh_token, "token_creation_time": token.token_creation_time.timestamp(),
+            "token_refreshes": token.token_refreshes, "global_uuid": token.uuid, "all_domain": token.all_domain,
+            "server_version": fmc.serverVersion}
+
+
+class RestoredToken(Token):
+    """
+    Token of a logged in FMC API object restored from its login state instead of logging in again. Once the refreshes
+        are exhausted it logs in like `Token`, which fails without password.
+    """
+
+    def __init__(self, fmc: FMC, fmc_state: dict[str, Any]):
+        """
+        :param fmc: The FMC API object (not logged in)
+        :param fmc_state: Login state from `get_fmc_state`
+        """
+        self.fmc_state: Optional[dict[str, Any]] = fmc_state
+        super().__init__(host=fmc.host, username=fmc.username, password=None, verify_cert=fmc.VERIFY_CERT,
+                         timeout=fmc.timeout)
+
+    def generate_tokens(self) -> None:
+        """
+        Restore the tokens of the login state on the first call (from `Token.__init__`), afterwards refresh or create
+            them as usual.
+        """
+        if self.fmc_state is None:
+            super().generate_tokens()
+            return
+        fmc_state, self.fmc_state = self.fmc_state, None
+        self.access_token, self.refresh_token = fmc_state["access_token"], fmc_state["refresh_token"]
+        self.token_creation_time = datetime.fromtimestamp(fmc_state["token_creation_time"])
+        self.token_refreshes, self.uuid = fmc_state["token_refreshes"], fmc_state["global_uuid"]
+        self.all_domain = fmc_state["all_domain"]
+
+
+def restore_fmc(fmc_state: dict[str, Any]) -> FMC:
+    """
+    Recreate a logged in FMC API object from its login state without logging in again. The tokens are refreshed as
+        usual, but a new login is needed once the refreshes are exhausted.
+
+    :param fmc_state: Login state from `get_fmc_state`
+    :return: The FMC API object
+    """
+    fmc = get_fmc(fmc_state["host"], fmc_state["username"], None)
+    fmc.mytoken = RestoredToken(fmc, fmc_state)
+    fmc.uuid = fmc.mytoken.uuid
+    fmc.build_urls()
+    fmc.serverVersion = fmc_state["server_version"]
+    return fmc
+
+
+def limit_fmc_rate(fmc: FMC, budget: Optional[RateLimiter] = None) -> None:
+    """
+    Make the FMC API calls of the FMC object share the rate limit of its host (with every other session of the host)
+        instead of waiting only after FMC rejects the requests.
+
+    :param fmc: The FMC API object
+    :param budget: Own rate limit of low priority calls (e.g. prefetch). Such calls only take the host tokens left
+        spare by the other calls instead of queueing for them.
+    """
+    rate_limiter = get_rate_limiter(fmc.host)
+    send_to_api = fmc.send_to_api
+
+    def acquire_api_rate():
+        if budget is None:
+            rate_limiter.acquire()
+        else:
+            budget.acquire()
+            while not rate_limiter.acquire(blocking=False):
+                sleep(rate_limiter.interval)
+
+    def rate_limited_send_to_api(*args, **kwargs):
+        acquire_api_rate()
+        return send_to_api(*args, **kwargs)
+
+    # Also used by the calls bypassing `send_to_api` (see `iter_fmc_items`)
+    fmc.acquire_api_rate = acquire_api_rate
+    fmc.send_to_api = rate_limited_send_to_api
+
+
+def open_fmc_page(fmc: FMC, url: str) -> requests.Response:
+    """
+    Send the GET call of a FMC API list page and return the response to be streamed. The call is hedged like the GET
+        calls of `hedge_fmc_gets`: each attempt has its own deadline (`FMC_GET_TIMEOUT_SECONDS`) and once the response
+        takes longer than the observed `HEDGE_PERCENTILE` latency of the host, a duplicate request is sent if the host
+        rate limiter has a spare token. The first response is used and the other one closed.
+
+    :param fmc: The FMC API object (rate limited by `limit_fmc_rate`)
+    :param url: Page URL
+    :return: Streamed response (to be closed by the caller)
+    """
+    rate_limiter = get_rate_limiter(fmc.host)
+    latencies, attempt_pool = get_hedge_state(fmc.host)
+
+    def get_attempt(rate_limited: bool) -> requests.Response:
+        if rate_limited:
+            fmc.acquire_api_rate()
+        start = perf_counter()
+        response = requests.get(url, stream=True, headers={"Content-Type": "application/json",
+                                                           "X-auth-access-token": fmc.mytoken.get_token()},
+                                verify=fmc.VERIFY_CERT, timeout=FMC_GET_TIMEOUT_SECONDS)
+        latencies.add(perf_counter() - start)
+        return response
+
+    def close_response(future: Future) -> None:
+        if future.exception() is None:
+            future.result().close()
+
+    futures = [attempt_pool.submit(get_attempt, True)]
+    if not wait(futures, timeout=latencies.get_percentile(HEDGE_PERCENTILE)).done and \
+            rate_limiter.acquire(blocking=False):
+        futures.append(attempt_pool.submit(get_attempt, False))
+    error = None
+    for future in as_completed(futures):
+        try:
+            response = future.result()
+        except RequestException as e:
+            error = e
+            continue
+        for other_future in futures:
+            if other_future is not future:
+                other_future.add_done_callback(close_response)
+        return response
+    raise error
+
+
+def iter_fmc_items(fmc: FMC, url: str) -> Iterator[dict]:
+    """
+    Generator function of the items of a FMC API list (all pages). The responses are streamed and parsed one item at a
+        time instead of loading whole pages like `send_to_api`, each page is requested through `open_fmc_page`. A failed
+        or throttled (429) page is retried (with backoff) from the first item not yet yielded, at most `FMC_GET_RETRIES`
+        times per page. An expired access token (401) is renewed once per page as done by `send_to_api`.
+
+    :param fmc: The FMC API object (rate limited by `limit_fmc_rate`)
+    :param url: List URL without query string
+    """
+    offset = 0
+    attempt = 0
+    token_renewed = False
+    while True:
+        page_items = 0
+        try:
+            with open_fmc_page(fmc, f"{url}?expanded=true&limit={fmc.limit}&offset={offset}") as response:
+                if response.status_code == 401 and not token_renewed:
+                    token_renewed = True
+                    fmc.mytoken.access_token = None
+                    continue
+                if response.status_code == 429 and attempt < FMC_GET_RETRIES:
+                    attempt += 1
+                    sleep(fmc.TOO_MANY_CONNECTIONS_TIMEOUT)
+                    continue
+                response.raise_for_status()
+                response.encoding = response.encoding or "utf-8"
+                for item in iter_json_array_items(response.iter_content(STREAM_CHUNK_SIZE, decode_unicode=True),
+                                                  "items"):
+                    yield item
+                    page_items += 1
+                    offset += 1
+        except RequestException:
+            if attempt == FMC_GET_RETRIES:
+                raise
+            attempt += 1
+            sleep(uniform(0, FMC_GET_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+            continue
+        if page_items < fmc.limit:
+            return
+        # The retries are per page
+        attempt = 0
+        token_renewed = False
+
+
+def get_rate_limiter(host: str) -> RateLimiter:
+    """
+    :param host: FMC host
+    :return: Rate limiter shared by the FMC API calls of the host in this process. The worker processes split
+        `FMC_REQUESTS_PER_MINUTE` (and the burst) so that together they stay within the limit of the host.
+    """
+    with _rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter(FMC_REQUESTS_PER_MINUTE / WORKER_PROCESSES,
+                                              max(1, FMC_REQUEST_BURST // WORKER_PROCESSES))
+        return rate_limiters[host]
+
+
+def get_hedge_state(host: str) -> tuple[LatencyTracker, ThreadPoolExecutor]:
+    """
+    :param host: FMC host
+    :return: Latencies of the GET calls of the host and the thread pool of the GET attempts, shared by the sessions of
+        the host in this process
+    """
+    with _rate_limiters_lock:
+        if host not in get_latencies:
+            get_latencies[host] = LatencyTracker(HEDGE_LATENCY_WINDOW, HEDGE_MIN_SAMPLES)
+            get_attempt_pools[host] = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE)
+        return get_latencies[host], get_attempt_pools[host]
+
+
+def hedge_fmc_gets(fmc: FMC) -> None:
+    """
+    Mitigate the slow GET calls of the FMC object (which are idempotent):
+        - each attempt has its own deadline (`FMC_GET_TIMEOUT_SECONDS`) and is retried with jittered backoff,
+        - once an attempt takes longer than the observed `HEDGE_PERCENTILE` latency of the host, a duplicate request is
+          sent if the host rate limiter has a spare token and the first response is used.
+        The other calls keep `fmc.send_to_api`. Call it after `limit_fmc_rate`. The paged reads of `iter_fmc_items` are
+        hedged the same way (see `open_fmc_page`).
+
+    :param fmc: The FMC API object
+    """
+    rate_limiter = get_rate_limiter(fmc.host)
+    latencies, attempt_pool = get_hedge_state(fmc.host)
+    send_to_api = fmc.send_to_api
+
+    def get_attempt(url: str, rate_limited: bool) -> Any:
+        # Own copy so that the deadline and the paging state do not affect the concurrent calls
+        attempt_fmc = copy(fmc)
+        attempt_fmc.timeout = FMC_GET_TIMEOUT_SECONDS
+        attempt_fmc.send_to_api = partial(type(fmc).send_to_api, attempt_fmc)
+        limit_fmc_rate(attempt_fmc)
+        start = perf_counter()
+        if rate_limited:
+            response = attempt_fmc.send_to_api(method="get", url=url)
+        else:
+            response = type(fmc).send_to_api(attempt_fmc, method="get", url=url)
+        latencies.add(perf_counter() - start)
+        return response
+
+    def hedged_send_to_api(method="", url="", *args, **kwargs):
+        if method != "get" or args or any(kwargs.values()):
+            return send_to_api(method, url, *args, **kwargs)
+        error = None
+        for attempt in range(FMC_GET_RETRIES + 1):
+            if attempt:
+                sleep(uniform(0, FMC_GET_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+            futures = [attempt_pool.submit(get_attempt, url, True)]
+            if not wait(futures, timeout=latencies.get_percentile(HEDGE_PERCENTILE)).done and \
+                    rate_limiter.acquire(blocking=False):
+                futures.append(attempt_pool.submit(get_attempt, url, False))
+            for future in as_completed(futures):
+                try:
+                    return future.result()
+                except RequestException as e:
+                    error = e
+        raise error
+
+    fmc.send_to_api = hedged_send_to_api
+
+
+def get_domain_fmc(fmc: FMC, domain_id: str, budget: Optional[RateLimiter] = None) -> FMC:
+    """
+    Copy of the logged in FMC API object working on another domain, so that several domains can be fetched in parallel.
+
+    :param fmc: The FMC API object
+    :param domain_id: Domain UUID
+    :param budget: Own rate limit of the low priority calls (see `limit_fmc_rate`)
+    :return: The FMC API object of the domain (sharing the tokens)
+    """
+    domain_fmc = copy(fmc)
+    domain_fmc.uuid = domain_id
+    domain_fmc.build_urls()
+    # Drop the rate limited `send_to_api` of the copied instance
+    domain_fmc.send_to_api = partial(type(fmc).send_to_api, domain_fmc)
+    limit_fmc_rate(domain_fmc, budget)
+    return domain_fmc
+
+
+def start_deployment(fmc: FMC, device_ids: set[str]) -> Optional[str]:
+    """
+    Request the deployment of the pending changes of the devices.
+
+    :param fmc: The FMC API object
+    :param device_ids: Devices to deploy (the ones without pending changes are skipped)
+    :return: Deployment task ID (None if there is nothing to deploy)
+    """
+    deployable_devices = [device for device in DeployableDevices(fmc=fmc).get() or []
+                          if device["device"]["id"] in device_ids]
+    if not deployable_devices:
+        return None
+    deployment_api = DeploymentRequests(fmc=fmc)
+    # The smallest version among the devices, as done by fmcapi
+    json_data = {"type": "DeploymentRequest", "forceDeploy": deployment_api.forceDeploy,
+                 "ignoreWarning": deployment_api.ignoreWarning,
+                 "version": min((device["version"] for device in deployable_devices), key=int),
+                 "deviceList": [device["device"]["id"] for device in deployable_devices]}
+    response = fmc.send_to_api(method="post", url=deployment_api.URL, json_data=json_data)
+    if response is None:
+        raise RuntimeError("Deployment request failed")
+    return response["metadata"]["task"]["id"]
+
+
+def get_deployment_status(fmc: FMC, task_id: str) -> Optional[str]:
+    """
+    Get the status of a deployment task.
+
+    :param fmc: The FMC API object
+    :param task_id: Deployment task ID
+    :return: Task status (e.g. "Deploying", "Deployed", "Failed")
+    """
+    task = TaskStatuses(fmc=fmc, id=task_id).get()
+    return task.get("status") if task else None
+
+
 def get_topologies_from_ids(p2p_topologies: dict[str, list[dict]], device_id: str, topology_ids: list[str],
                             hns_p2p_topologies: list[dict]) -> list[
     dict]:
@@ -64,6 +415,8 @@ def fetch_topology_settings(fmc: FMC, topology: dict, key_name: str, policy_serv
         return topology[key_name]
     settings = policy_service(fmc=fmc)
     settings.vpn_policy(vpn_id=topology["id"])
+    if key_name == "endpoints":
+        return list(iter_fmc_items(fmc, settings.URL))
     response = settings.get()["items"]
     return response
 
@@ -106,47 +459,52 @@ def get_topology_post_request_params(topology_config):
     return topology_params
 
 
-def get_base_hns_topology(p2p_topologies: dict[str, list[dict]], hub_device_id: str, override: dict,
-                          topology_name: str, hns_topology_id: str, hns_topologies: list[dict]) -> dict:
+def get_base_hns_topology(p2p_topologies: dict[str, list[dict]], hub_device_id: str, p2p_topology_ids: list[str],
+                          override: dict, topology_name: str, hns_topology_id: str, hns_topologies: list[dict],
+                          topology_type: str = "HUB_AND_SPOKE") -> dict:
     """
     Get topology configuration with default settings while creating new topology or get the existing topology while merging
         into existing one. If hns_topology_id is supplied existing topology is used.
 
     :param p2p_topologies: The device id and p2p topology list map
     :param hub_device_id: The device of the hub of new topology
+    :param p2p_topology_ids: The merged p2p topology IDs, the settings of the new topology are based on the first one
+        of the hub
     :param override: The _subtree_ dict used to override the paratemeters of the base topology
     :param topology_name: Name of topology if creating new topology
     :param hns_topology_id: Hub and spoke topology id (if merging into existing one)
     :param hns_topologies: List of hub and spoke topologies (needed if merging into existing one)
+    :param topology_type: Type of new topology ("HUB_AND_SPOKE" or "FULL_MESH")
     :return: Base topology used for merging the p2p topologies
     """
     if hns_topology_id is None:
-        base_topology: dict = deepcopy(p2p_topologies[hub_device_id][0])
+        merged_topology_ids = set(p2p_topology_ids)
+        base_topology: dict = to_fmc_json(next(topology for topology in p2p_topologies[hub_device_id]
+                                               if topology["id"] in merged_topology_ids))
         base_topology["name"] = topology_name
         base_topology.pop("id")
-        base_topology["topologyType"] = "HUB_AND_SPOKE"
+        base_topology["topologyType"] = topology_type
     else:
         for topology in hns_topologies:
             if topology["id"] == hns_topology_id:
-                base_topology: dict = deepcopy(topology)
+                base_topology: dict = to_fmc_json(topology)
                 break
     patch_dict(base_topology, override)
     return base_topology
 
 
-def get_topology_api(topology_config: dict, fmc: FMC) -> FTDS2SVPNs:
+def create_topology(topology_config: dict, fmc: FMC) -> dict:
     """
-    Get API object of the topology from the topology object and create it on FMC
+    Create the topology on FMC from the topology object (updated instead if it has an ID)
 
 
     :param topology_config:
     :param fmc: The FMC API object
-    :return: The topology object
+    :return: The created topology response
     """
     topology_params = get_topology_post_request_params(topology_config)
     topology_api = FTDS2SVPNs(fmc=fmc, **topology_params)
-    topology_api.post()
-    return topology_api
+    return topology_api.post()
 
 
 def get_ike_settings(fmc: FMC, hns_topology_id: str, topology_config: dict) -> dict:
@@ -167,7 +525,7 @@ def get_ike_settings(fmc: FMC, hns_topology_id: str, topology_config: dict) -> d
 
 
 def post_topology_settings(fmc: FMC, topology_id: str, topology_config: dict, key_name: str,
-                           policy_service) -> None:
+                           policy_service) -> dict:
     """
     Create topology settings (IKESettings, AdvancedSettings)
 
@@ -177,10 +535,11 @@ def post_topology_settings(fmc: FMC, topology_id: str, topology_config: dict, ke
     :param topology_config: The topology object
     :param key_name: The name key in the topology object ("ikeSettings", "advancedSettings")
     :param policy_service: Policy service class (IKESettings, AdvancedSettings)
+    :return: Created settings
     """
     settings_api = policy_service(fmc=fmc, **topology_config[key_name])
     settings_api.vpn_policy(vpn_id=topology_id)
-    settings_api.post()
+    return settings_api.post()
 
 
 def get_hns_endpoint_data_from_p2p(p2p_topologies: dict[str, list[dict]], hub_device_id: str, fmc: FMC,
@@ -215,7 +574,7 @@ def get_hns_endpoint_data_from_p2p(p2p_topologies: dict[str, list[dict]], hub_de
     for topology in topology_list:
         if topology["id"] in p2p_topology_ids_set:
             for p2p_endpoint in topology["endpoints"]:
-                hns_endpoint = deepcopy(p2p_endpoint)
+                hns_endpoint = to_fmc_json(p2p_endpoint)
                 if hns_topology_id is not None and not hns_endpoint["extranet"] and hns_endpoint["device"]["id"] in existing_hns_hub_device_ids:
                     continue
                 if not hns_endpoint["extranet"] and hns_endpoint["device"]["id"] == hub_device_id:
@@ -235,6 +594,47 @@ def get_hns_endpoint_data_from_p2p(p2p_topologies: dict[str, list[dict]], hub_de
     return endpoints_data
 
 
+def get_mesh_endpoint_data_from_p2p(p2p_topologies: dict[str, list[dict]], device_id: Optional[str], fmc: FMC,
+                                    mesh_topology_id: str, p2p_topology_ids: list[str],
+                                    hns_p2p_topologies: list[dict], existing_topology: Optional[dict]) -> Iterator[dict]:
+    """
+    Generator of the FMC API request data for creating the endpoints of full mesh topology from the p2p topologies. Every
+        distinct endpoint (by device and interface or extranet IP) becomes a peer. The data is generated lazily and the
+        duplicates are detected through a set, so thousands of peers cost linear time.
+
+    :param p2p_topologies: The device id and p2p topology list map
+    :param device_id: The device whose p2p topologies are merged into new topology
+    :param fmc: The FMC API object
+    :param mesh_topology_id: The ID of full mesh topology
+    :param p2p_topology_ids: The P2P topology IDs being merged
+    :param hns_p2p_topologies: List of p2p topologies for merging into existing topology
+    :param existing_topology: Existing full mesh topology merged into (None if new topology)
+    :return: Request objects for creating endpoints
+    """
+    p2p_topology_ids_set = set(p2p_topology_ids)
+    if existing_topology is None:
+        topology_list = p2p_topologies[device_id]
+        endpoint_keys = set()
+    else:
+        topology_list = hns_p2p_topologies
+        endpoint_keys = {get_endpoint_key(endpoint) for endpoint in existing_topology["endpoints"]}
+    for topology in topology_list:
+        if topology["id"] not in p2p_topology_ids_set:
+            continue
+        for p2p_endpoint in topology["endpoints"]:
+            endpoint_key = get_endpoint_key(p2p_endpoint)
+            if endpoint_key in endpoint_keys:
+                continue
+            endpoint_keys.add(endpoint_key)
+            mesh_endpoint = to_fmc_json(p2p_endpoint)
+            mesh_endpoint.pop("id")
+            mesh_endpoint["peerType"] = "PEER"
+            mesh_endpoint["description"] = "desc"
+            endpoints_api = Endpoints(fmc=fmc, **mesh_endpoint)
+            endpoints_api.vpn_policy(vpn_id=mesh_topology_id)
+            yield endpoints_api.format_data()
+
+
 def get_create_bulk_endpoints_url(fmc: FMC, hns_topology_id: str) -> str:
     """
     Construct FMC API url for creating endpoints in bulk.
@@ -252,13 +652,40 @@ def get_create_bulk_endpoints_url(fmc: FMC, hns_topology_id: str) -> str:
     return endpoints_api_bulk_url
 
 
+def get_endpoint_key(endpoint: dict) -> str:
+    """
+    Identity of an endpoint within a topology: the extranet IP or the device and interface.
+
+    :param endpoint: Endpoint object
+    :return: Endpoint key
+    """
+    if endpoint.get("extranet"):
+        return f"extranet:{endpoint['extranetInfo'].get('ipAddress') or endpoint['extranetInfo']['name']}"
+    return f"device:{endpoint['device']['id']}:{endpoint['interface']['id'] if 'interface' in endpoint else ''}"
+
+
+def get_verification_digest(item: dict, policy_service) -> str:
+    """
+    Canonical digest of the configured values of an object, the same for the request data and the object read back from
+        FMC (IDs, versions, links and secrets are not compared).
+
+    :param item: Request data or FMC object
+    :param policy_service: API class of the object (Endpoints, IKESettings...) whose fields are compared
+    :return: Digest
+    """
+    return get_canonical_digest(item, [key for key in policy_service.VALID_JSON_DATA if key not in VERIFY_IGNORED_KEYS],
+                                COMPACT_DROPPED_KEYS | RECORD_SECRET_KEYS)
+
+
 def set_endpoints_future(p2p_topologies: dict[str, list[dict]], hub_device_id: str, fmc: FMC, hns_topology_id: str,
                          p2p_topology_ids: list[str], hns_p2p_topologies: list[dict], api_pool, hns_topologies,
                          new_topology: bool,
-                         submit_future: Callable) -> list[dict]:
+                         submit_future: Callable, journal: MergeJournal,
+                         topology_type: str = "HUB_AND_SPOKE", endpoint_digests: Optional[Counter] = None) -> list[dict]:
     """
     Creates the endpoints in parallel (and in bulk per connection). If HNS topology ID is specified (not None) it is assumed
-        existing topology is used for merging.
+        existing topology is used for merging. Endpoints already created according to the journal are skipped and each
+        created chunk is recorded in the journal.
 
 
 
@@ -272,21 +699,119 @@ def set_endpoints_future(p2p_topologies: dict[str, list[dict]], hub_device_id: s
     :param hns_topologies: List of HNS topologies
     :param submit_future: Runs a task in background and executes the supplied callback on completion
     :param new_topology: Is new topology created?
+    :param journal: Journal of the merge
+    :param topology_type: Type of the topology ("HUB_AND_SPOKE" or "FULL_MESH")
+    :param endpoint_digests: Counter of the endpoint key and digest of each intended endpoint (filled while the request
+        data is built, for `verify_topology`)
     :return: List of endpoint responses on creation
     """
-    created_endpoints = []
-    endpoints_data = get_hns_endpoint_data_from_p2p(p2p_topologies, hub_device_id, fmc, hns_topology_id,
-                                                    p2p_topology_ids, hns_p2p_topologies, hns_topologies, new_topology)
+    created_endpoints = list(journal.created_endpoints)
+    if topology_type == "FULL_MESH":
+        existing_topology = None if new_topology else next(
+            topology for topology in hns_topologies if topology["id"] == hns_topology_id)
+        endpoints_data = get_mesh_endpoint_data_from_p2p(p2p_topologies, hub_device_id, fmc, hns_topology_id,
+                                                         p2p_topology_ids, hns_p2p_topologies, existing_topology)
+    else:
+        endpoints_data = get_hns_endpoint_data_from_p2p(p2p_topologies, hub_device_id, fmc, hns_topology_id,
+                                                        p2p_topology_ids, hns_p2p_topologies, hns_topologies,
+                                                        new_topology)
+    if endpoint_digests is not None:
+        def add_digest(endpoint: dict) -> dict:
+            endpoint_digests[get_endpoint_key(endpoint), get_verification_digest(endpoint, Endpoints)] += 1
+            return endpoint
+
+        # Including the endpoints created before resuming
+        endpoints_data = map(add_digest, endpoints_data)
+    endpoints_data = (endpoint for endpoint in endpoints_data
+                      if get_endpoint_key(endpoint) not in journal.created_endpoint_keys)
     bulk_endpoints_api_url = get_create_bulk_endpoints_url(fmc, hns_topology_id)
-    for chunk in get_post_data_chunks(endpoints_data):
-        def set_endpoints(endpoints_response):
+    # Chunks are posted while the following ones are being built
+    for chunk in iter_post_data_chunks(endpoints_data):
+        def set_endpoints(endpoints_response, endpoint_keys=[get_endpoint_key(endpoint) for endpoint in chunk]):
+            journal.record("endpoints", endpoint_keys=endpoint_keys, items=endpoints_response["items"])
             created_endpoints.extend(endpoints_response["items"])
 
-        submit_future(lambda: fmc.send_to_api(method="post", url=bulk_endpoints_api_url, json_data=chunk),
+        submit_future(fmc.send_to_api, method="post", url=bulk_endpoints_api_url, json_data=chunk,
                       callback=set_endpoints)
     return created_endpoints
 
 
+def rollback_merge(fmc: FMC, api_pool: ThreadPoolExecutor, journal: MergeJournal) -> None:
+    """
+    Undo the FMC changes of a (failed) merge in parallel. A newly created topology is deleted as a whole. For an
+        existing topology the created endpoints are deleted and the previous settings restored.
+
+    :param fmc: The FMC API object
+    :param api_pool: Thread pool used to execute FMC API calls
+    :param journal: Journal of the merge
+    """
+    topology_step = journal.get("topology")
+    if topology_step is None:
+        return
+    topology_id = topology_step["topology_id"]
+    if topology_step["created"]:
+        delete_p2p_topology_ids([topology_id], fmc, api_pool)
+        return
+    tasks = []
+    for endpoint in journal.created_endpoints:
+        endpoints_api = Endpoints(fmc=fmc)
+        endpoints_api.vpn_policy(vpn_id=topology_id)
+        endpoints_api.id = endpoint["id"]
+        tasks.append(endpoints_api.delete)
+    previous_settings = journal.parameters["previous_settings"]
+    for key_name, policy_service in (("ikeSettings", IKESettings), ("ipsecSettings", IPSecSettings),
+                                     ("advancedSettings", AdvancedSettings)):
+        if journal.is_done(key_name) and previous_settings.get(key_name):
+            settings_api = policy_service(fmc=fmc, **previous_settings[key_name])
+            settings_api.vpn_policy(vpn_id=topology_id)
+            tasks.append(settings_api.put)
+    execute_parallel_tasks(tasks, api_pool)
+
+
+def verify_topology(fmc: FMC, api_pool: ThreadPoolExecutor, topology_id: str, endpoint_digests: Counter,
+                    settings_digests: dict[str, str]) -> dict[str, Any]:
+    """
+    Verify that FMC holds the intended endpoints and settings of a merged topology by comparing their digests with the
+        digests of a single paged read-back of the endpoints (and of the settings, read meanwhile). Linear in the
+        number of endpoints, only the mismatched objects are kept.
+
+    :param fmc: The FMC API object
+    :param api_pool: Thread pool used to execute FMC API calls
+    :param topology_id: The topology ID
+    :param endpoint_digests: Counter of the endpoint key and digest of each intended endpoint
+    :param settings_digests: The settings key name ("ikeSettings", "ipsecSettings", "advancedSettings") and digest of
+        the intended settings map
+    :return: "verified", the expected and read endpoint counts and the mismatched objects with their "problem"
+        ("missing", "unexpected" or "changed")
+    """
+    policy_services = {"ikeSettings": IKESettings, "ipsecSettings": IPSecSettings, "advancedSettings": AdvancedSettings}
+    settings_futures = {key_name: api_pool.submit(fetch_topology_settings, fmc, {"id": topology_id, key_name: {
+        "links": {}}}, key_name, policy_services[key_name]) for key_name in settings_digests}
+    endpoints_api = Endpoints(fmc=fmc)
+    endpoints_api.vpn_policy(vpn_id=topology_id)
+    remaining_digests = Counter(endpoint_digests)
+    unmatched_endpoints, read_endpoints = [], 0
+    for endpoint in iter_fmc_items(fmc, endpoints_api.URL):
+        read_endpoints += 1
+        key_digest = get_endpoint_key(endpoint), get_verification_digest(endpoint, Endpoints)
+        if remaining_digests[key_digest] > 0:
+            remaining_digests[key_digest] -= 1
+        else:
+            unmatched_endpoints.append(endpoint)
+    missing_keys = {key for (key, _), count in remaining_digests.items() if count > 0}
+    unmatched_keys = {get_endpoint_key(endpoint) for endpoint in unmatched_endpoints}
+    mismatched = [{"key": get_endpoint_key(endpoint), "endpoint": endpoint,
+                   "problem": "changed" if get_endpoint_key(endpoint) in missing_keys else "unexpected"}
+                  for endpoint in unmatched_endpoints]
+    mismatched.extend({"key": key, "problem": "missing"} for key in missing_keys - unmatched_keys)
+    for key_name, future in settings_futures.items():
+        settings = future.result()[0]
+        if get_verification_digest(settings, policy_services[key_name]) != settings_digests[key_name]:
+            mismatched.append({"key": key_name, "settings": settings, "problem": "changed"})
+    return {"verified": not mismatched, "expected_endpoints": sum(endpoint_digests.values()),
+            "read_endpoints": read_endpoints, "mismatched": mismatched}
+
+
 def fetch_to_device_p2p_topologies(futures: dict[str, list[Future]], p2p_topologies: dict[str, list[dict]],
                                    hub_device_id: str,
                                    api_pool: ThreadPoolExecutor, fmc: FMC) -> None:
@@ -294,45 +819,62 @@ def fetch_to_device_p2p_topologies(futures: dict[str, list[Future]], p2p_topolog
     Fetches p2p topologies having specific device as an endpoint _fully_. Currently only IKE settings need to
         be fetched. The endpoints are fetched during initial fetch of topologies.
 
-    :param futures: The futures object used to track the completion of tasks. (pending_futures in FMCSession)
+    :param futures: The futures object used to track the completion of tasks. (pending_futures in MergeWorkspace)
     :param p2p_topologies: The device id and p2p topology list map
     :param hub_device_id: The device of the hub of new topology
     :param api_pool: Thread pool used to execute FMC API calls
     :param fmc: The FMC API object
     :return:
     """
-    futures["device_p2p_topologies"] = futures["topologies"]
+    # A copy, the replaced futures must not be the ones of the (possibly shared) "topologies" task
+    futures["device_p2p_topologies"] = list(futures["topologies"])
     wait(futures["topologies"])
     future_to_ike_settings = {api_pool.submit(partial(get_topology_ike_settings, fmc, topology)): topology for topology
                               in p2p_topologies[hub_device_id]}
     futures["device_p2p_topologies"][:] = future_to_ike_settings
-    for i, future in enumerate(as_completed(future_to_ike_settings)):
-        print("Completed device p2p", i)
+    for future in as_completed(future_to_ike_settings):
         topology = future_to_ike_settings[future]
         topology["ikeSettings"] = future.result()
 
 
-def get_topologies_with_their_endpoints(future_to_endpoints_topology_map: dict[Future, dict]) -> dict[
-    str, list]:
+def get_topologies_with_their_endpoints(future_to_endpoints_topology_map: dict[Future, dict],
+                                        shared_values: dict) -> dict[str, list[TopologyRecord]]:
     """
     Gives the list of topologies with their endpoints set. The links are replaced by actual endpoint list in
-        the topology object.
+        the topology object. The topologies are converted to compact records.
 
 
     :param future_to_endpoints_topology_map: Map of endpoints' future and the corresponding topology
+    :param shared_values: Values shared among the compact records of the inventory
     :return: List of topology objects
     """
     fetched_topologies = defaultdict(list)
-    for i, future in enumerate(as_completed(future_to_endpoints_topology_map)):
-        print("Completed ", i)
+    for future in as_completed(future_to_endpoints_topology_map):
         topology = future_to_endpoints_topology_map[future]
         topology["endpoints"] = future.result()
+        topology = TopologyRecord(topology, shared_values)
         topology_type = topology["topologyType"]
         fetched_topologies[topology_type].append(topology)
     fetched_topologies.default_factory = None
     return fetched_topologies
 
 
+def get_topologies_from_snapshot(topologies: list[dict], shared_values: dict) -> dict[str, list[TopologyRecord]]:
+    """
+    Gives the topologies of a stored inventory snapshot grouped by type, the same way as
+        `get_topologies_with_their_endpoints`.
+
+    :param topologies: Stored topologies with their endpoints
+    :param shared_values: Values shared among the compact records of the inventory
+    :return: Topology type and list of topology objects map
+    """
+    fetched_topologies = defaultdict(list)
+    for topology in topologies:
+        fetched_topologies[topology["topologyType"]].append(TopologyRecord(topology, shared_values))
+    fetched_topologies.default_factory = None
+    return fetched_topologies
+
+
 def fetch_to_hns_p2p_topologies(futures: dict[str, list[Future]], p2p_topologies: dict[str, list[dict]],
                                 hns_topology: dict,
                                 api_pool: ThreadPoolExecutor, fmc: FMC, hns_p2p_topologies: list[dict]) -> None:
@@ -341,7 +883,7 @@ def fetch_to_hns_p2p_topologies(futures: dict[str, list[Future]], p2p_topologies
         Currently only IKE settings need to be fetched. The endpoints are fetched during initial fetch of topologies.
 
 
-    :param futures: The futures object used to track the completion of tasks. (pending_futures in FMCSession)
+    :param futures: The futures object used to track the completion of tasks. (pending_futures in MergeWorkspace)
     :param p2p_topologies: The device id and p2p topology list map
     :param hns_topology: The existing hns_topology to which P2P are being merged
     :param api_pool: Thread pool used to execute FMC API calls
@@ -349,7 +891,7 @@ def fetch_to_hns_p2p_topologies(futures: dict[str, list[Future]], p2p_topologies
     :param hns_p2p_topologies:
     :return:
     """
-    futures["hns_p2p_topologies"] = futures["topologies"]
+    futures["hns_p2p_topologies"] = list(futures["topologies"])
     wait(futures["topologies"])
     for endpoint in hns_topology["endpoints"]:
         if not endpoint["extranet"] and endpoint["device"]["id"] in p2p_topologies:
@@ -357,7 +899,6 @@ def fetch_to_hns_p2p_topologies(futures: dict[str, list[Future]], p2p_topologies
     future_to_ike_settings = {api_pool.submit(partial(get_topology_ike_settings, fmc, topology)): topology for topology
                               in hns_p2p_topologies + [hns_topology]}
     futures["hns_p2p_topologies"][:] = future_to_ike_settings
-    for i, future in enumerate(as_completed(future_to_ike_settings)):
-        print("Completed hns p2p", i)
+    for future in as_completed(future_to_ike_settings):
         topology = future_to_ike_settings[future]
         topology["ikeSettings"] = future.result()
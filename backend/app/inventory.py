@@ -0,0 +1,215 @@
+from collections.abc import Mapping, MutableMapping
+from sys import intern
+from typing import Any, Iterator
+from weakref import WeakValueDictionary
+
+from app.constants import COMPACT_DROPPED_KEYS
+
+_MISSING = object()
+
+_SCALAR_TYPES = {str, int, float, bool, type(None)}
+
+_refs: "WeakValueDictionary[tuple, Ref]" = WeakValueDictionary()
+
+
+class Ref(Mapping):
+    """
+    Reference to an FMC object (device, interface, network, policy) i.e. `{"id": ..., "name": ..., "type": ...}`.
+        References are interned process-wide so every endpoint of every session points to the same instance.
+    """
+    __slots__ = ("id", "name", "type", "__weakref__")
+    KEYS = ("id", "name", "type")
+
+    def __new__(cls, id: str, name: str = None, type: str = None):
+        key = (id, name, type)
+        ref = _refs.get(key)
+        if ref is None:
+            ref = super().__new__(cls)
+            ref.id, ref.name, ref.type = (intern(value) if isinstance(value, str) else value for value in key)
+            _refs[key] = ref
+        return ref
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.KEYS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in self.KEYS if getattr(self, key) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __reduce__(self):
+        return Ref, (self.id, self.name, self.type)
+
+    def __deepcopy__(self, memo) -> "Ref":
+        return self
+
+    def __repr__(self) -> str:
+        return f"Ref({self.id!r}, {self.name!r}, {self.type!r})"
+
+
+class CompactRecord(MutableMapping):
+    """
+    Dict-like record storing the frequently read keys of an FMC object in slots. Remaining keys live in the (usually
+        shared) `extra` dict which is copied on write.
+    """
+    __slots__ = ("extra",)
+    FIELDS: dict[str, str] = {}
+
+    def __init__(self, json_object: Mapping, shared_values: dict):
+        extra = {}
+        for key, value in json_object.items():
+            if key in COMPACT_DROPPED_KEYS:
+                continue
+            value = self.get_compact_field(key, value, shared_values)
+            if key in self.FIELDS:
+                setattr(self, self.FIELDS[key], value)
+            else:
+                extra[intern(key)] = value
+        for slot in self.FIELDS.values():
+            if not hasattr(self, slot):
+                setattr(self, slot, _MISSING)
+        self.extra = get_shared_value(extra, shared_values)
+
+    def get_compact_field(self, key: str, value: Any, shared_values: dict) -> Any:
+        """
+        Compact the value of a key.
+
+        :param key: Key name
+        :param value: JSON value
+        :param shared_values: Content hash and shared value map
+        :return: Compacted value
+        """
+        return get_compact_value(value, shared_values)
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, self.FIELDS[key]) if key in self.FIELDS else self.extra[key]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self.FIELDS:
+            setattr(self, self.FIELDS[key], value)
+        else:
+            self.extra = {**self.extra, key: value}
+
+    def __delitem__(self, key: str) -> None:
+        if key in self.FIELDS:
+            if getattr(self, self.FIELDS[key]) is _MISSING:
+                raise KeyError(key)
+            setattr(self, self.FIELDS[key], _MISSING)
+        else:
+            extra = dict(self.extra)
+            del extra[key]
+            self.extra = extra
+
+    def __iter__(self) -> Iterator[str]:
+        for key, slot in self.FIELDS.items():
+            if getattr(self, slot) is not _MISSING:
+                yield key
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({to_fmc_json(self)!r})"
+
+
+class EndpointRecord(CompactRecord):
+    """
+    Compact VPN topology endpoint.
+    """
+    __slots__ = ("id", "name", "peer_type", "extranet", "device", "interface", "protected_networks", "extranet_info")
+    FIELDS = {"id": "id", "name": "name", "peerType": "peer_type", "extranet": "extranet", "device": "device",
+              "interface": "interface", "protectedNetworks": "protected_networks", "extranetInfo": "extranet_info"}
+
+
+class TopologyRecord(CompactRecord):
+    """
+    Compact VPN topology (`ftds2svpns` object) with its endpoints.
+    """
+    __slots__ = ("id", "name", "topology_type", "ike_settings", "ipsec_settings", "advanced_settings", "endpoints")
+    FIELDS = {"id": "id", "name": "name", "topologyType": "topology_type", "ikeSettings": "ike_settings",
+              "ipsecSettings": "ipsec_settings", "advancedSettings": "advanced_settings", "endpoints": "endpoints"}
+
+    def get_compact_field(self, key: str, value: Any, shared_values: dict) -> Any:
+        if key == "endpoints" and isinstance(value, list):
+            return [endpoint if isinstance(endpoint, EndpointRecord) else EndpointRecord(endpoint, shared_values)
+                    for endpoint in value]
+        return super().get_compact_field(key, value, shared_values)
+
+
+def get_content_hash(value: Any) -> int:
+    """
+    Hash of a compacted dict or list by its content. The nested dicts and lists are already shared, so they are
+        identified by their identity and the hash costs only a single level.
+
+    :param value: Compacted dict or list
+    :return: Content hash
+    """
+    items = value.items() if type(value) is dict else enumerate(value)
+    return hash((type(value), tuple((key, (type(item), item) if type(item) in _SCALAR_TYPES else id(item))
+                                    for key, item in items)))
+
+
+def get_compact_value(value: Any, shared_values: dict) -> Any:
+    """
+    Compact a JSON value.
+        - Drop the `links` and `metadata` keys (except for link-only stubs of not yet fetched sub-resources)
+        - Replace object references by interned `Ref`
+        - Intern the strings
+        - Share the identical dicts and lists through `shared_values`. Shared values must not be modified in place.
+
+    :param value: JSON value from FMC API
+    :param shared_values: Content hash and shared value map (per inventory)
+    :return: Compacted value
+    """
+    value_type = type(value)
+    if value_type is str:
+        return intern(value)
+    if value_type is dict:
+        if "links" in value and value.keys() <= {"id", "name", "type", "links"}:
+            return value
+        compacted = {intern(key): get_compact_value(item, shared_values) for key, item in value.items()
+                     if key not in COMPACT_DROPPED_KEYS}
+        if "id" in compacted and compacted.keys() <= set(Ref.KEYS):
+            return Ref(compacted["id"], compacted.get("name"), compacted.get("type"))
+    elif value_type is list:
+        compacted = [get_compact_value(item, shared_values) for item in value]
+    else:
+        # Scalars, `Ref` and compact records
+        return value
+    return get_shared_value(compacted, shared_values)
+
+
+def get_shared_value(value: Any, shared_values: dict) -> Any:
+    """
+    Get the previously seen value identical to the supplied one. Only the content hash is stored so that unique values
+        cost a single entry.
+
+    :param value: Compacted JSON value
+    :param shared_values: Content hash and shared value map
+    :return: The shared value or the supplied value if seen first time (or on hash collision)
+    """
+    shared_value = shared_values.setdefault(get_content_hash(value), value)
+    return shared_value if shared_value is value or shared_value == value else value
+
+
+def to_fmc_json(value: Any) -> Any:
+    """
+    Convert compacted value back to plain (and unshared) FMC API JSON. Used when serving or posting the objects.
+
+    :param value: Compacted or plain JSON value
+    :return: JSON value
+    """
+    if isinstance(value, Mapping):
+        return {key: to_fmc_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_fmc_json(item) for item in value]
+    return value
@@ -0,0 +1,153 @@
+import json
+from os import fsync
+from pathlib import Path
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+from typing import Any, Optional
+
+from app.constants import MERGE_JOURNAL_DIR
+from app.utils import make_private_file
+
+
+class MergeJournal:
+    """
+    Local write-ahead journal of a topology merge. Each completed step of `FMCSession.merge_hns_topology` is appended
+        (and synced) with the IDs it created so that a failed merge can be resumed from the last good step or rolled
+        back, even after a backend restart. The journal keeps the previous settings (with the pre-shared keys) for the
+        rollback, hence it's only readable by the owner.
+
+    Steps: "begin" (merge parameters), "topology", "ikeSettings", "endpoints" (one per bulk chunk), "ipsecSettings",
+        "advancedSettings" and finally "complete" or "rolled_back".
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.merge_id = path.stem
+        self.lock = Lock()
+        self.steps: dict[str, dict] = {}
+        self.created_endpoints: list[dict] = []
+        self.created_endpoint_keys: set[str] = set()
+        if path.exists():
+            with open(path) as journal_file:
+                for line in journal_file:
+                    self.apply(json.loads(line))
+
+    @classmethod
+    def begin(cls, **merge_parameters) -> "MergeJournal":
+        """
+        Start the journal of a new merge.
+
+        :param merge_parameters: Parameters needed to resume the merge (host, domain, hub device, topology IDs...)
+        :return: The journal
+        """
+        path = Path(MERGE_JOURNAL_DIR) / f"{token_urlsafe(8)}.jsonl"
+        make_private_file(str(path))
+        journal = cls(path)
+        journal.record("begin", **merge_parameters)
+        return journal
+
+    @classmethod
+    def load(cls, merge_id: str) -> "MergeJournal":
+        """
+        Load existing journal.
+
+        :param merge_id: Merge ID (journal file name)
+        :return: The journal
+        """
+        path = Path(MERGE_JOURNAL_DIR) / f"{Path(merge_id).name}.jsonl"
+        if not path.exists():
+            raise KeyError(merge_id)
+        return cls(path)
+
+    @classmethod
+    def get_all(cls, host: str, domain_id: str) -> list["MergeJournal"]:
+        """
+        Get journals of the merges in a domain.
+
+        :param host: FMC host
+        :param domain_id: Domain UUID
+        :return: List of journals
+        """
+        journal_dir = Path(MERGE_JOURNAL_DIR)
+        journals = [cls(path) for path in journal_dir.glob("*.jsonl")] if journal_dir.exists() else []
+        return [journal for journal in journals if journal.parameters.get("host") == host
+                and journal.parameters.get("domain_id") == domain_id]
+
+    @classmethod
+    def get_unfinished(cls, host: str, domain_id: str) -> list["MergeJournal"]:
+        """
+        Get journals of the merges which neither completed nor were rolled back.
+
+        :param host: FMC host
+        :param domain_id: Domain UUID
+        :return: List of journals
+        """
+        return [journal for journal in cls.get_all(host, domain_id) if not journal.is_finished]
+
+    def apply(self, entry: dict) -> None:
+        """
+        Update the in-memory state from a journal entry.
+
+        :param entry: Journal entry
+        """
+        step = entry["step"]
+        if step == "endpoints":
+            self.created_endpoints.extend(entry["items"])
+            self.created_endpoint_keys.update(entry["endpoint_keys"])
+        self.steps[step] = entry
+
+    def record(self, step: str, **data: Any) -> None:
+        """
+        Durably append a completed step.
+
+        :param step: Step name
+        :param data: Step data (e.g. created IDs)
+        """
+        entry = {"step": step, "time": time(), **data}
+        with self.lock:
+            with open(self.path, "a") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                fsync(journal_file.fileno())
+            self.apply(entry)
+
+    def is_done(self, step: str) -> bool:
+        """
+        :param step: Step name
+        :return: Was the step completed?
+        """
+        return step in self.steps
+
+    def get(self, step: str) -> Optional[dict]:
+        """
+        :param step: Step name
+        :return: Journal entry of the step if completed
+        """
+        return self.steps.get(step)
+
+    @property
+    def parameters(self) -> dict:
+        """
+        :return: Merge parameters recorded at the beginning
+        """
+        return self.steps["begin"]
+
+    @property
+    def is_finished(self) -> bool:
+        """
+        :return: Did the merge complete or was rolled back?
+        """
+        return self.is_done("complete") or self.is_done("rolled_back")
+
+    def get_summary(self) -> dict[str, Any]:
+        """
+        :return: Merge progress summary served to the client
+        """
+        topology_step = self.get("topology")
+        return {"merge_id": self.merge_id, "started": self.parameters["time"],
+                "hub_device_id": self.parameters["hub_device_id"],
+                "hns_topology_id": topology_step["topology_id"] if topology_step else None,
+                "p2p_topology_ids": self.parameters["p2p_topology_ids"],
+                "completed_steps": [step for step in self.steps if step != "begin"],
+                "created_endpoints": len(self.created_endpoints)}
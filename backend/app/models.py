@@ -5,3 +5,16 @@ class LoginResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
     domains: dict[str, str]
+
+
+class FleetMember(BaseModel):
+    host: str
+    username: str
+    password: str
+
+
+class FleetLoginResponse(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    domains: dict[str, dict[str, str]]
+    failed: dict[str, str]
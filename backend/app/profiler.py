@@ -0,0 +1,86 @@
+import sys
+from collections import Counter
+from threading import Event, Thread, get_ident, enumerate as enumerate_threads
+from typing import Optional
+
+from app.session_store import session_store
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler sampling the stacks of every thread of the process (the request handler, the API pool and the
+        background fetches) while active. The idle workers of the thread pools are skipped. The samples are aggregated
+        as folded stacks (`process-wide;thread;outer;...;inner count`) read by flamegraph.pl and speedscope.
+        The profile is process-wide: the threads are shared by the requests, so the concurrent requests and the
+        background tasks of other sessions are sampled as well. The root frame labels it as such.
+    """
+
+    # Root frame of the folded stacks
+    SCOPE = "process-wide"
+
+    def __init__(self, interval: float):
+        """
+        :param interval: Seconds between the samples
+        """
+        self.interval = interval
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.samples = 0
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self) -> None:
+        """
+        Sample until stopped.
+        """
+        own_thread_id = get_ident()
+        while not self.stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in enumerate_threads()}
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id or (frame.f_code.co_name == "_worker"
+                                                  and frame.f_code.co_filename.endswith("thread.py")):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                stack.append(self.SCOPE)
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def get_folded_stacks(self) -> str:
+        """
+        :return: Folded stacks, one per line with the number of samples
+        """
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common())
+
+
+def save_profile(profile_id: str, path: str, profiler: SamplingProfiler) -> None:
+    """
+    Store the profile for any worker process.
+
+    :param profile_id: Profile ID
+    :param path: Profiled route path
+    :param profiler: Stopped profiler
+    """
+    session_store.set_task_status(f"profile:{profile_id}", "done", {
+        "path": path, "scope": profiler.SCOPE, "interval": profiler.interval, "samples": profiler.samples,
+        "folded_stacks": profiler.get_folded_stacks()})
+
+
+def load_profile(profile_id: str) -> Optional[dict]:
+    """
+    :param profile_id: Profile ID
+    :return: Stored profile (None if not found)
+    """
+    task_status = session_store.get_task_status(f"profile:{profile_id}")
+    return task_status[1] if task_status else None
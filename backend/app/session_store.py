@@ -0,0 +1,151 @@
+import json
+import sqlite3
+from hashlib import sha256
+from threading import local
+from time import time, sleep
+from typing import Any, Optional
+
+from app.constants import SESSION_STORE_PATH, SESSION_STORE_TTL_SECONDS, SESSION_STORE_POLL_SECONDS
+from app.utils import make_private_file, encrypt_text, decrypt_text
+
+
+def get_token_hash(token: str) -> str:
+    """
+    :param token: OAuth2 token
+    :return: Hash identifying the token in the store (the token itself is never stored)
+    """
+    return sha256(token.encode()).hexdigest()
+
+
+class SessionStore:
+    """
+    SQLite store shared by the worker processes so that any worker can serve any token. It holds
+        - the session metadata (FMC tokens and the selected domain/device/topology) with a version bumped on each save,
+        - the inventory snapshot of the session per domain,
+        - the status of the background tasks (e.g. inventory fetch, deployment).
+    The store file is private to the user. The rows are keyed by the hash of the OAuth2 token and the session metadata
+        is encrypted with the token, so the FMC tokens cannot be read from the file without the OAuth2 token.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connections = local()
+        # The WAL and shared memory files of SQLite get the permissions of the database file
+        make_private_file(path)
+        with self.connection as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (token_hash TEXT PRIMARY KEY, state TEXT, version INTEGER,
+                    updated REAL);
+                CREATE TABLE IF NOT EXISTS inventories (token_hash TEXT, domain_id TEXT, topologies TEXT, updated REAL,
+                    PRIMARY KEY (token_hash, domain_id));
+                CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, status TEXT, data TEXT, updated REAL);
+            """)
+            expired = time() - SESSION_STORE_TTL_SECONDS
+            for table in ("sessions", "inventories", "tasks"):
+                connection.execute(f"DELETE FROM {table} WHERE updated < ?", (expired,))
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        :return: Connection of the current thread
+        """
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # Readers do not block the writer of other worker
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.connections.connection = connection
+        return connection
+
+    def save_session(self, token: str, state: dict[str, Any]) -> int:
+        """
+        Store the session metadata encrypted with the token.
+
+        :param token: OAuth2 token
+        :param state: JSON serializable session state
+        :return: New version of the session
+        """
+        token_hash = get_token_hash(token)
+        with self.connection as connection:
+            connection.execute("INSERT INTO sessions VALUES (?, ?, 1, ?) ON CONFLICT(token_hash) DO UPDATE SET "
+                               "state = excluded.state, version = version + 1, updated = excluded.updated",
+                               (token_hash, encrypt_text(json.dumps(state), token), time()))
+            return connection.execute("SELECT version FROM sessions WHERE token_hash = ?",
+                                      (token_hash,)).fetchone()[0]
+
+    def get_session_version(self, token: str) -> Optional[int]:
+        """
+        :param token: OAuth2 token
+        :return: Version of the stored session (None if not found)
+        """
+        row = self.connection.execute("SELECT version FROM sessions WHERE token_hash = ?",
+                                      (get_token_hash(token),)).fetchone()
+        return row[0] if row else None
+
+    def load_session(self, token: str) -> Optional[tuple[dict[str, Any], int]]:
+        """
+        :param token: OAuth2 token
+        :return: Session state and its version (None if not found)
+        """
+        row = self.connection.execute("SELECT state, version FROM sessions WHERE token_hash = ?",
+                                      (get_token_hash(token),)).fetchone()
+        return (json.loads(decrypt_text(row[0], token)), row[1]) if row else None
+
+    def save_inventory(self, token: str, domain_id: str, topologies: list[dict]) -> None:
+        """
+        Store the inventory snapshot of the session.
+
+        :param token: OAuth2 token
+        :param domain_id: Domain UUID
+        :param topologies: Fetched topologies with their endpoints (plain JSON)
+        """
+        with self.connection as connection:
+            connection.execute("INSERT OR REPLACE INTO inventories VALUES (?, ?, ?, ?)",
+                               (get_token_hash(token), domain_id, json.dumps(topologies), time()))
+
+    def load_inventory(self, token: str, domain_id: str) -> Optional[list[dict]]:
+        """
+        :param token: OAuth2 token
+        :param domain_id: Domain UUID
+        :return: Stored topologies (None if not found)
+        """
+        row = self.connection.execute("SELECT topologies FROM inventories WHERE token_hash = ? AND domain_id = ?",
+                                      (get_token_hash(token), domain_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_task_status(self, key: str, status: str, data: Any = None) -> None:
+        """
+        :param key: Task key
+        :param status: Task status (e.g. "pending", "done")
+        :param data: JSON serializable task data
+        """
+        with self.connection as connection:
+            connection.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)",
+                               (key, status, json.dumps(data), time()))
+
+    def get_task_status(self, key: str) -> Optional[tuple[str, Any]]:
+        """
+        :param key: Task key
+        :return: Task status and data (None if not found)
+        """
+        row = self.connection.execute("SELECT status, data FROM tasks WHERE key = ?", (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def wait_for_task(self, key: str, pending_status: str = "pending", timeout: float = None) -> Optional[tuple[str, Any]]:
+        """
+        Wait while the task (running in any worker) has the pending status.
+
+        :param key: Task key
+        :param pending_status: Status of the unfinished task
+        :param timeout: Maximum seconds to wait (None for no limit)
+        :return: Last task status and data (None if not found)
+        """
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            task_status = self.get_task_status(key)
+            if task_status is None or task_status[0] != pending_status or (deadline and time() > deadline):
+                return task_status
+            sleep(SESSION_STORE_POLL_SECONDS)
+
+
+session_store = SessionStore(SESSION_STORE_PATH)
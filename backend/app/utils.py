@@ -1,14 +1,26 @@
+import json
+import os
+from base64 import b64encode, b64decode
+from hashlib import sha256
+from secrets import token_bytes
 from concurrent.futures import wait, Future, as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
 from itertools import chain
 from sys import getsizeof
-from typing import Callable, Dict, Mapping, Union
+from collections import deque
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Mapping, Union, Iterable, Iterator, Optional
 
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from fastapi import FastAPI
 from pydantic.typing import AnyCallable
 from starlette.middleware.cors import CORSMiddleware
 
-from app.constants import BULK_POST_BYTE_LIMIT
+from app.constants import BULK_POST_BYTE_LIMIT, BULK_POST_ITEM_LIMIT
 
 ALLOWED_CORS_ORIGINS = [
     "http://localhost:3000",
@@ -40,6 +52,76 @@ def enable_cors(app: FastAPI) -> None:
     )
 
 
+class RateLimiter:
+    """
+    Token bucket rate limiter shared by threads.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int):
+        """
+        :param requests_per_minute: Sustained request rate
+        :param burst: Number of requests allowed at once after being idle
+        """
+        self.interval = 60 / requests_per_minute
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Take a token, waiting for one if needed.
+
+        :param blocking: Wait for the token? Otherwise return immediately.
+        :return: Was the token taken?
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+            if self.tokens < 1 and not blocking:
+                return False
+            # Reserve the token and wait for it outside the lock
+            self.tokens -= 1
+            wait_seconds = -self.tokens * self.interval
+        if wait_seconds > 0:
+            sleep(wait_seconds)
+        return True
+
+
+class LatencyTracker:
+    """
+    Latencies of the recent calls shared by threads.
+    """
+
+    def __init__(self, window: int, min_samples: int):
+        """
+        :param window: Number of recent calls kept
+        :param min_samples: Number of calls needed before giving the percentiles
+        """
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = Lock()
+
+    def add(self, seconds: float) -> None:
+        """
+        :param seconds: Latency of a completed call
+        """
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def get_percentile(self, percentile: float) -> Optional[float]:
+        """
+        :param percentile: Percentile (e.g. 95)
+        :return: Latency percentile of the recent calls (None if too few calls)
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+
 def execute_parallel_tasks(task_list: list[Callable], api_pool: ThreadPoolExecutor) -> None:
     """
     Excute list of tasks in parallel and return on completion.
@@ -99,6 +181,70 @@ def get_task_callback_setup(executor: ThreadPoolExecutor) -> tuple[Callable, Cal
     return submit_task, run_callbacks
 
 
+def make_private_dir(path: str) -> None:
+    """
+    Create the directory (and its parents) accessible only by the current user. An existing directory is used as is,
+        it is never chmoded.
+
+    :param path: Directory path
+    :raises PermissionError: If the existing directory is not owned by the current user or is group/world accessible
+    """
+    try:
+        os.makedirs(path, mode=0o700)
+    except FileExistsError:
+        status = os.stat(path)
+        if status.st_uid != os.getuid() or status.st_mode & 0o077:
+            raise PermissionError(f"{path} must be owned by the current user and not accessible by others (chmod 700)")
+    else:
+        # Not restricted by the umask
+        os.chmod(path, 0o700)
+
+
+def make_private_file(path: str) -> None:
+    """
+    Create the file (if missing) in a private directory, readable and writable only by the current user.
+
+    :param path: File path
+    """
+    make_private_dir(os.path.dirname(os.path.abspath(path)))
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    os.chmod(path, 0o600)
+
+
+def get_secret_cipher(secret: str) -> AESGCM:
+    """
+    :param secret: High entropy secret (e.g. OAuth2 token)
+    :return: AES-256-GCM cipher of the key derived from the secret (HKDF-SHA256)
+    """
+    return AESGCM(HKDF(SHA256(), 32, None, b"fmctool session store").derive(secret.encode()))
+
+
+def encrypt_text(text: str, secret: str) -> str:
+    """
+    Encrypt and authenticate a text with a secret (AES-256-GCM with a random nonce).
+
+    :param text: Plain text
+    :param secret: High entropy secret (e.g. OAuth2 token)
+    :return: Base64 of the nonce and the ciphertext (with the authentication tag)
+    """
+    nonce = token_bytes(12)
+    return b64encode(nonce + get_secret_cipher(secret).encrypt(nonce, text.encode(), None)).decode()
+
+
+def decrypt_text(encrypted: str, secret: str) -> str:
+    """
+    :param encrypted: Text encrypted by `encrypt_text`
+    :param secret: The secret used for the encryption
+    :return: Plain text
+    :raises ValueError: If the secret is wrong or the text was tampered with
+    """
+    raw = b64decode(encrypted)
+    try:
+        return get_secret_cipher(secret).decrypt(raw[:12], raw[12:], None).decode()
+    except InvalidTag:
+        raise ValueError("Invalid secret or tampered text")
+
+
 def get_post_data_chunks(data: list[dict]) -> list[dict]:
     """
     Generator function to split list of items into smaller lists to stay under FMC API limit.
@@ -112,6 +258,64 @@ def get_post_data_chunks(data: list[dict]) -> list[dict]:
         yield chunk
 
 
+def iter_post_data_chunks(data: Iterable[dict]) -> Iterator[list[dict]]:
+    """
+    Generator function to split a stream of items into lists staying under FMC API limits (serialized size and item
+        count) without materializing the whole stream.
+
+    :param data: Items to split
+    """
+    chunk, chunk_bytes = [], 0
+    for item in data:
+        item_bytes = len(json.dumps(item)) + 1
+        if chunk and (chunk_bytes + item_bytes > BULK_POST_BYTE_LIMIT or len(chunk) == BULK_POST_ITEM_LIMIT):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += item_bytes
+    if chunk:
+        yield chunk
+
+
+def iter_json_array_items(chunks: Iterable[str], key: str) -> Iterator:
+    """
+    Generator function parsing the items of an array of a JSON object (e.g. "items" of FMC API list response) one at a
+        time while the response is read in chunks, so that only a chunk and an item are held in memory.
+
+    :param chunks: Text chunks of the JSON object
+    :param key: Key of the array
+    """
+    decoder = json.JSONDecoder()
+    marker = f'"{key}"'
+    chunks = iter(chunks)
+    buffer = ""
+    while True:
+        marker_index = buffer.find(marker)
+        array_index = buffer.find("[", marker_index + len(marker)) if marker_index >= 0 else -1
+        if array_index >= 0:
+            buffer = buffer[array_index + 1:]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            # Empty list responses have no items
+            return
+        buffer += chunk
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,")
+        if buffer.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            buffer += chunk
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
 def get_dict_diff(dicts: list[dict], ignored_keys: set[str]) -> Dict:
     """
     Consider the dict/hashmap a tree structure. For the provided tree it returns the subtree whose values are not
@@ -141,6 +345,46 @@ def get_dict_diff(dicts: list[dict], ignored_keys: set[str]) -> Dict:
     return res
 
 
+def get_conflict_signature(value: Any, ignored_keys: set[str]) -> str:
+    """
+    Serialize the compared part of a tree, so that the trees without conflicts (see `get_dict_diff`) among them have
+        the same signature.
+
+    :param value: Tree (e.g. topology)
+    :param ignored_keys: Ignore subtrees with certain key values
+    :return: Signature
+    """
+    def strip(item: Any) -> Any:
+        if isinstance(item, Mapping):
+            return {key: strip(child) for key, child in item.items() if key not in ignored_keys}
+        if isinstance(item, list):
+            return [strip(child) for child in item]
+        return item
+
+    return json.dumps(strip(value), sort_keys=True)
+
+
+def get_canonical_digest(value: Mapping, keys: Iterable[str], dropped_keys: set[str]) -> str:
+    """
+    Digest of the canonical form of an object: only the compared keys, the dropped subtrees removed at every level and
+        the mapping keys and the list items sorted. Objects equal but for ordering have the same digest.
+
+    :param value: Object (e.g. endpoint)
+    :param keys: Compared top level keys
+    :param dropped_keys: Ignore subtrees with certain key values (e.g. "links")
+    :return: SHA-256 hex digest
+    """
+    def canonicalize(item: Any) -> Any:
+        if isinstance(item, Mapping):
+            return {key: canonicalize(child) for key, child in item.items() if key not in dropped_keys}
+        if isinstance(item, (list, tuple)):
+            return sorted((canonicalize(child) for child in item), key=lambda child: json.dumps(child, sort_keys=True))
+        return item
+
+    canonical_value = {key: canonicalize(value[key]) for key in keys if key in value}
+    return sha256(json.dumps(canonical_value, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
 def get_list_value_conflict(values: list[list]) -> Union[None, list[list]]:
     """
     Find conflicts among list of _list values_. It merges the lists, removes the duplicates and checks if merged list is
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import json
+import subprocess
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from collections import defaultdict
+from functools import partial
+from inspect import signature
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+from fmcapi import FMC, Endpoints
+
+from app.constants import CONFLICT_IGNORED_KEYS
+from app.fmc_utils import get_hns_endpoint_data_from_p2p, get_topologies_from_ids
+from app.inventory import TopologyRecord
+from app.utils import get_dict_diff, get_list_value_conflict, patch_dict, iter_post_data_chunks
+from recreate import generate_topologies
+
+BASELINE_PATH = Path(__file__).with_name("benchmark_baseline.json")
+
+SCALES = (100, 10_000, 100_000)
+
+# Allowed slowdown/growth relative to the baseline before a benchmark is flagged as regressed
+TIME_TOLERANCE = 1.5
+
+MEMORY_TOLERANCE = 1.2
+
+# Absolute slowdown ignored as timer noise for the micro-second benchmarks
+TIME_NOISE_SECONDS = 0.001
+
+# Modules imported by the server on cold start (the routes and the production entry point)
+STARTUP_MODULES = ("app.api", "app.asgi")
+
+# The endpoint generation needs the forked fmcapi (`vpn_policy(vpn_id=...)`)
+FORKED_FMCAPI = "vpn_id" in signature(Endpoints.vpn_policy).parameters
+
+# Benchmarks which can't run without the forked fmcapi (the routes check the server version on import)
+FORKED_FMCAPI_BENCHMARKS = {"get_hns_endpoint_data_from_p2p", "startup[app.api]"}
+
+
+def get_p2p_topologies(topologies: list[dict]) -> dict[str, list[dict]]:
+    """
+    Build the device id and p2p topology list map the same way `FMCSession.fetch_topologies` does.
+
+    :param topologies: Generated topologies
+    :return: Device id and p2p topology list map
+    """
+    p2p_topologies = defaultdict(list)
+    for topology in topologies:
+        if topology["topologyType"] == "POINT_TO_POINT":
+            for endpoint in topology["endpoints"]:
+                if not endpoint["extranet"]:
+                    p2p_topologies[endpoint["device"]["id"]].append(topology)
+    p2p_topologies.default_factory = None
+    return p2p_topologies
+
+
+def get_benchmarks(scale: int) -> dict[str, Callable[[], Callable]]:
+    """
+    Get the benchmarked merge core functions for a synthetic inventory of specific size. Each benchmark is a setup
+        function returning the measured call so that the setup cost (e.g. copying the input) is not measured.
+
+    :param scale: Number of point-to-point topologies merged into a single hub
+    :return: Benchmark name and setup function map
+    """
+    topologies = generate_topologies(scale, device_count=1, spokes_per_hub=(scale, scale), conflict_rate=0.2,
+                                     hns_count=0, seed=scale)
+    p2p_topologies = get_p2p_topologies(topologies)
+    hub_device_id = next(iter(p2p_topologies))
+    topology_ids = [topology["id"] for topology in topologies[::2]]
+    override = {"advancedSettings": {"advancedTunnelSetting": {"natKeepaliveMessageTraversal": {"intervalSeconds": 40}}},
+                "ikeSettings": {"ikeV2Settings": {"manualPreSharedKey": "Cisco@123-Collab"}}}
+    policy_lists = [topology["ikeSettings"]["ikeV2Settings"]["policies"] for topology in topologies]
+    endpoints = [endpoint for topology in topologies for endpoint in topology["endpoints"]]
+    fmc = FMC(host="benchmark")
+    fmc.configuration_url = "https://benchmark/api/fmc_config/v1/domain/benchmark"
+    fmc.serverVersion = "7.0.0"
+
+    def patch_topologies():
+        for topology in topologies:
+            patch_dict(topology, override)
+
+    def chunk_endpoints(endpoints_data):
+        return list(iter_post_data_chunks(endpoints_data))
+
+    def compact_topologies():
+        shared_values = {}
+        return [TopologyRecord(topology, shared_values) for topology in topologies]
+
+    benchmarks = {
+        "get_dict_diff": lambda: partial(get_dict_diff, topologies, CONFLICT_IGNORED_KEYS),
+        "get_list_value_conflict": lambda: partial(get_list_value_conflict, policy_lists),
+        "patch_dict": lambda: patch_topologies,
+        # The endpoints are streamed to the chunking as in `set_endpoints_future`, hence a fresh iterator per run
+        "iter_post_data_chunks": lambda: partial(chunk_endpoints, iter(endpoints)),
+        "get_topologies_from_ids": lambda: partial(get_topologies_from_ids, p2p_topologies, hub_device_id,
+                                                   topology_ids, []),
+        "compact_topologies": lambda: compact_topologies,
+    }
+    if FORKED_FMCAPI:
+        benchmarks["get_hns_endpoint_data_from_p2p"] = lambda: partial(
+            get_hns_endpoint_data_from_p2p, p2p_topologies, hub_device_id, fmc, "benchmark",
+            [topology["id"] for topology in topologies], [], [], True)
+    return benchmarks
+
+
+def measure(setup: Callable[[], Callable], repeat: int) -> dict[str, float]:
+    """
+    Measure the best wall time and the peak memory allocated by the benchmark.
+
+    :param setup: Function returning the measured call
+    :param repeat: Number of timed runs
+    :return: Time (seconds) and peak memory (bytes)
+    """
+    times = []
+    for _ in range(repeat):
+        call = setup()
+        start = perf_counter()
+        call()
+        times.append(perf_counter() - start)
+    call = setup()
+    tracemalloc.start()
+    call()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak_memory}
+
+
+def measure_startup(module: str, repeat: int) -> dict[str, float]:
+    """
+    Measure the import time of a module in fresh interpreters (i.e. the cold start of the server) and the peak memory
+        allocated by the import (the RSS of the child process includes the memory of the forked benchmark process).
+
+    :param module: Imported module
+    :param repeat: Number of timed runs
+    :return: Time (seconds) and peak memory (bytes)
+    """
+    script = ("import json, time, tracemalloc; tracemalloc.start(); start = time.perf_counter(); import {module}; "
+              "print(json.dumps({{'seconds': time.perf_counter() - start, "
+              "'peak_bytes': tracemalloc.get_traced_memory()[1]}}))").format(module=module)
+    runs = [json.loads(subprocess.run([sys.executable, "-c", script], cwd=Path(__file__).parent, check=True,
+                                      capture_output=True, text=True).stdout) for _ in range(repeat)]
+    return {"seconds": min(run["seconds"] for run in runs), "peak_bytes": min(run["peak_bytes"] for run in runs)}
+
+
+def get_regressions(results: dict[str, dict], baseline: dict[str, dict]) -> list[str]:
+    """
+    Compare the results with the baseline.
+
+    :param results: Benchmark results
+    :param baseline: Stored benchmark results
+    :return: Description of the regressed benchmarks (the ones missing from the baseline are not compared)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"NO BASELINE {name} (store it with --update-baseline)")
+            continue
+        if result["seconds"] > max(baseline[name]["seconds"] * TIME_TOLERANCE,
+                                   baseline[name]["seconds"] + TIME_NOISE_SECONDS):
+            regressions.append(f"{name}: {result['seconds']:.4f}s (baseline {baseline[name]['seconds']:.4f}s)")
+        if result["peak_bytes"] > baseline[name]["peak_bytes"] * MEMORY_TOLERANCE:
+            regressions.append(f"{name}: {result['peak_bytes']} B (baseline {baseline[name]['peak_bytes']} B)")
+    return regressions
+
+
+def run_benchmarks(scales: list[int], selected: set[str]) -> dict[str, dict]:
+    """
+    Run the benchmarks for each scale.
+
+    :param scales: Inventory sizes
+    :param selected: Benchmark names to run (all if empty)
+    :return: Results keyed by `$NAME[$SCALE]`
+    """
+    results = {}
+    if not FORKED_FMCAPI:
+        for name in sorted(FORKED_FMCAPI_BENCHMARKS):
+            if not selected or name.split("[")[0] in selected:
+                print(f"SKIPPED {name}: needs the forked fmcapi (vpn_policy(vpn_id=...))")
+    for scale in scales:
+        for name, setup in get_benchmarks(scale).items():
+            if selected and name not in selected:
+                continue
+            results[f"{name}[{scale}]"] = measure(setup, 3 if scale < SCALES[-1] else 1)
+            print(f"{name}[{scale}]", results[f"{name}[{scale}]"])
+    if not selected or "startup" in selected:
+        for module in STARTUP_MODULES:
+            if not FORKED_FMCAPI and f"startup[{module}]" in FORKED_FMCAPI_BENCHMARKS:
+                continue
+            results[f"startup[{module}]"] = measure_startup(module, 5)
+            print(f"startup[{module}]", results[f"startup[{module}]"])
+    return results
+
+
+if __name__ == "__main__":
+    """Run the merge core benchmarks and compare with the stored baseline"""
+    parser = ArgumentParser(description="Benchmark the merge core functions on synthetic inventories")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES)
+    parser.add_argument("--only", nargs="+", default=[], help="Benchmark names to run")
+    parser.add_argument("--update-baseline", action="store_true", help=f"Store the results in {BASELINE_PATH.name}")
+    args = parser.parse_args()
+    benchmark_results = run_benchmarks(args.scales, set(args.only))
+    stored_baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    if args.update_baseline:
+        stored_baseline.update(benchmark_results)
+        BASELINE_PATH.write_text(json.dumps(stored_baseline, indent=2, sort_keys=True) + "\n")
+    else:
+        regressed = get_regressions(benchmark_results, stored_baseline)
+        for regression in regressed:
+            print("REGRESSION", regression)
+        exit(1 if regressed else 0)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import json
+import os
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+from getpass import getpass
+from itertools import chain
+from pathlib import Path
+from secrets import token_urlsafe
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Optional
+
+from fmcapi import FTDS2SVPNs, DeploymentRequests
+
+from app.batch_merge import get_majority_override, get_merged_override, plan_batch_merge, run_batch_merge
+from app.constants import FMC_REQUESTS_PER_MINUTE, FMC_REQUEST_BURST, BATCH_MERGE_MIN_TOPOLOGIES, \
+    BATCH_MERGE_PARALLEL_HUBS
+from app.deployment import submit_deployment
+from app.fmc_session import FMCSession
+from app.merge_journal import MergeJournal
+
+# Parallel FMC connections of a session (size of `FMCSession.api_pool`)
+API_POOL_SIZE = 8
+
+
+class DryRunRecorder:
+    """
+    Replacement of `FMC.send_to_api` which performs the GET calls (needed to plan the merge) and records every other call
+        instead of sending it. The recorded writes answer with the submitted data so the merge proceeds as if created.
+    """
+
+    def __init__(self, send_to_api):
+        self.send_to_api = send_to_api
+        self.calls: list[dict[str, Any]] = []
+        self.created: dict[str, Any] = {}
+        self.read_seconds: list[float] = []
+
+    def __call__(self, method: str, url: str, json_data: Any = None, **kwargs) -> Any:
+        if method == "get":
+            created_object = self.created.get(url.split("?")[0].rstrip("/").rsplit("/", 1)[-1])
+            if created_object is not None:
+                return created_object
+            start = perf_counter()
+            response = self.send_to_api(method=method, url=url, json_data=json_data, **kwargs)
+            self.read_seconds.append(perf_counter() - start)
+            return response
+        self.calls.append({"method": method.upper(), "url": url, "items": len(json_data) if isinstance(json_data, list)
+                          else 1, "json": json_data})
+        if isinstance(json_data, list):
+            return {"items": [{**item, "id": f"dry-run-{len(self.calls)}-{i}"} for i, item in enumerate(json_data)]}
+        response = {**(json_data or {}), "id": f"dry-run-{len(self.calls)}"}
+        self.created[response["id"]] = response
+        return response
+
+    def get_estimate(self) -> dict[str, Any]:
+        """
+        :return: Write call and bulk chunk counts and the estimated duration of the writes under the FMC rate limit
+        """
+        bulk_calls = [call for call in self.calls if "bulk=true" in call["url"]]
+        mean_latency = sum(self.read_seconds) / len(self.read_seconds) if self.read_seconds else 0
+        rate_limited_seconds = max(0, len(self.calls) - FMC_REQUEST_BURST) * 60 / FMC_REQUESTS_PER_MINUTE
+        return {"write_calls": len(self.calls), "bulk_chunks": len(bulk_calls),
+                "bulk_items": sum(call["items"] for call in bulk_calls),
+                "estimated_seconds": max(rate_limited_seconds, len(self.calls) * mean_latency / API_POOL_SIZE)}
+
+
+def load_plan(path: str) -> dict[str, Any]:
+    """
+    Load JSON or YAML (needs PyYAML) merge plan.
+
+    :param path: Plan file path
+    :return: Merge plan
+    """
+    text = Path(path).read_text()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit("PyYAML is needed for YAML plans (pip install pyyaml)")
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def get_domain_id(fmc_session: FMCSession, domain: str) -> str:
+    """
+    :param fmc_session:
+    :param domain: Domain UUID or name (e.g. "Global")
+    :return: Domain UUID
+    """
+    for domain_id, name in fmc_session.domains.items():
+        if domain in (domain_id, name, f"Global/{name}"):
+            return domain_id
+    raise SystemExit(f"Domain {domain} not found")
+
+
+def select_topologies(topologies: list[dict], selectors: Optional[list[str]]) -> list[str]:
+    """
+    :param topologies: Candidate topologies
+    :param selectors: Topology IDs, names or name patterns (e.g. "P2P-*"). All topologies if None.
+    :return: IDs of the selected topologies
+    """
+    return [topology["id"] for topology in topologies if selectors is None or any(
+        selector == topology["id"] or fnmatch(topology["name"], selector) for selector in selectors)]
+
+
+def run_merge(fmc_session: FMCSession, merge: dict[str, Any], policy: str,
+              journal: Optional[MergeJournal], verify: bool = True) -> tuple[dict, list[dict]]:
+    """
+    Merge the selected point-to-point topologies into a new topology of a hub device or into an existing hub and spoke
+        topology.
+
+    :param fmc_session:
+    :param merge: Merge entry of the plan with "hub_device_id" or "hns_topology_id", "topologies" selectors, optional
+        "override", "name" and "topology_type" ("HUB_AND_SPOKE" or "FULL_MESH")
+    :param policy: Conflict policy ("majority" or "first")
+    :param journal: Journal used instead of a new one (for dry-run)
+    :param verify: Verify the merged topology against FMC?
+    :return: Merged topology and the merged point-to-point topologies
+    """
+    workspace = fmc_session.get_workspace("cli")
+    hns_topology_id = merge.get("hns_topology_id")
+    if hns_topology_id is None:
+        workspace.set_hub_device_id(merge["hub_device_id"])
+        candidates = fmc_session.p2p_topologies[merge["hub_device_id"]]
+    else:
+        workspace.set_hub_device_id(None)
+        candidates = workspace.set_hns_topology_id(hns_topology_id)
+    topology_ids = select_topologies(candidates, merge.get("topologies"))
+    if not topology_ids:
+        raise SystemExit(f"No topologies selected for {merge}")
+    topologies = [topology for topology in candidates if topology["id"] in topology_ids]
+    conflicts = workspace.get_topology_conflicts(topology_ids)
+    resolution = get_majority_override(topologies, conflicts) if policy == "majority" else {}
+    resolution = get_merged_override(resolution, merge.get("override") or {})
+    topology = workspace.create_hns_topology(merge.get("name") or "HNS-" + token_urlsafe(2), topology_ids, resolution,
+                                             hns_topology_id, journal, merge.get("topology_type", "HUB_AND_SPOKE"),
+                                             verify)
+    return topology, topologies
+
+
+def get_topology_device_ids(topologies: list[dict], topology_ids: list[str]) -> set[str]:
+    """
+    :param topologies: Candidate topologies
+    :param topology_ids: IDs of the topologies
+    :return: Devices of the topologies' endpoints
+    """
+    topology_id_set = set(topology_ids)
+    return {endpoint["device"]["id"] for topology in topologies if topology["id"] in topology_id_set
+            for endpoint in topology["endpoints"] if not endpoint["extranet"]}
+
+
+def run_plan(plan: dict[str, Any], password: str, dry_run: bool) -> dict[str, Any]:
+    """
+    Login and run the merges of the plan. With dry-run the FMC is only read.
+
+    :param plan: Merge plan
+    :param password: FMC password
+    :param dry_run: Print the FMC writes instead of sending them
+    :return: Result summary
+    """
+    creds = SimpleNamespace(username=f"{plan['host']} {plan['username']}", password=password)
+    fmc_session = FMCSession(token_urlsafe(32), creds)
+    recorder = None
+    if dry_run:
+        recorder = DryRunRecorder(fmc_session.fmc.send_to_api)
+        fmc_session.fmc.send_to_api = recorder
+    fmc_session.set_domain(get_domain_id(fmc_session, plan["domain"]), blocking=True)
+    policy = plan.get("policy", "majority")
+    summary: dict[str, Any] = {"merged": []}
+    merged_p2p_topology_ids, device_ids = [], set()
+    with TemporaryDirectory() as journal_dir:
+        for i, merge in enumerate(plan.get("merges", [])):
+            journal = MergeJournal(Path(journal_dir) / f"{i}.jsonl") if dry_run else None
+            topology, topologies = run_merge(fmc_session, merge, policy, journal, verify=not dry_run)
+            summary["merged"].append({"id": topology["id"], "name": topology.get("name"),
+                                      "p2p_topology_ids": [p2p_topology["id"] for p2p_topology in topologies],
+                                      "endpoints": len(topology["endpoints"]),
+                                      "verification": topology.get("verification"),
+                                      "round_trips": topology.get("round_trips")})
+            merged_p2p_topology_ids.extend(p2p_topology["id"] for p2p_topology in topologies)
+            for endpoint in chain(topology["endpoints"], *(p2p_topology["endpoints"] for p2p_topology in topologies)):
+                if not endpoint["extranet"]:
+                    device_ids.add(endpoint["device"]["id"])
+    summary["round_trips_saved"] = sum(merged["round_trips"]["saved"] for merged in summary["merged"]
+                                       if merged["round_trips"])
+    if plan.get("batch"):
+        if dry_run:
+            raise SystemExit("Dry-run is not supported for batch plans, use the `/batch-merge/plan` route instead")
+        batch = plan["batch"]
+        plans = plan_batch_merge(fmc_session.p2p_topologies, batch.get("hub_device_ids"),
+                                 batch.get("min_topologies", BATCH_MERGE_MIN_TOPOLOGIES))
+        summary["batch"] = run_batch_merge(fmc_session, plans, policy, batch.get("override"),
+                                           batch.get("parallel_hubs", BATCH_MERGE_PARALLEL_HUBS))
+        for result in summary["batch"]["results"]:
+            if result["status"] == "merged":
+                merged_p2p_topology_ids.extend(result["p2p_topology_ids"])
+                device_ids.update(get_topology_device_ids(fmc_session.p2p_topologies[result["hub_device_id"]],
+                                                          result["p2p_topology_ids"]))
+    if plan.get("deploy") and merged_p2p_topology_ids:
+        if dry_run:
+            for topology_id in merged_p2p_topology_ids:
+                recorder(method="delete", url=f"{FTDS2SVPNs(fmc=fmc_session.fmc).URL}/{topology_id}")
+            recorder(method="post", url=DeploymentRequests(fmc=fmc_session.fmc).URL,
+                     json_data={"type": "DeploymentRequest", "deviceList": sorted(device_ids)})
+        else:
+            job = submit_deployment(fmc_session.fmc, fmc_session.api_pool, merged_p2p_topology_ids, device_ids)
+            for phase in job.iter_phases():
+                print("deployment", phase["phase"], phase["detail"])
+            summary["deployment"] = job.phases[-1]
+    if recorder is not None:
+        summary["dry_run"] = recorder.get_estimate()
+        for call in recorder.calls:
+            print(call["method"], call["url"], json.dumps(call["json"]))
+    return summary
+
+
+if __name__ == "__main__":
+    """Run the merges of a plan without the UI"""
+    parser = ArgumentParser(description="Merge point-to-point topologies according to a JSON/YAML plan")
+    parser.add_argument("plan", help="Plan file with host, username, domain, policy and merges (see README)")
+    parser.add_argument("--dry-run", action="store_true", help="Print the FMC writes and estimate the duration")
+    args = parser.parse_args()
+    merge_plan = load_plan(args.plan)
+    fmc_password = os.environ.get("FMC_PASSWORD") or getpass(f"Password for {merge_plan['username']}: ")
+    print(json.dumps(run_plan(merge_plan, fmc_password, args.dry_run), indent=2))
@@ -1,6 +1,24 @@
 #!/usr/bin/env python3
+import os
+from argparse import ArgumentParser
+
 import uvicorn
 
 if __name__ == '__main__':
-    """Start the backend server at specified host and port. Restart on source file modifications."""
-    uvicorn.run("app.api:app", host="127.0.0.1", port=8000, reload=True)
+    """
+    Start the backend server at specified host and port. Restart on source file modifications unless in production mode
+        i.e. with `--production` or several worker processes (sharing the sessions through `SESSION_STORE_PATH`).
+    """
+    parser = ArgumentParser(description="Start the backend server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes (production mode if more than one)")
+    parser.add_argument("--production", action="store_true",
+                        help="Serve without reloader, loading the routes after the server starts (see /ready)")
+    args = parser.parse_args()
+    # Inherited by the worker processes to split the FMC rate limit among them
+    os.environ["WORKER_PROCESSES"] = str(args.workers)
+    if args.production or args.workers > 1:
+        uvicorn.run("app.asgi:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run("app.api:app", host=args.host, port=args.port, reload=True)
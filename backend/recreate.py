@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
+import json
 import socket
 import struct
+from argparse import ArgumentParser
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from random import randint
+from random import Random
+from typing import Optional
+from uuid import UUID
 
-from fmcapi import FMC, AdvancedSettings, FTDS2SVPNs, Endpoints, IKESettings
+from fmcapi import FMC, AdvancedSettings, FTDS2SVPNs, IKESettings
 
-from app.utils import execute_parallel_tasks
+from app.constants import FMC_PAGE_LIMIT
+from app.fmc_recorder import get_cassette_entry
+from app.fmc_utils import get_create_bulk_endpoints_url
+from app.utils import execute_parallel_tasks, get_post_data_chunks
 
 ##################################################
 # Verify the constants before running the script
@@ -28,8 +35,14 @@ FTD_DEVICE_ = {"name": "10.10.8.2", "id": "07cfba2c-c2bf-11eb-9e85-c5bee801c0c9"
 PROTECTED_NETWORKS = {
     "networks": [{"name": "10P2PObj", "id": "0050568C-4A4E-0ed3-0000-021474838306", "type": "Network"}]}
 
+DEFAULT_INTERVAL_SECONDS, CONFLICTING_INTERVAL_SECONDS = 20, 40
 
-def recreate_test_topologies(fmc, api_pool, count=5, p2p_only=False):
+DEFAULT_PRE_SHARED_KEY, CONFLICTING_PRE_SHARED_KEY = "Cisco@123-Collab", "Cisco@123-Switching"
+
+STAND_IN_DOMAIN = {"name": "Global", "uuid": "e276abec-e0f2-11e3-8169-6d9ed49b625f"}
+
+
+def recreate_test_topologies(fmc, api_pool, count=5, p2p_only=False, **distribution):
     """
     Delete all existing topologies and create fresh topologies.
 
@@ -37,28 +50,21 @@ def recreate_test_topologies(fmc, api_pool, count=5, p2p_only=False):
     :param api_pool: Thread pool used for sending requests
     :param count: Number of P2P topologies created.
     :param p2p_only: Delete and recreate only P2P topologies
+    :param distribution: Settings distribution passed to `generate_topologies`
     """
     delete_all_topologies(fmc, api_pool, p2p_only)
+    topologies = generate_topologies(count, hns_count=0 if p2p_only else 1, **distribution)
+    seed_topologies(fmc, api_pool, topologies)
 
-    extranet_ips = get_random_ips(count)
-
-    tasks = [partial(create_topology, fmc, extranet_ips.pop(), f"p2p-topology-{i:03d}", True) for i in range(count)]
-    if not p2p_only:
-        tasks.append(partial(create_topology, fmc, get_random_ips(1).pop(), "test_hns_topology", False))
 
-    execute_parallel_tasks(tasks, api_pool)
-
-
-def create_test_topology_advanced_settings(fmc, topology_api, advanced_settings_id):
+def get_advanced_settings(interval_seconds: int) -> dict:
     """
-    Set specific advanced settings for the topology.
+    Get the advanced settings of the test topologies.
 
-    :param fmc: FMC API object
-    :param topology_api: Topology API object
-    :param advanced_settings_id: Advanced settings object ID
+    :param interval_seconds: NAT keepalive interval, the parameter varied to create conflicts
+    :return: Advanced settings object
     """
-    advanced_settings = {
-        "id": advanced_settings_id,
+    return {
         "type": "AdvancedSettings",
         "advancedTunnelSetting": {
             "certificateMapSettings": {
@@ -70,7 +76,7 @@ def create_test_topology_advanced_settings(fmc, topology_api, advanced_settings_
             "enableSpokeToSpokeConnectivityThroughHub": False,
             "natKeepaliveMessageTraversal": {
                 "enabled": True,
-                "intervalSeconds": [20, 40][randint(0, 1)]
+                "intervalSeconds": interval_seconds
             },
             "bypassAccessControlTrafficForDecryptedTraffic": False
         },
@@ -95,9 +101,154 @@ def create_test_topology_advanced_settings(fmc, topology_api, advanced_settings_
             "enableNotificationOnTunnelDisconnect": False
         }
     }
-    advanced_settings_api = AdvancedSettings(fmc=fmc, **advanced_settings)
-    advanced_settings_api.vpn_policy(vpn_id=topology_api.id)
-    advanced_settings_api.put()
+
+
+def get_ike_settings(pre_shared_key: str) -> dict:
+    """
+    Get the IKE settings of the test topologies.
+
+    :param pre_shared_key: Manual pre-shared key, the parameter varied to create conflicts
+    :return: IKE settings object
+    """
+    return {"type": "IkeSetting",
+            "ikeV2Settings": {"authenticationType": "MANUAL_PRE_SHARED_KEY", "enforceHexBasedPreSharedKeyOnly": False,
+                              "manualPreSharedKey": pre_shared_key, "policies": IKE_POLICIES}}
+
+
+def get_ipsec_settings() -> dict:
+    """
+    Get the (default) IPsec settings of the test topologies.
+
+    :return: IPsec settings object
+    """
+    return {"type": "IPSecSetting", "cryptoMapType": "STATIC", "ikeV2Mode": "TUNNEL", "enableRRI": True,
+            "enableSaStrengthEnforcement": False, "lifetimeSeconds": 28800, "lifetimeKilobytes": 4608000,
+            "perfectForwardSecrecy": {"enabled": False}}
+
+
+def get_synthetic_devices(count: int, rng: Random) -> list[tuple[dict, dict]]:
+    """
+    Create device and interface references. A single device uses the real FTD constants, more are only valid for the
+        local FMC stand-in.
+
+    :param count: Number of devices
+    :param rng: Random generator
+    :return: List of (device, interface) references
+    """
+    if count == 1:
+        return [(FTD_DEVICE_, FTD_INTERFACE)]
+    return [({"name": f"ftd-{i:05d}", "id": get_random_uuid(rng), "type": "Device"},
+             {"name": "Outside", "id": get_random_uuid(rng), "type": "PhysicalInterface"}) for i in range(count)]
+
+
+def get_random_uuid(rng: Random) -> str:
+    """
+    Create reproducible UUID.
+
+    :param rng: Random generator
+    :return: UUID string
+    """
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def get_device_endpoint(device: dict, interface: dict, peer_type: str, rng: Random) -> dict:
+    """
+    Get endpoint object of a managed device.
+
+    :param device: Device reference
+    :param interface: Interface reference
+    :param peer_type: "PEER", "HUB" or "SPOKE"
+    :param rng: Random generator
+    :return: Endpoint object
+    """
+    return {"id": get_random_uuid(rng), "type": "EndPoint", "name": device["name"], "peerType": peer_type,
+            "extranet": False, "device": device, "interface": interface, "protectedNetworks": PROTECTED_NETWORKS,
+            "connectionType": "BIDIRECTIONAL"}
+
+
+def get_extranet_endpoint(extranet_ip: str, peer_type: str, rng: Random) -> dict:
+    """
+    Get endpoint object of an extranet device.
+
+    :param extranet_ip: IP of the extranet endpoint
+    :param peer_type: "PEER", "HUB" or "SPOKE"
+    :param rng: Random generator
+    :return: Endpoint object
+    """
+    return {"id": get_random_uuid(rng), "type": "EndPoint", "name": extranet_ip, "peerType": peer_type,
+            "extranet": True, "extranetInfo": {"name": extranet_ip, "ipAddress": extranet_ip, "isDynamicIP": False},
+            "protectedNetworks": PROTECTED_NETWORKS, "connectionType": "BIDIRECTIONAL"}
+
+
+def get_topology(name: str, p2p: bool, endpoints: list[dict], conflict_rate: float, rng: Random) -> dict:
+    """
+    Get topology object (corresponding to FMC API's GET ftds2svpns with the endpoints and settings expanded).
+
+    :param name: Name of topology
+    :param p2p: Point-to-point or hub-and-spoke topology
+    :param endpoints: Endpoints of the topology
+    :param conflict_rate: Probability of each varied setting to deviate from the default
+    :param rng: Random generator
+    :return: Topology object
+    """
+    interval_seconds = CONFLICTING_INTERVAL_SECONDS if rng.random() < conflict_rate else DEFAULT_INTERVAL_SECONDS
+    pre_shared_key = CONFLICTING_PRE_SHARED_KEY if rng.random() < conflict_rate else DEFAULT_PRE_SHARED_KEY
+    topology = {"id": get_random_uuid(rng), "name": name, "type": "FTDS2SVpn",
+                "topologyType": "POINT_TO_POINT" if p2p else "HUB_AND_SPOKE", "routeBased": False,
+                "ikeV1Enabled": False, "ikeV2Enabled": True, "ikeSettings": get_ike_settings(pre_shared_key),
+                "ipsecSettings": get_ipsec_settings(), "advancedSettings": get_advanced_settings(interval_seconds),
+                "endpoints": endpoints}
+    for key_name in ("ikeSettings", "ipsecSettings", "advancedSettings"):
+        topology[key_name]["id"] = get_random_uuid(rng)
+    return topology
+
+
+def generate_topologies(p2p_count: int, device_count: int = 1, spokes_per_hub: tuple[int, int] = (1, 5),
+                        conflict_rate: float = 0.5, hns_count: int = 1, seed: Optional[int] = None) -> list[dict]:
+    """
+    Generate reproducible topologies. Each point-to-point topology connects a hub device with an extranet spoke. The
+        hub devices are assigned round-robin, each getting a number of spokes drawn from `spokes_per_hub`.
+
+    :param p2p_count: Number of point-to-point topologies
+    :param device_count: Number of managed (hub) devices
+    :param spokes_per_hub: Range (inclusive) of the number of point-to-point topologies per hub device
+    :param conflict_rate: Probability of each varied setting (NAT keepalive interval, pre-shared key) to deviate from
+        the default
+    :param hns_count: Number of hub-and-spoke topologies
+    :param seed: Random seed
+    :return: List of topology objects
+    """
+    rng = Random(seed)
+    devices = get_synthetic_devices(device_count, rng)
+    extranet_ips = sorted(get_random_ips(p2p_count + hns_count * spokes_per_hub[1], rng))
+    topologies = []
+    device_index = 0
+    while len(topologies) < p2p_count:
+        device, interface = devices[device_index % device_count]
+        device_index += 1
+        for _ in range(min(rng.randint(*spokes_per_hub), p2p_count - len(topologies))):
+            endpoints = [get_extranet_endpoint(extranet_ips.pop(), "PEER", rng),
+                         get_device_endpoint(device, interface, "PEER", rng)]
+            topologies.append(get_topology(f"p2p-topology-{len(topologies):03d}", True, endpoints, conflict_rate, rng))
+    for i in range(hns_count):
+        device, interface = devices[rng.randrange(device_count)]
+        endpoints = [get_device_endpoint(device, interface, "HUB", rng)]
+        endpoints.extend(get_extranet_endpoint(extranet_ips.pop(), "SPOKE", rng)
+                         for _ in range(rng.randint(*spokes_per_hub)))
+        topologies.append(get_topology("test_hns_topology" if i == 0 else f"test_hns_topology_{i}", False, endpoints,
+                                       conflict_rate, rng))
+    return topologies
+
+
+def seed_topologies(fmc: FMC, api_pool: ThreadPoolExecutor, topologies: list[dict]) -> None:
+    """
+    Create the generated topologies on FMC in parallel using the shared thread pool.
+
+    :param fmc: FMC API object
+    :param api_pool: Thread pool used for sending requests
+    :param topologies: Topology objects from `generate_topologies`
+    """
+    execute_parallel_tasks([partial(create_topology, fmc, topology) for topology in topologies], api_pool)
 
 
 def delete_all_topologies(fmc: FMC, api_pool: ThreadPoolExecutor, p2p_only=False) -> None:
@@ -120,74 +271,134 @@ def delete_all_topologies(fmc: FMC, api_pool: ThreadPoolExecutor, p2p_only=False
     execute_parallel_tasks(delete_tasks, api_pool)
 
 
-def create_topology(fmc, extranet_ip: str, topology_name: str, p2p: bool) -> None:
+def create_topology(fmc: FMC, topology: dict) -> None:
     """
-    Create topology with device and extranet endpoints.
+    Create topology with its settings and endpoints.
 
-    :param p2p: Create P2P topology or HNS
     :param fmc: FMC API object
-    :param extranet_ip: IP of the extranet endpoint
-    :param topology_name: Name of topology
+    :param topology: Generated topology object
     """
-    topology_api = FTDS2SVPNs(fmc=fmc, name=topology_name, topologyType="POINT_TO_POINT" if p2p else "HUB_AND_SPOKE")
-    topology = topology_api.post()
+    topology_api = FTDS2SVPNs(fmc=fmc, name=topology["name"], topologyType=topology["topologyType"])
+    created_topology = topology_api.post()
 
-    create_test_topology_advanced_settings(fmc, topology_api, topology["advancedSettings"]["id"])
+    advanced_settings = dict(topology["advancedSettings"], id=created_topology["advancedSettings"]["id"])
+    advanced_settings_api = AdvancedSettings(fmc=fmc, **advanced_settings)
+    advanced_settings_api.vpn_policy(vpn_id=topology_api.id)
+    advanced_settings_api.put()
 
-    create_topology_ike_settings(fmc, topology_api)
+    create_topology_ike_settings(fmc, topology_api, topology["ikeSettings"])
 
-    create_topology_endpoints(fmc, extranet_ip, topology_api, p2p)
+    create_topology_endpoints(fmc, topology_api, topology["endpoints"])
 
 
-def create_topology_endpoints(fmc: FMC, extranet_ip: str, topology_api: FTDS2SVPNs, p2p: bool) -> None:
+def create_topology_endpoints(fmc: FMC, topology_api: FTDS2SVPNs, endpoints: list[dict]) -> None:
     """
-    Create device and extranet endpoints
+    Create the endpoints in bulk.
 
-    :param p2p: Create p2p endpoints or hns
     :param fmc: FMC API object
-    :param extranet_ip: IP of the extranet endpoint
     :param topology_api: Topology API object
+    :param endpoints: Generated endpoint objects
     """
-    ftd = {"peerType": "PEER" if p2p else "HUB",
-           "device": FTD_DEVICE_,
-           "interface": FTD_INTERFACE,
-           "protectedNetworks": PROTECTED_NETWORKS}
-    extranet = {"peerType": "PEER" if p2p else "SPOKE", "extranet": True,
-                "extranetInfo": {"name": extranet_ip, "ipAddress": extranet_ip},
-                "protectedNetworks": PROTECTED_NETWORKS}
-    for device in (extranet, ftd):
-        endpoints_api = Endpoints(fmc=fmc, **device)
-        endpoints_api.vpn_policy(vpn_id=topology_api.id)
-        endpoints_api.post()
+    bulk_endpoints_api_url = get_create_bulk_endpoints_url(fmc, topology_api.id)
+    endpoints_data = [{key: value for key, value in endpoint.items() if key != "id"} for endpoint in endpoints]
+    for chunk in get_post_data_chunks(endpoints_data):
+        fmc.send_to_api(method="post", url=bulk_endpoints_api_url, json_data=chunk)
 
 
-def create_topology_ike_settings(fmc: FMC, topology_api: FTDS2SVPNs):
+def create_topology_ike_settings(fmc: FMC, topology_api: FTDS2SVPNs, ike_settings: dict):
     """
     Create IKE settings
 
     :param fmc: FMC API object
     :param topology_api: Topology API object
+    :param ike_settings: Generated IKE settings object
     """
-    ike_settings = {"authenticationType": "MANUAL_PRE_SHARED_KEY", "enforceHexBasedPreSharedKeyOnly": False,
-                    "manualPreSharedKey": ["Cisco@123-Collab", "Cisco@123-Switching"][randint(0, 1)],
-                    "policies": IKE_POLICIES}
-
-    ike_settings_api = IKESettings(fmc=fmc, ikeV2Settings=ike_settings,
+    ike_settings_api = IKESettings(fmc=fmc, ikeV2Settings=ike_settings["ikeV2Settings"],
                                    id=getattr(topology_api, "ikeSettings")["id"])
     ike_settings_api.vpn_policy(vpn_id=topology_api.id)
     ike_settings_api.put()
 
 
-def get_random_ips(count: int) -> set[str]:
+def get_page_cassette_entries(path: str, items: list[dict], limit: int, latency: float) -> list[dict]:
+    """
+    Get the responses of the pages of a FMC API list as read by `iter_fmc_items`.
+
+    :param path: List path without query string
+    :param items: All items of the list
+    :param limit: Items per page
+    :param latency: Simulated round trip time of each request in seconds
+    :return: Cassette entry of each page
+    """
+    pages = max(1, -(-len(items) // limit))
+    entries = []
+    for page in range(pages):
+        offset = page * limit
+        paging = {"offset": offset, "limit": limit, "count": len(items), "pages": pages}
+        if page + 1 < pages:
+            paging["next"] = [f"{path}?offset={offset + limit}&limit={limit}&expanded=true"]
+        entries.append(get_cassette_entry("GET", f"{path}?expanded=true&limit={limit}&offset={offset}",
+                                          {"items": items[offset:offset + limit], "paging": paging},
+                                          elapsed=latency, repeatable=True))
+    return entries
+
+
+def write_inventory_cassette(cassette_path: str, topologies: list[dict], latency: float = 0.0,
+                             limit: int = FMC_PAGE_LIMIT) -> None:
+    """
+    Seed the topologies into the local FMC stand-in, i.e. write the responses FMC would give for them as a cassette
+        served by `FMCReplayAdapter` (`FMC_REPLAY_PATH`). The responses are repeatable so that any number of sessions
+        can fetch the inventory. The lists are written page by page.
+
+    :param cassette_path: Path of the cassette
+    :param topologies: Topology objects from `generate_topologies`
+    :param latency: Simulated round trip time of each request in seconds
+    :param limit: Items per page of the lists (the `limit` of the FMC API object)
+    """
+    domain_url = f"/api/fmc_config/v1/domain/{STAND_IN_DOMAIN['uuid']}"
+    topologies_url = f"{domain_url}/policy/ftds2svpns"
+    devices = {endpoint["device"]["id"]: endpoint["device"]
+               for topology in topologies for endpoint in topology["endpoints"] if not endpoint["extranet"]}
+    token_headers = {"X-auth-access-token": "REDACTED", "X-auth-refresh-token": "REDACTED",
+                     "DOMAIN_UUID": STAND_IN_DOMAIN["uuid"], "DOMAINS": json.dumps([STAND_IN_DOMAIN])}
+    entries = [
+        get_cassette_entry("POST", "/api/fmc_platform/v1/auth/generatetoken", {}, 204, token_headers, latency,
+                           repeatable=True),
+        get_cassette_entry("GET", "/api/fmc_platform/v1/info/serverversion",
+                           {"items": [{"serverVersion": "7.0.0", "vdbVersion": "0", "sruVersion": "0",
+                                       "geoVersion": "0", "type": "ServerVersion"}]}, elapsed=latency,
+                           repeatable=True),
+        get_cassette_entry("GET", f"{domain_url}/devices/devicerecords",
+                           {"items": list(devices.values()), "paging": {"count": len(devices)}}, elapsed=latency,
+                           repeatable=True),
+    ]
+    topology_items = []
+    for topology in topologies:
+        topology_url = f"{topologies_url}/{topology['id']}"
+        topology_item = {key: value for key, value in topology.items() if key not in {"ikeSettings", "endpoints"}}
+        topology_item["ikeSettings"] = {"id": topology["ikeSettings"]["id"], "type": "IkeSetting",
+                                        "links": {"self": f"{topology_url}/ikesettings"}}
+        topology_item["endpoints"] = {"type": "EndPoint", "links": {"self": f"{topology_url}/endpoints"}}
+        topology_items.append(topology_item)
+        entries += get_page_cassette_entries(f"{topology_url}/endpoints", topology["endpoints"], limit, latency)
+        entries += get_page_cassette_entries(f"{topology_url}/ikesettings", [topology["ikeSettings"]], limit, latency)
+    entries += get_page_cassette_entries(topologies_url, topology_items, limit, latency)
+    with open(cassette_path, "w") as cassette:
+        for entry in entries:
+            cassette.write(json.dumps(entry) + "\n")
+
+
+def get_random_ips(count: int, rng: Optional[Random] = None) -> set[str]:
     """
     Create set of random IPs (0.0.0.0 - 255.255.255.255)
     :param count: Number of IPs
+    :param rng: Random generator
     :return: IP set
     """
+    rng = rng or Random()
     random_ips: set[str] = set()
     for _ in range(count):
         while True:
-            random_number = randint(1, 0xffffffff)
+            random_number = rng.randint(1, 0xffffffff)
             random_ip = socket.inet_ntoa(struct.pack('>I', random_number))
             if random_ip not in random_ips:
                 break
@@ -197,7 +408,22 @@ def get_random_ips(count: int) -> set[str]:
 
 if __name__ == "__main__":
     """Delete all topologies and recreate test p2p and hns topologies"""
-    with ThreadPoolExecutor(max_workers=8)  as api_pool:
-        with FMC(host=FMC_HOST, username=FMC_USER, password=FMC_PASSWORD, autodeploy=False) as fmc:
-            fmc.TOO_MANY_CONNECTIONS_TIMEOUT = 5
-            recreate_test_topologies(fmc=fmc, api_pool=api_pool, count=5, p2p_only=False)
+    parser = ArgumentParser(description="Delete all topologies and recreate test p2p and hns topologies")
+    parser.add_argument("--count", type=int, default=5, help="Number of point-to-point topologies")
+    parser.add_argument("--devices", type=int, default=1, help="Number of hub devices (>1 only for the stand-in)")
+    parser.add_argument("--spokes-per-hub", type=int, nargs=2, default=(1, 5), metavar=("MIN", "MAX"))
+    parser.add_argument("--conflict-rate", type=float, default=0.5)
+    parser.add_argument("--hns-count", type=int, default=1, help="Number of hub-and-spoke topologies")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--cassette", help="Write the inventory for the local FMC stand-in instead of FMC")
+    args = parser.parse_args()
+    generated_topologies = generate_topologies(args.count, args.devices, tuple(args.spokes_per_hub),
+                                               args.conflict_rate, args.hns_count, args.seed)
+    if args.cassette:
+        write_inventory_cassette(args.cassette, generated_topologies)
+    else:
+        with ThreadPoolExecutor(max_workers=8) as api_pool:
+            with FMC(host=FMC_HOST, username=FMC_USER, password=FMC_PASSWORD, autodeploy=False) as fmc:
+                fmc.TOO_MANY_CONNECTIONS_TIMEOUT = 5
+                delete_all_topologies(fmc, api_pool, args.hns_count == 0)
+                seed_topologies(fmc, api_pool, generated_topologies)
@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+from inspect import signature
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+# Session store and merge journals of the test run, read by `app.constants` on import
+os.environ["FMCTOOL_DATA_DIR"] = mkdtemp(prefix="fmctool-tests-")
+for name in ("SESSION_STORE_PATH", "MERGE_JOURNAL_DIR", "FMC_RECORD_PATH", "FMC_REPLAY_PATH"):
+    os.environ.pop(name, None)
+
+import pytest
+from fmcapi import Endpoints
+
+from app.fmc_recorder import FMCReplayAdapter
+
+# The FMC API objects need the forked fmcapi (`vpn_policy(vpn_id=...)`, `check_server_version`)
+FORKED_FMCAPI = "vpn_id" in signature(Endpoints.vpn_policy).parameters
+
+
+def pytest_sessionfinish():
+    rmtree(os.environ["FMCTOOL_DATA_DIR"], ignore_errors=True)
+
+
+@pytest.fixture
+def replay(tmp_path):
+    """
+    Serve the FMC requests from a cassette instead of contacting FMC.
+
+    :return: Function taking the cassette entries (see `get_cassette_entry`) and returning the started adapter
+    """
+    adapters = []
+
+    def start_replay(entries: list[dict]) -> FMCReplayAdapter:
+        cassette_path = tmp_path / f"cassette-{len(adapters)}.jsonl"
+        cassette_path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+        adapters.append(FMCReplayAdapter(str(cassette_path), latency_scale=0).__enter__())
+        return adapters[-1]
+
+    yield start_replay
+    for adapter in reversed(adapters):
+        adapter.__exit__(None, None, None)
+
+
+@pytest.fixture
+def replay_fmc():
+    """
+    :return: Logged in FMC API object for the replayed FMC (skipped without the forked fmcapi)
+    """
+    if not FORKED_FMCAPI:
+        pytest.skip("Needs the forked fmcapi (vpn_policy(vpn_id=...))")
+    from app.fmc_utils import restore_fmc, limit_fmc_rate
+    fmc = restore_fmc({"host": "fmc.test", "username": "api", "access_token": "access", "refresh_token": "refresh",
+                       "token_creation_time": time(), "token_refreshes": 0, "global_uuid": "global",
+                       "all_domain": [{"uuid": "global", "name": "Global"}], "server_version": "7.0.0"})
+    limit_fmc_rate(fmc)
+    return fmc
@@ -0,0 +1,58 @@
+import pytest
+
+from app import api_utils
+from app.api_utils import load_session, save_session
+from app.session_store import session_store
+
+
+class StoredSession:
+    """
+    Session of the token restored in this worker process.
+    """
+
+    def __init__(self, token: str, state: dict):
+        self.token = token
+        self.state = state
+        self.saved_state = state
+        self.applied_states = []
+
+    def get_state(self) -> dict:
+        return self.state
+
+    def apply_state(self, state: dict) -> None:
+        self.applied_states.append(state)
+        self.state = state
+
+
+@pytest.fixture
+def stored_session(monkeypatch):
+    token = "catch-up-token"
+    state = {"domain_id": "global"}
+    fmc_session = StoredSession(token, state)
+    monkeypatch.setitem(api_utils.sessions, token, fmc_session)
+    monkeypatch.setitem(api_utils.session_versions, token, session_store.save_session(token, state))
+    return fmc_session
+
+
+def test_load_session_catches_up(stored_session):
+    assert load_session(stored_session.token) is stored_session
+    assert stored_session.applied_states == []
+    # Saved by other worker process
+    session_store.save_session(stored_session.token, {"domain_id": "other"})
+    assert load_session(stored_session.token) is stored_session
+    assert stored_session.applied_states == [{"domain_id": "other"}]
+    load_session(stored_session.token)
+    assert len(stored_session.applied_states) == 1
+
+
+def test_own_save_is_not_reloaded(stored_session):
+    stored_session.state = {"domain_id": "changed"}
+    save_session(stored_session)
+    assert session_store.load_session(stored_session.token)[0] == {"domain_id": "changed"}
+    load_session(stored_session.token)
+    assert stored_session.applied_states == []
+
+
+def test_load_session_unknown_token():
+    with pytest.raises(KeyError):
+        load_session("unknown-token")
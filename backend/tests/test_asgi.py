@@ -0,0 +1,107 @@
+import asyncio
+import sys
+from types import ModuleType
+
+import httpx
+from fastapi import FastAPI
+
+from app.asgi import LazyApp
+
+
+async def get_responses(app: LazyApp, *paths: str) -> list[httpx.Response]:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://backend") as client:
+        return [await client.get(path) for path in paths]
+
+
+def test_unavailable_until_loaded(monkeypatch):
+    module = ModuleType("lazy_loaded_app")
+    module.app = FastAPI()
+    module.app.get("/ready")(lambda: {"ready": True})
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    lazy_app = LazyApp(f"{module.__name__}:app")
+
+    async def run():
+        before = await get_responses(lazy_app, "/health", "/ready", "/login")
+        await lazy_app.load()
+        return before, await get_responses(lazy_app, "/ready")
+
+    (health, ready, login), (loaded_ready,) = asyncio.run(run())
+    assert health.status_code == 200 and health.json() == {"ready": False}
+    assert ready.status_code == login.status_code == 503
+    assert ready.headers["retry-after"] == "1"
+    assert loaded_ready.status_code == 200 and loaded_ready.json() == {"ready": True}
+
+
+def test_failed_load_is_reported():
+    lazy_app = LazyApp("app.missing_module:app")
+
+    async def run():
+        lazy_app.load_task = asyncio.create_task(lazy_app.load())
+        await asyncio.wait([lazy_app.load_task])
+        return await get_responses(lazy_app, "/ready")
+
+    (ready,) = asyncio.run(run())
+    assert ready.status_code == 500
+    assert "missing_module" in ready.json()["error"]
+
+
+def test_shutdown_after_failed_startup(monkeypatch):
+    module = ModuleType("lazy_failing_app")
+    module.app = FastAPI()
+    handled_events = []
+    module.app.on_event("startup")(lambda: handled_events.append("capture started"))
+
+    @module.app.on_event("startup")
+    def fail():
+        raise RuntimeError("startup failed")
+
+    module.app.on_event("shutdown")(lambda: handled_events.append("capture stopped"))
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    lazy_app = LazyApp(f"{module.__name__}:app")
+
+    async def run():
+        events = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+            if message["type"] == "lifespan.startup.complete":
+                await asyncio.wait([lazy_app.load_task])
+                await events.put({"type": "lifespan.shutdown"})
+
+        await events.put({"type": "lifespan.startup"})
+        await lazy_app({"type": "lifespan"}, events.get, send)
+        return sent
+
+    assert asyncio.run(run()) == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert handled_events == ["capture started", "capture stopped"]
+    assert "startup failed" in repr(lazy_app.get_load_error())
+
+
+def test_websocket_closed_until_loaded():
+    lazy_app = LazyApp("lazy_unloaded_app:app")
+    sent = []
+
+    async def receive():
+        return {"type": "websocket.connect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(lazy_app({"type": "websocket", "path": "/events"}, receive, send))
+    assert sent == [{"type": "websocket.close", "code": 1013}]
+
+
+def test_cancelled_load_is_reported():
+    lazy_app = LazyApp("lazy_unloaded_app:app")
+
+    async def run():
+        lazy_app.load_task = asyncio.create_task(asyncio.sleep(10))
+        await asyncio.sleep(0)
+        lazy_app.load_task.cancel()
+        await asyncio.wait([lazy_app.load_task])
+        return await get_responses(lazy_app, "/ready")
+
+    (ready,) = asyncio.run(run())
+    assert ready.status_code == 500
+    assert "cancelled" in ready.json()["error"]
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+from app.batch_merge import plan_batch_merge, get_majority_override, get_unique_topology_name, get_topology_names
+from app.constants import CONFLICT_IGNORED_KEYS
+from app.merge_journal import MergeJournal
+from app.utils import get_dict_diff
+
+
+def get_p2p_topology(topology_id: str, hub_device_id: str, spoke_device_id: str) -> dict:
+    return {"id": topology_id, "name": f"P2P-{topology_id}",
+            "endpoints": [{"extranet": False, "device": {"id": device_id, "name": f"name-{device_id}"}}
+                          for device_id in (hub_device_id, spoke_device_id)]}
+
+
+def get_p2p_topologies(*topologies: dict) -> dict[str, list[dict]]:
+    p2p_topologies = {}
+    for topology in topologies:
+        for endpoint in topology["endpoints"]:
+            p2p_topologies.setdefault(endpoint["device"]["id"], []).append(topology)
+    return p2p_topologies
+
+
+def test_plan_batch_merge():
+    p2p_topologies = get_p2p_topologies(get_p2p_topology("t1", "hub1", "s1"), get_p2p_topology("t2", "hub1", "s2"),
+                                        get_p2p_topology("t3", "hub1", "hub2"), get_p2p_topology("t4", "hub2", "s3"),
+                                        get_p2p_topology("t5", "hub2", "s4"))
+    # The busiest device first, each topology planned once
+    assert plan_batch_merge(p2p_topologies) == [
+        {"hub_device_id": "hub1", "hub_device_name": "name-hub1", "p2p_topology_ids": ["t1", "t2", "t3"]},
+        {"hub_device_id": "hub2", "hub_device_name": "name-hub2", "p2p_topology_ids": ["t4", "t5"]}]
+    assert [plan["p2p_topology_ids"] for plan in plan_batch_merge(p2p_topologies, ["hub2", "hub1"])] == [
+        ["t3", "t4", "t5"], ["t1", "t2"]]
+    assert [plan["hub_device_id"] for plan in plan_batch_merge(p2p_topologies, min_topologies=3)] == ["hub1"]
+
+
+def test_majority_override():
+    topologies = [{"ikeSettings": {"lifetime": 86400, "policies": [{"id": "p1"}], "mode": "main"}},
+                  {"ikeSettings": {"lifetime": 3600, "policies": [{"id": "p2"}], "mode": "aggressive"}},
+                  {"ikeSettings": {"lifetime": 3600, "policies": [{"id": "p1"}], "mode": "main"}},
+                  {"ikeSettings": {"lifetime": 86400, "policies": [{"id": "p1"}], "mode": "aggressive"}}]
+    conflicts = get_dict_diff(topologies, CONFLICT_IGNORED_KEYS)
+    assert get_majority_override(topologies, conflicts) == {
+        # Tie resolved by the first topology, lists by their union
+        "ikeSettings": {"lifetime": 86400, "policies": [{"id": "p1"}, {"id": "p2"}], "mode": "main"}}
+    assert get_majority_override(topologies[1:], get_dict_diff(topologies[1:], CONFLICT_IGNORED_KEYS)) == {
+        "ikeSettings": {"lifetime": 3600, "policies": [{"id": "p2"}, {"id": "p1"}], "mode": "aggressive"}}
+
+
+def test_unique_topology_names():
+    p2p_topology = get_p2p_topology("t1", "hub1", "s1")
+    fmc_session = SimpleNamespace(p2p_topologies=get_p2p_topologies(p2p_topology),
+                                  get_merge_targets=lambda: [{"name": "HNS-hub1"}],
+                                  fmc=SimpleNamespace(host="batch.test", uuid="global"))
+    for topology_name, rolled_back in (("HNS-hub1-3", False), ("HNS-hub1-4", True)):
+        journal = MergeJournal.begin(host="batch.test", domain_id="global", hns_topology_id=None,
+                                     topology_name=topology_name)
+        if rolled_back:
+            journal.record("rolled_back")
+    taken_names = get_topology_names(fmc_session)
+    assert taken_names == {"P2P-t1", "HNS-hub1", "HNS-hub1-3"}
+    assert [get_unique_topology_name("HNS-hub1", taken_names) for _ in range(3)] == [
+        "HNS-hub1-2", "HNS-hub1-4", "HNS-hub1-5"]
+    assert get_unique_topology_name("HNS-hub2", taken_names) == "HNS-hub2"
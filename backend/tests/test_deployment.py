@@ -0,0 +1,87 @@
+import asyncio
+from threading import Thread
+from time import sleep
+from types import SimpleNamespace
+
+from app import deployment
+from app.deployment import DeploymentJob, DeploymentQueue, aiter_stored_phases, deploy_jobs
+
+FMC = SimpleNamespace(host="fmc.test", uuid="global", username="api")
+
+
+def get_job(topology_id: str, device_id: str, fmc: SimpleNamespace = FMC) -> DeploymentJob:
+    return DeploymentJob(fmc, None, [topology_id], {device_id})
+
+
+def test_queue_coalesces_jobs(monkeypatch):
+    monkeypatch.setattr(deployment, "DEPLOY_COALESCE_SECONDS", 0.1)
+    queue = DeploymentQueue()
+    deployed_batches = []
+    late_job = get_job("p3", "d3")
+
+    def deploy(jobs):
+        if not deployed_batches:
+            # Queued while deploying, hence in the next batch
+            queue.submit(late_job)
+        deployed_batches.append(jobs)
+
+    monkeypatch.setattr(deployment, "deploy_jobs", deploy)
+    first_job, second_job = get_job("p1", "d1"), get_job("p2", "d2")
+    queue.submit(first_job)
+    worker = queue.worker
+    queue.submit(second_job)
+    assert queue.worker is worker
+    worker.join(5)
+    assert deployed_batches == [[first_job, second_job], [late_job]]
+    assert queue.worker is None
+
+
+def test_combined_deployment(monkeypatch):
+    calls = {}
+    monkeypatch.setattr(deployment, "DEPLOY_POLL_INITIAL_SECONDS", 0)
+    monkeypatch.setattr(deployment, "delete_p2p_topology_ids",
+                        lambda topology_ids, fmc, api_pool: calls.setdefault("deleted", []).extend(topology_ids))
+    monkeypatch.setattr(deployment, "start_deployment",
+                        lambda fmc, device_ids: calls.setdefault("deployed", device_ids) and "task1")
+    statuses = iter(["Deploying", "Deploying", "Deployed"])
+    monkeypatch.setattr(deployment, "get_deployment_status", lambda fmc, task_id: next(statuses))
+    jobs = [get_job("p1", "d1"), get_job("p2", "d2")]
+    deploy_jobs(jobs)
+    assert calls == {"deleted": ["p1", "p2"], "deployed": {"d1", "d2"}}
+    for job in jobs:
+        assert job.done
+        assert [phase["phase"] for phase in job.phases] == ["queued", "deleting", "deploying", "Deploying", "deployed"]
+
+
+def test_deployment_per_user(monkeypatch):
+    monkeypatch.setattr(deployment, "DEPLOY_POLL_INITIAL_SECONDS", 0)
+    deleted, deployed = [], []
+    monkeypatch.setattr(deployment, "delete_p2p_topology_ids",
+                        lambda topology_ids, fmc, api_pool: deleted.append((fmc.username, topology_ids)))
+    monkeypatch.setattr(deployment, "start_deployment",
+                        lambda fmc, device_ids: deployed.append((fmc.username, device_ids)) or f"task-{fmc.username}")
+    monkeypatch.setattr(deployment, "get_deployment_status", lambda fmc, task_id: "Deployed")
+    other_fmc = SimpleNamespace(host=FMC.host, uuid=FMC.uuid, username="other")
+    jobs = [get_job("p1", "d1"), get_job("p2", "d2", other_fmc), get_job("p3", "d3")]
+    deploy_jobs(jobs)
+    assert deleted == [("api", ["p1"]), ("other", ["p2"]), ("api", ["p3"])]
+    assert deployed == [("api", {"d1", "d3"}), ("other", {"d2"})]
+    assert all(job.done for job in jobs)
+
+
+def test_phases_are_streamed_to_async_listeners():
+    job = get_job("p1", "d1")
+
+    def run():
+        sleep(0.1)
+        job.set_phase("deleting")
+        sleep(0.1)
+        job.set_phase("deployed", "Deployed", True)
+
+    async def listen():
+        Thread(target=run).start()
+        return [phase["phase"] async for phase in job.aiter_phases()], \
+            [phase["phase"] async for phase in aiter_stored_phases(job.job_id)]
+
+    assert asyncio.run(listen()) == (["queued", "deleting", "deployed"], ["queued", "deleting", "deployed"])
+    assert not job.listeners
@@ -0,0 +1,35 @@
+import pytest
+import requests
+from requests.exceptions import ConnectionError
+
+from app.fmc_recorder import get_cassette_entry
+
+
+def test_replay_matches_pages(replay):
+    replay([get_cassette_entry("GET", "/list?limit=2&offset=0", {"items": [1, 2]}),
+            get_cassette_entry("GET", "/list?limit=2&offset=2", {"items": [3]})])
+    assert requests.get("https://fmc.test/list?limit=2&offset=2").json() == {"items": [3]}
+    assert requests.get("https://fmc.test/list?limit=2&offset=0").json() == {"items": [1, 2]}
+    # Served once, the page must not be repeated forever
+    with pytest.raises(ConnectionError):
+        requests.get("https://fmc.test/list?limit=2&offset=2")
+
+
+def test_replay_entry_without_query_serves_first_page(replay):
+    replay([get_cassette_entry("GET", "/list", {"items": [1]})])
+    with pytest.raises(ConnectionError):
+        requests.get("https://fmc.test/list?limit=2&offset=2")
+    assert requests.get("https://fmc.test/list?expanded=true&limit=2").json() == {"items": [1]}
+
+
+def test_replay_repeatable_entry(replay):
+    adapter = replay([get_cassette_entry("GET", "/serverversion", {"items": []}, repeatable=True)])
+    for _ in range(3):
+        assert requests.get("https://fmc.test/serverversion").status_code == 200
+    assert adapter.last_served[("GET", "/serverversion")]["repeatable"]
+
+
+def test_replay_streamed_response(replay):
+    replay([get_cassette_entry("GET", "/list", {"items": [1, 2]})])
+    with requests.get("https://fmc.test/list", stream=True) as response:
+        assert b"".join(response.iter_content(4)) == b'{"items": [1, 2]}'
@@ -0,0 +1,193 @@
+from concurrent.futures import wait
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+from app import fmc_session as fmc_session_module
+from app.fmc_session import FMCSession
+from app.merge_journal import MergeJournal
+from app.session_store import session_store
+
+DOMAINS = [{"uuid": "d1", "name": "Global"}, {"uuid": "d2", "name": "Global/Leaf"}]
+
+
+def get_inventory(device_id: str) -> dict:
+    return {"p2p_topologies": {device_id: [{"id": f"p2p-{device_id}"}]}, "hns_topologies": [], "mesh_topologies": []}
+
+
+@pytest.fixture
+def fmc_session(monkeypatch):
+    """
+    :return: Session restored in this worker process with the inventory of both domains fetched
+    """
+    fmc = SimpleNamespace(uuid=None, domain=None, mytoken=SimpleNamespace(all_domain=DOMAINS), build_urls=lambda: None)
+    monkeypatch.setattr(fmc_session_module, "restore_fmc", lambda fmc_state: fmc)
+    monkeypatch.setattr(fmc_session_module, "limit_fmc_rate", lambda fmc, budget=None: None)
+    monkeypatch.setattr(fmc_session_module, "hedge_fmc_gets", lambda fmc: None)
+    monkeypatch.setattr(fmc_session_module, "get_fmc_state", lambda fmc: {})
+    fetched = []
+    monkeypatch.setattr(fmc_session_module, "fetch_to_device_p2p_topologies",
+                        lambda pending_futures, p2p_topologies, device_id, api_pool, fmc: fetched.append(
+                            (fmc.uuid, device_id, pending_futures)))
+    fmc_session = FMCSession("workspace-token", state={"fmc": {}, "domain_id": None})
+    fmc_session.inventories = {"d1": get_inventory("hub1"), "d2": get_inventory("hub2")}
+    fmc_session.fetched = fetched
+    yield fmc_session
+    fmc_session.api_pool.shutdown()
+
+
+def test_workspaces_are_isolated(fmc_session):
+    fmc_session.set_domain("d1")
+    first, second = fmc_session.get_workspace("first"), fmc_session.get_workspace("second")
+    assert fmc_session.get_workspace("first") is first
+    first.set_hub_device_id("hub1")
+    assert (first.hub_device_id, second.hub_device_id) == ("hub1", None)
+    assert fmc_session.fetched == [("d1", "hub1", first.pending_futures)]
+    assert first.pending_futures is not second.pending_futures
+    # The inventory fetch is shared
+    assert first.pending_futures["topologies"] is second.pending_futures["topologies"]
+    assert session_store.get_task_status(fmc_session.get_task_key("device_p2p_topologies", "d1", "first"))[0] == "done"
+    assert session_store.get_task_status(fmc_session.get_task_key("device_p2p_topologies", "d1", "second")) is None
+    fmc_session.remove_workspace("first")
+    assert list(fmc_session.workspaces) == ["second"]
+
+
+def test_workspaces_are_kept_per_domain(fmc_session):
+    fmc_session.set_domain("d1")
+    first = fmc_session.get_workspace("first")
+    fmc_session.set_domain("d2")
+    assert fmc_session.workspaces == {}
+    fmc_session.get_workspace("second").set_hub_device_id("hub2")
+    assert list(fmc_session.get_state()["workspaces"]) == ["second"]
+    fmc_session.set_domain("d1")
+    assert fmc_session.workspaces == {"first": first}
+    assert fmc_session.p2p_topologies == get_inventory("hub1")["p2p_topologies"]
+
+
+@pytest.mark.parametrize("endpoint_chunks, round_trips", [(2, {"critical_path": 3, "saved": 1}),
+                                                           (0, {"critical_path": 2, "saved": 2})])
+def test_merge_round_trips(fmc_session, monkeypatch, tmp_path, endpoint_chunks, round_trips):
+    base_topology = {"name": "HNS", "ikeSettings": {}, "ipsecSettings": {}, "advancedSettings": {}}
+    monkeypatch.setattr(fmc_session_module, "get_base_hns_topology", lambda *args: base_topology)
+    monkeypatch.setattr(fmc_session_module, "create_topology", lambda topology, fmc: {"id": "hns1", "name": "HNS"})
+    monkeypatch.setattr(fmc_session_module, "get_ike_settings", lambda fmc, topology_id, topology: {"id": "ike1"})
+    monkeypatch.setattr(fmc_session_module, "post_topology_settings",
+                        lambda fmc, topology_id, topology, key_name, policy_service: {"id": key_name})
+
+    def set_endpoints_future(*args):
+        submit_task, journal = args[9], args[10]
+        created_endpoints = list(journal.created_endpoints)
+        for key in (f"e{index}" for index in range(endpoint_chunks)):
+            def set_endpoints(response, endpoint_keys=[key]):
+                journal.record("endpoints", endpoint_keys=endpoint_keys, items=response["items"])
+                created_endpoints.extend(response["items"])
+
+            if key not in journal.created_endpoint_keys:
+                submit_task(lambda key=key: {"items": [{"id": key}]}, callback=set_endpoints)
+        return created_endpoints
+
+    monkeypatch.setattr(fmc_session_module, "set_endpoints_future", set_endpoints_future)
+    fmc_session.hns_topologies, fmc_session.mesh_topologies = [], []
+    journal = MergeJournal(tmp_path / "merge.jsonl")
+    merged_topology = fmc_session.merge_hns_topology("HNS", ["p1"], {}, None, "hub1", journal, verify=False)
+    assert merged_topology["round_trips"] == round_trips
+    assert len(merged_topology["endpoints"]) == endpoint_chunks
+    # Resumed after completion, the writes are skipped
+    resumed_topology = fmc_session.merge_hns_topology("HNS", ["p1"], {}, None, "hub1", journal, verify=False)
+    assert resumed_topology["round_trips"] == {"critical_path": 0, "saved": 1}
+
+
+def get_fetched_topologies(device_id: str) -> dict[str, list[dict]]:
+    return {"POINT_TO_POINT": [{"id": f"p2p-{device_id}", "endpoints": [
+        {"extranet": False, "device": {"id": device_id}}, {"extranet": True, "extranetInfo": {"name": "peer"}}]}],
+            "HUB_AND_SPOKE": [{"id": f"hns-{device_id}"}]}
+
+
+@pytest.fixture
+def prefetched_domains(fmc_session, monkeypatch):
+    """
+    :return: Domain UUID and FMC API object map of the prefetches ("domain_fmcs"), released by setting "fetched"
+    """
+    domain_fmcs = {}
+    fetched = Event()
+
+    def get_domain_fmc(fmc, domain_id, budget=None):
+        domain_fmcs[domain_id] = SimpleNamespace(uuid=domain_id, budget=budget)
+        return domain_fmcs[domain_id]
+
+    def fetch_inventory(domain_fmc, api_pool, use_snapshot=False):
+        fetched.wait(5)
+        return get_fetched_topologies(f"hub-{domain_fmc.uuid}")
+
+    monkeypatch.setattr(fmc_session_module, "get_domain_fmc", get_domain_fmc)
+    monkeypatch.setattr(fmc_session, "fetch_inventory", fetch_inventory)
+    return SimpleNamespace(domain_fmcs=domain_fmcs, fetched=fetched)
+
+
+def test_prefetch_domains(fmc_session, prefetched_domains):
+    fmc_session.inventories = {"d1": get_inventory("hub1")}
+    prefetched_domains.fetched.set()
+    fmc_session.prefetch_domains()
+    wait(fmc_session.prefetch_futures.values())
+    # Already fetched domains are skipped
+    assert list(prefetched_domains.domain_fmcs) == ["d2"]
+    assert prefetched_domains.domain_fmcs["d2"].budget is fmc_session.prefetch_budget
+    assert fmc_session.inventories["d2"] == {"p2p_topologies": {"hub-d2": get_fetched_topologies("hub-d2")[
+        "POINT_TO_POINT"]}, "hns_topologies": [{"id": "hns-hub-d2"}], "mesh_topologies": []}
+    # Not the current domain
+    assert fmc_session.p2p_topologies is None
+
+
+def test_domain_selected_while_prefetching(fmc_session, prefetched_domains):
+    fmc_session.inventories = {}
+    fmc_session.prefetch_domains(low_priority=False)
+    fmc_session.set_domain("d2")
+    assert fmc_session.prefetch_futures["d2"] in fmc_session.pending_futures["topologies"]
+    prefetched_domains.fetched.set()
+    wait(fmc_session.pending_futures["topologies"])
+    assert prefetched_domains.domain_fmcs["d2"].budget is None
+    assert list(fmc_session.p2p_topologies) == ["hub-d2"]
+
+
+def get_settings_topology(topology_id: str, device_id: str, lifetime: int, fetched: bool = True) -> dict:
+    return {"id": topology_id, "name": f"P2P-{topology_id}", "topologyType": "POINT_TO_POINT",
+            "ikeSettings": {"ikeV2Settings": {"lifetime": lifetime}} if fetched else {"links": {"self": "url"}},
+            "ipsecSettings": {"lifetime": 3600}, "endpoints": [{"extranet": False, "device": {"id": device_id}}]}
+
+
+def test_device_settings_groups(fmc_session, monkeypatch):
+    fetched_devices = []
+
+    class DeviceRecords:
+        def __init__(self, fmc):
+            pass
+
+        def get(self):
+            fetched_devices.append(len(fetched_devices))
+            return {"items": [{"id": "hub1", "name": "hub1"}, {"id": "hub2", "name": "hub2"}, {"id": "spoke"}]}
+
+    monkeypatch.setattr(fmc_session_module, "DeviceRecords", DeviceRecords)
+    fmc_session.inventories = {"d1": {
+        "p2p_topologies": {"hub1": [get_settings_topology("t1", "hub1", 100), get_settings_topology("t2", "hub1", 200),
+                                    {**get_settings_topology("t3", "hub1", 100), "name": "other"}],
+                           "hub2": [get_settings_topology("t4", "hub2", 100),
+                                    get_settings_topology("t5", "hub2", 100, fetched=False)]},
+        "hns_topologies": [{"id": "hns1", "endpoints": [{"extranet": False, "device": {"id": "hub1"}},
+                                                        {"extranet": True, "extranetInfo": {"name": "peer"}}]}],
+        "mesh_topologies": [{"id": "mesh1", "endpoints": [{"extranet": False, "device": {"id": "hub1"}},
+                                                          {"extranet": False, "device": {"id": "spoke"}}]}]}}
+    # Counts unknown until the topologies are fetched
+    fmc_session.fmc.uuid = "d1"
+    assert [device["vpn"] for device in fmc_session.get_registered_devices()] == [
+        {"p2pTopologies": None, "hnsTopologies": None, "conflictGroups": None}] * 3
+    fmc_session.use_inventory("d1")
+    assert {device["id"]: device["vpn"] for device in fmc_session.get_registered_devices()} == {
+        # t1 and t3 differ only by name
+        "hub1": {"p2pTopologies": 3, "hnsTopologies": 2, "conflictGroups": 2},
+        # Until the IKE settings of t5 are fetched
+        "hub2": {"p2pTopologies": 2, "hnsTopologies": 0, "conflictGroups": None},
+        "spoke": {"p2pTopologies": 0, "hnsTopologies": 1, "conflictGroups": None}}
+    assert len(fetched_devices) == 1
+    fmc_session.get_registered_devices(refresh=True)
+    assert len(fetched_devices) == 2
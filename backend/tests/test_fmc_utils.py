@@ -0,0 +1,244 @@
+import json
+from collections import Counter
+from concurrent.futures.thread import ThreadPoolExecutor
+from threading import Lock
+from time import time, sleep, perf_counter
+from types import SimpleNamespace
+
+import pytest
+from fmcapi import Endpoints, IKESettings
+from requests.exceptions import HTTPError, ConnectionError
+
+from app import fmc_utils
+from app.fmc_recorder import get_cassette_entry, get_request_path, FMCReplayAdapter
+from app.fmc_utils import get_endpoint_key, get_verification_digest, verify_topology, iter_fmc_items, get_hedge_state, \
+    RestoredToken, get_mesh_endpoint_data_from_p2p, hedge_fmc_gets, limit_fmc_rate
+
+
+class PagedFMC:
+    """
+    The attributes of the FMC API object used by `iter_fmc_items`.
+    """
+    limit = 2
+    VERIFY_CERT = False
+    TOO_MANY_CONNECTIONS_TIMEOUT = 0
+
+    def __init__(self, host: str):
+        self.host = host
+        self.issued_tokens = []
+        self.mytoken = SimpleNamespace(access_token="expired", get_token=self.get_token)
+
+    def get_token(self) -> str:
+        if self.mytoken.access_token is None:
+            self.mytoken.access_token = f"token-{len(self.issued_tokens)}"
+            self.issued_tokens.append(self.mytoken.access_token)
+        return self.mytoken.access_token
+
+    def acquire_api_rate(self) -> None:
+        pass
+
+
+def get_page_entry(offset: int, items: list, status: int = 200, elapsed: float = 0.0) -> dict:
+    return get_cassette_entry("GET", f"/list?expanded=true&limit={PagedFMC.limit}&offset={offset}",
+                              {"items": items} if status == 200 else {"error": {}}, status, elapsed=elapsed)
+
+
+def get_endpoint(device_id: str, network_ids: list[str]) -> dict:
+    return {"name": device_id, "type": "EndPoint", "peerType": "PEER", "extranet": False,
+            "device": {"id": device_id, "type": "Device"}, "interface": {"id": f"i-{device_id}", "type": "Interface"},
+            "protectedNetworks": {"networks": [{"id": network_id, "type": "Network"} for network_id in network_ids]}}
+
+
+def get_read_back(endpoint: dict, endpoint_id: str) -> dict:
+    """
+    :return: The endpoint as listed by FMC (with ID, links and reordered networks)
+    """
+    return {**endpoint, "id": endpoint_id, "version": "7", "links": {"self": f"https://fmc.test/{endpoint_id}"},
+            "protectedNetworks": {"networks": list(reversed(endpoint["protectedNetworks"]["networks"]))}}
+
+
+def test_verification_digest_of_request_and_read_back():
+    endpoint = get_endpoint("d1", ["n1", "n2"])
+    assert get_verification_digest(endpoint, Endpoints) == get_verification_digest(get_read_back(endpoint, "e1"),
+                                                                                    Endpoints)
+    assert get_verification_digest(endpoint, Endpoints) != get_verification_digest(get_endpoint("d1", ["n1"]),
+                                                                                    Endpoints)
+    ike_settings = {"type": "IkeSetting", "ikeV2Settings": {"authenticationType": "MANUAL_PRE_SHARED_KEY",
+                                                            "manualPreSharedKey": "secret"}}
+    # FMC does not return the pre-shared keys
+    read_back_ike_settings = {"id": "ike1", "type": "IkeSetting",
+                              "ikeV2Settings": {"authenticationType": "MANUAL_PRE_SHARED_KEY"}}
+    assert get_verification_digest(ike_settings, IKESettings) == get_verification_digest(read_back_ike_settings,
+                                                                                          IKESettings)
+
+
+def test_verify_topology(replay, replay_fmc):
+    intended = [get_endpoint("d1", ["n1", "n2"]), get_endpoint("d2", ["n3"]), get_endpoint("d3", ["n4"])]
+    endpoint_digests = Counter((get_endpoint_key(endpoint), get_verification_digest(endpoint, Endpoints))
+                               for endpoint in intended)
+    # d2 changed on FMC, d3 missing and d4 not merged
+    listed = [get_read_back(intended[0], "e1"), get_read_back(get_endpoint("d2", ["n9"]), "e2"),
+              get_read_back(get_endpoint("d4", ["n5"]), "e4")]
+    endpoints_path = get_request_path(f"{replay_fmc.configuration_url}/policy/ftds2svpns/t1/endpoints")
+    replay([get_cassette_entry("GET", endpoints_path, {"items": listed, "paging": {"count": len(listed)}})])
+    with ThreadPoolExecutor(2) as api_pool:
+        verification = verify_topology(replay_fmc, api_pool, "t1", endpoint_digests, {})
+    assert not verification["verified"]
+    assert verification["expected_endpoints"] == 3 and verification["read_endpoints"] == 3
+    assert {mismatch["key"]: mismatch["problem"] for mismatch in verification["mismatched"]} == {
+        "device:d2:i-d2": "changed", "device:d3:i-d3": "missing", "device:d4:i-d4": "unexpected"}
+
+
+def test_verify_topology_match(replay, replay_fmc):
+    intended = [get_endpoint("d1", ["n1"]), get_endpoint("d2", ["n2", "n3"])]
+    endpoint_digests = Counter((get_endpoint_key(endpoint), get_verification_digest(endpoint, Endpoints))
+                               for endpoint in intended)
+    listed = [get_read_back(endpoint, f"e{index}") for index, endpoint in enumerate(intended)]
+    endpoints_path = get_request_path(f"{replay_fmc.configuration_url}/policy/ftds2svpns/t1/endpoints")
+    replay([get_cassette_entry("GET", endpoints_path, {"items": listed})])
+    with ThreadPoolExecutor(2) as api_pool:
+        verification = verify_topology(replay_fmc, api_pool, "t1", endpoint_digests, {})
+    assert verification == {"verified": True, "expected_endpoints": 2, "read_endpoints": 2, "mismatched": []}
+
+
+def test_iter_fmc_items_pages(replay):
+    fmc = PagedFMC("pages.test")
+    replay([get_page_entry(0, [], 401), get_page_entry(0, [1, 2]),
+            get_page_entry(2, [], 429), get_page_entry(2, [3, 4]),
+            # The retries are per page
+            get_page_entry(4, [], 429), get_page_entry(4, [], 429), get_page_entry(4, [5])])
+    assert list(iter_fmc_items(fmc, "https://pages.test/list")) == [1, 2, 3, 4, 5]
+    assert fmc.issued_tokens == ["token-0"]
+
+
+def test_iter_fmc_items_throttled(replay):
+    replay([get_page_entry(0, [], 429)] * 3)
+    with pytest.raises(HTTPError):
+        list(iter_fmc_items(PagedFMC("throttled.test"), "https://throttled.test/list"))
+
+
+def test_iter_fmc_items_hedged(tmp_path):
+    latencies, _ = get_hedge_state("hedged.test")
+    for _ in range(latencies.min_samples):
+        latencies.add(0.01)
+    cassette_path = tmp_path / "cassette.jsonl"
+    cassette_path.write_text("".join(json.dumps(entry) + "\n" for entry in [
+        get_page_entry(0, ["slow"], elapsed=2), get_page_entry(0, ["hedged"])]))
+    with FMCReplayAdapter(str(cassette_path)):
+        assert list(iter_fmc_items(PagedFMC("hedged.test"), "https://hedged.test/list")) == ["hedged"]
+    assert len(latencies.latencies) > latencies.min_samples
+
+
+def test_iter_fmc_items_inventory_cassette(tmp_path):
+    from recreate import generate_topologies, write_inventory_cassette, STAND_IN_DOMAIN
+    topologies = generate_topologies(5, hns_count=0, seed=1)
+    cassette_path = tmp_path / "inventory.jsonl"
+    write_inventory_cassette(str(cassette_path), topologies, limit=PagedFMC.limit)
+    topologies_url = f"https://fmc.test/api/fmc_config/v1/domain/{STAND_IN_DOMAIN['uuid']}/policy/ftds2svpns"
+    pages = [json.loads(entry["body"])["paging"] for entry in map(json.loads, cassette_path.read_text().splitlines())
+             if entry["path"].startswith(f"{get_request_path(topologies_url)}?")]
+    assert [(paging["offset"], paging["pages"], "next" in paging) for paging in pages] == [
+        (0, 3, True), (2, 3, True), (4, 3, False)]
+    with FMCReplayAdapter(str(cassette_path), latency_scale=0):
+        for _ in range(2):
+            assert [topology["id"] for topology in iter_fmc_items(PagedFMC("fmc.test"), topologies_url)] == [
+                topology["id"] for topology in topologies]
+
+
+def test_restored_token():
+    fmc_state = {"host": "fmc.test", "username": "api", "access_token": "access", "refresh_token": "refresh",
+                 "token_creation_time": time(), "token_refreshes": 1, "global_uuid": "global",
+                 "all_domain": [{"uuid": "global", "name": "Global"}], "server_version": "7.0.0"}
+    fmc = SimpleNamespace(host="fmc.test", username="api", VERIFY_CERT=False, timeout=5)
+    # Restored without logging in
+    token = RestoredToken(fmc, fmc_state)
+    assert token.get_token() == "access"
+    assert (token.refresh_token, token.token_refreshes, token.uuid) == ("refresh", 1, "global")
+    assert token.all_domain == fmc_state["all_domain"]
+
+
+def get_p2p_topology(topology_id: str, endpoints: list[dict]) -> dict:
+    return {"id": topology_id, "topologyType": "POINT_TO_POINT",
+            "endpoints": [{**endpoint, "id": f"{topology_id}-{index}"} for index, endpoint in enumerate(endpoints)]}
+
+
+def test_mesh_endpoints_deduplicated(replay_fmc):
+    hub = get_endpoint("d1", ["n1"])
+    p2p_topologies = {"d1": [get_p2p_topology("p1", [hub, get_endpoint("d2", ["n2"])]),
+                             get_p2p_topology("p2", [hub, get_endpoint("d2", ["n2"]), get_endpoint("d3", ["n3"])]),
+                             get_p2p_topology("p3", [hub, get_endpoint("d4", ["n4"])])]}
+    endpoints = list(get_mesh_endpoint_data_from_p2p(p2p_topologies, "d1", replay_fmc, "m1", ["p1", "p2"], [], None))
+    # Each distinct endpoint of the selected topologies once, as a peer
+    assert [get_endpoint_key(endpoint) for endpoint in endpoints] == ["device:d1:i-d1", "device:d2:i-d2",
+                                                                     "device:d3:i-d3"]
+    assert all(endpoint["peerType"] == "PEER" and "id" not in endpoint for endpoint in endpoints)
+
+
+def test_mesh_endpoints_skip_existing_target(replay_fmc):
+    existing_topology = {"id": "m1", "topologyType": "FULL_MESH",
+                         "endpoints": [{**get_endpoint("d1", ["n1"]), "id": "e1"}]}
+    hns_p2p_topologies = [get_p2p_topology("p1", [get_endpoint("d1", ["n1"]), get_endpoint("d2", ["n2"])])]
+    endpoints = get_mesh_endpoint_data_from_p2p({}, None, replay_fmc, "m1", ["p1"], hns_p2p_topologies,
+                                                existing_topology)
+    assert [get_endpoint_key(endpoint) for endpoint in endpoints] == ["device:d2:i-d2"]
+
+
+class ScriptedFMC:
+    """
+    FMC API object answering the calls with the scripted (seconds, response or exception) of each call in turn.
+    """
+
+    def __init__(self, host: str, script: list[tuple[float, object]]):
+        self.host = host
+        self.timeout = 180
+        self.script = script
+        self.calls = []
+        self.lock = Lock()
+
+    def send_to_api(self, method="", url="", headers="", json_data=None, more_items=None):
+        with self.lock:
+            self.calls.append((method, url, self.timeout))
+            seconds, response = self.script[min(len(self.calls), len(self.script)) - 1]
+        sleep(seconds)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def get_hedged_fmc(host: str, script: list[tuple[float, object]]) -> ScriptedFMC:
+    fmc = ScriptedFMC(host, script)
+    limit_fmc_rate(fmc)
+    hedge_fmc_gets(fmc)
+    return fmc
+
+
+def test_hedged_get_uses_first_response():
+    latencies, _ = get_hedge_state("hedge-get.test")
+    for _ in range(latencies.min_samples):
+        latencies.add(0.01)
+    fmc = get_hedged_fmc("hedge-get.test", [(2, "slow"), (0, "hedged")])
+    start = perf_counter()
+    assert fmc.send_to_api(method="get", url="https://hedge-get.test/item") == "hedged"
+    assert perf_counter() - start < 1
+    # Each attempt has its own deadline
+    assert [call[2] for call in fmc.calls] == [fmc_utils.FMC_GET_TIMEOUT_SECONDS] * 2
+
+
+def test_failed_get_is_retried(monkeypatch):
+    monkeypatch.setattr(fmc_utils, "FMC_GET_RETRY_BACKOFF_SECONDS", 0)
+    fmc = get_hedged_fmc("retry-get.test", [(0, ConnectionError("reset")), (0, ConnectionError("reset")), (0, "ok")])
+    assert fmc.send_to_api(method="get", url="https://retry-get.test/item") == "ok"
+    assert len(fmc.calls) == fmc_utils.FMC_GET_RETRIES + 1
+    failing_fmc = get_hedged_fmc("failing-get.test", [(0, ConnectionError("reset"))])
+    with pytest.raises(ConnectionError):
+        failing_fmc.send_to_api(method="get", url="https://failing-get.test/item")
+    assert len(failing_fmc.calls) == fmc_utils.FMC_GET_RETRIES + 1
+
+
+def test_other_calls_are_not_hedged():
+    fmc = get_hedged_fmc("unhedged.test", [(0, ConnectionError("reset"))])
+    with pytest.raises(ConnectionError):
+        fmc.send_to_api(method="post", url="https://unhedged.test/item", json_data={"name": "item"})
+    with pytest.raises(ConnectionError):
+        fmc.send_to_api(method="get", url="https://unhedged.test/list", more_items=["paged"])
+    assert fmc.calls == [("post", "https://unhedged.test/item", 180), ("get", "https://unhedged.test/list", 180)]
@@ -0,0 +1,71 @@
+import pickle
+from copy import deepcopy
+
+import pytest
+
+from app.inventory import TopologyRecord, EndpointRecord, Ref, to_fmc_json
+
+
+def get_topology(topology_id: str) -> dict:
+    return {
+        "id": topology_id, "name": f"P2P-{topology_id}", "type": "FTDS2SVpn", "topologyType": "POINT_TO_POINT",
+        "ikeV2Enabled": True, "links": {"self": f"https://fmc.test/ftds2svpns/{topology_id}"},
+        "metadata": {"timestamp": 0},
+        "ikeSettings": {"id": f"ike-{topology_id}", "type": "IkeSetting",
+                        "links": {"self": f"https://fmc.test/ftds2svpns/{topology_id}/ikesettings"}},
+        "endpoints": [{"id": f"e-{topology_id}", "name": "hub", "extranet": False, "peerType": "PEER",
+                       "device": {"id": "d1", "name": "hub", "type": "Device"},
+                       "protectedNetworks": {"networks": [{"id": "n1", "type": "Network"}]}}],
+    }
+
+
+def test_record_maps_like_the_json_object():
+    topology = get_topology("t1")
+    record = TopologyRecord(topology, {})
+    expected = {key: value for key, value in topology.items() if key not in {"links", "metadata"}}
+    assert to_fmc_json(record) == expected
+    assert record == expected
+    assert len(record) == len(expected)
+    assert set(record) == set(expected)
+    assert record["topologyType"] == "POINT_TO_POINT" and record["ikeV2Enabled"] is True
+    assert "links" not in record and record.get("description") is None
+    with pytest.raises(KeyError):
+        record["description"]
+
+
+def test_record_keeps_link_only_stubs():
+    # Not yet fetched sub-resources are recognized by their links
+    record = TopologyRecord(get_topology("t1"), {})
+    assert "links" in record["ikeSettings"]
+
+
+def test_records_share_values_copy_on_write():
+    shared_values = {}
+    first, second = TopologyRecord(get_topology("t1"), shared_values), TopologyRecord(get_topology("t2"), shared_values)
+    assert first.extra is second.extra
+    assert first["endpoints"][0]["device"] is second["endpoints"][0]["device"]
+    assert isinstance(first["endpoints"][0], EndpointRecord)
+    assert isinstance(first["endpoints"][0]["device"], Ref)
+    first["ikeV2Enabled"] = False
+    first["description"] = "changed"
+    assert second["ikeV2Enabled"] is True and "description" not in second
+
+
+def test_record_deletion():
+    record = TopologyRecord(get_topology("t1"), {})
+    length = len(record)
+    del record["name"]
+    del record["ikeV2Enabled"]
+    assert "name" not in record and "ikeV2Enabled" not in record and len(record) == length - 2
+    for key in ("name", "ikeV2Enabled"):
+        with pytest.raises(KeyError):
+            del record[key]
+    record["name"] = "renamed"
+    assert record["name"] == "renamed"
+
+
+def test_ref_is_interned_and_copyable():
+    ref = Ref("d1", "hub", "Device")
+    assert Ref("d1", "hub", "Device") is ref
+    assert deepcopy(ref) is ref and pickle.loads(pickle.dumps(ref)) is ref
+    assert dict(Ref("d1")) == {"id": "d1"}
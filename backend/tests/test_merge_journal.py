@@ -0,0 +1,71 @@
+import stat
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import pytest
+
+from app.fmc_recorder import get_cassette_entry, get_request_path
+from app.fmc_utils import rollback_merge
+from app.merge_journal import MergeJournal
+
+
+def begin_journal(**parameters) -> MergeJournal:
+    return MergeJournal.begin(**{
+        "host": "fmc.test", "domain_id": "global", "hub_device_id": "d1", "hns_topology_id": None,
+        "topology_name": "HNS-hub", "p2p_topology_ids": ["p1", "p2"], "override": {}, "previous_settings": {},
+        "topology_type": "HUB_AND_SPOKE", **parameters})
+
+
+def test_journal_resumes_after_restart():
+    journal = begin_journal()
+    journal.record("topology", topology_id="t1", created=True, topology={"id": "t1"})
+    journal.record("endpoints", endpoint_keys=["device:d1:i1", "device:d2:i2"], items=[{"id": "e1"}, {"id": "e2"}])
+    resumed = MergeJournal.load(journal.merge_id)
+    assert resumed.parameters["p2p_topology_ids"] == ["p1", "p2"]
+    assert resumed.is_done("topology") and not resumed.is_done("ikeSettings")
+    assert resumed.created_endpoint_keys == {"device:d1:i1", "device:d2:i2"}
+    assert resumed.created_endpoints == [{"id": "e1"}, {"id": "e2"}]
+    assert resumed.get_summary()["completed_steps"] == ["topology", "endpoints"]
+    assert journal.merge_id in [unfinished.merge_id for unfinished in MergeJournal.get_unfinished("fmc.test", "global")]
+    assert journal.merge_id not in [unfinished.merge_id for unfinished in MergeJournal.get_unfinished("fmc.test", "other")]
+    resumed.record("complete")
+    assert MergeJournal.load(journal.merge_id).is_finished
+    assert journal.merge_id not in [unfinished.merge_id
+                                    for unfinished in MergeJournal.get_unfinished("fmc.test", "global")]
+
+
+def test_journal_is_private():
+    journal = begin_journal(previous_settings={"ikeSettings": {"ikeV2Settings": {"manualPreSharedKey": "secret"}}})
+    assert stat.S_IMODE(journal.path.stat().st_mode) == 0o600
+    assert stat.S_IMODE(journal.path.parent.stat().st_mode) == 0o700
+
+
+def test_journal_load_stays_in_journal_dir():
+    with pytest.raises(KeyError):
+        MergeJournal.load("../sessions")
+
+
+def test_rollback_deletes_created_topology(replay, replay_fmc):
+    journal = begin_journal()
+    journal.record("topology", topology_id="t1", created=True, topology={"id": "t1"})
+    delete_path = get_request_path(f"{replay_fmc.configuration_url}/policy/ftds2svpns/t1")
+    adapter = replay([get_cassette_entry("DELETE", delete_path, {"id": "t1"})])
+    with ThreadPoolExecutor(2) as api_pool:
+        rollback_merge(replay_fmc, api_pool, journal)
+    assert ("DELETE", delete_path) in adapter.last_served
+
+
+def test_rollback_restores_existing_topology(replay, replay_fmc):
+    previous_ike_settings = {"id": "ike1", "type": "IkeSetting", "ikeV2Settings": {"manualPreSharedKey": "previous"}}
+    journal = begin_journal(hns_topology_id="t1", previous_settings={"ikeSettings": previous_ike_settings})
+    journal.record("topology", topology_id="t1", created=False, topology={"id": "t1"})
+    journal.record("ikeSettings", settings=previous_ike_settings)
+    journal.record("endpoints", endpoint_keys=["device:d2:i2"], items=[{"id": "e2"}])
+    topology_url = f"{replay_fmc.configuration_url}/policy/ftds2svpns/t1"
+    endpoint_path = get_request_path(f"{topology_url}/endpoints/e2")
+    ike_settings_path = get_request_path(f"{topology_url}/ikesettings/ike1")
+    adapter = replay([get_cassette_entry("DELETE", endpoint_path, {"id": "e2"}),
+                      get_cassette_entry("PUT", ike_settings_path, previous_ike_settings)])
+    with ThreadPoolExecutor(2) as api_pool:
+        rollback_merge(replay_fmc, api_pool, journal)
+    assert ("DELETE", endpoint_path) in adapter.last_served
+    assert ("PUT", ike_settings_path) in adapter.last_served
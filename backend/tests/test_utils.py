@@ -0,0 +1,128 @@
+import json
+import os
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+
+from app import utils
+from app.utils import RateLimiter, iter_json_array_items, get_canonical_digest, encrypt_text, decrypt_text, \
+    make_private_dir, iter_post_data_chunks
+
+LIST_RESPONSE = {
+    "links": {"self": "https://fmc.test/api/fmc_config/v1/domain/global/policy/ftds2svpns?offset=0&limit=2"},
+    "items": [{"id": "a", "name": "with ] and \"items\" inside", "nested": {"list": [1, [2, 3]]}},
+              {"id": "b", "name": "second", "description": None}],
+    "paging": {"offset": 0, "limit": 2, "count": 2, "pages": 1},
+}
+
+
+def get_chunks(text: str, size: int) -> list[str]:
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+def test_rate_limiter_burst_then_waits():
+    rate_limiter = RateLimiter(600, 3)
+    assert all(rate_limiter.acquire(blocking=False) for _ in range(3))
+    assert not rate_limiter.acquire(blocking=False)
+    start = monotonic()
+    assert rate_limiter.acquire()
+    assert monotonic() - start > 0.05
+
+
+def test_rate_limiter_refills():
+    rate_limiter = RateLimiter(600, 1)
+    assert rate_limiter.acquire(blocking=False)
+    assert not rate_limiter.acquire(blocking=False)
+    sleep(rate_limiter.interval * 1.5)
+    assert rate_limiter.acquire(blocking=False)
+
+
+def test_rate_limiter_shared_by_threads():
+    rate_limiter = RateLimiter(1200, 2)
+    threads = [Thread(target=lambda: [rate_limiter.acquire() for _ in range(2)]) for _ in range(4)]
+    start = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 8 requests, 2 of them in the burst and 6 at 0.05 s interval
+    assert monotonic() - start > 0.25
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 20])
+def test_iter_json_array_items_chunked(chunk_size):
+    text = json.dumps(LIST_RESPONSE)
+    assert list(iter_json_array_items(get_chunks(text, chunk_size), "items")) == LIST_RESPONSE["items"]
+
+
+@pytest.mark.parametrize("text", ['{"links": {}, "paging": {"count": 0}}', '{"items": []}', '{"items" : [ ] }'])
+def test_iter_json_array_items_empty(text):
+    assert list(iter_json_array_items(get_chunks(text, 3), "items")) == []
+
+
+def test_iter_json_array_items_truncated():
+    text = json.dumps(LIST_RESPONSE)
+    truncated = text[:text.index('"second"')]
+    items = iter_json_array_items(get_chunks(truncated, 5), "items")
+    assert next(items) == LIST_RESPONSE["items"][0]
+    with pytest.raises(json.JSONDecodeError):
+        next(items)
+
+
+def test_canonical_digest_ignores_ordering():
+    endpoint = {"device": {"id": "d1", "name": "hub"}, "protectedNetworks": {"networks": [{"id": "n1"}, {"id": "n2"}]}}
+    reordered = {"protectedNetworks": {"networks": [{"id": "n2"}, {"id": "n1"}]}, "device": {"name": "hub", "id": "d1"}}
+    keys = ["device", "protectedNetworks"]
+    assert get_canonical_digest(endpoint, keys, set()) == get_canonical_digest(reordered, keys, set())
+
+
+def test_canonical_digest_drops_keys_at_every_level():
+    keys = ["device", "extranetInfo"]
+    endpoint = {"id": "e1", "device": {"id": "d1"}, "extranetInfo": {"name": "peer"}}
+    read_back = {"id": "e2", "links": {"self": "url"}, "device": {"id": "d1", "links": {"self": "url"}},
+                 "extranetInfo": {"name": "peer", "preSharedKey": "secret"}}
+    dropped_keys = {"links", "preSharedKey"}
+    assert get_canonical_digest(endpoint, keys, dropped_keys) == get_canonical_digest(read_back, keys, dropped_keys)
+    assert get_canonical_digest(endpoint, keys, dropped_keys) != get_canonical_digest(
+        {**endpoint, "device": {"id": "d2"}}, keys, dropped_keys)
+
+
+def test_encrypted_text_round_trip():
+    encrypted = encrypt_text('{"access_token": "fmc-token"}', "oauth2-token")
+    assert "fmc-token" not in encrypted
+    assert decrypt_text(encrypted, "oauth2-token") == '{"access_token": "fmc-token"}'
+    with pytest.raises(ValueError):
+        decrypt_text(encrypted, "other-token")
+
+
+def test_make_private_dir(tmp_path):
+    created = tmp_path / "created" / "store"
+    make_private_dir(str(created))
+    assert created.stat().st_mode & 0o777 == 0o700
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    os.chmod(shared, 0o755)
+    with pytest.raises(PermissionError):
+        make_private_dir(str(shared))
+    # Not chmoded
+    assert shared.stat().st_mode & 0o777 == 0o755
+    os.chmod(shared, 0o700)
+    make_private_dir(str(shared))
+
+
+def test_post_data_chunks_item_limit():
+    items = ({"id": str(index)} for index in range(2500))
+    chunks = list(iter_post_data_chunks(items))
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+    assert [item["id"] for chunk in chunks for item in chunk] == [str(index) for index in range(2500)]
+
+
+def test_post_data_chunks_byte_limit(monkeypatch):
+    monkeypatch.setattr(utils, "BULK_POST_BYTE_LIMIT", 100)
+    items = [{"name": "x" * 20}] * 7 + [{"name": "x" * 200}, {"name": "y"}]
+    chunks = list(iter_post_data_chunks(items))
+    # 3 items of 33 bytes per chunk, the oversized item alone
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1, 1, 1]
+    assert [item for chunk in chunks for item in chunk] == items
+    assert all(sum(len(json.dumps(item)) + 1 for item in chunk) <= 100 for chunk in chunks if len(chunk) > 1)
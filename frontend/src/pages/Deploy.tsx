@@ -1,10 +1,22 @@
 import {Container, Jumbotron} from "react-bootstrap";
 import Button from "react-bootstrap/Button";
+import {auth, backendRoot} from "../States";
 import {post} from "../utils";
 
 function deployTopology(callback: any) {
-    post("deploy", () => {
-        callback();
+    post("deploy", ({job_id}: { job_id: string }) => {
+        if (auth.token === undefined) return;
+        const url = `${backendRoot}/deploy/status?` + new URLSearchParams({job_id: job_id, token: auth.token});
+        const eventSource = new EventSource(url);
+        eventSource.addEventListener("phase", (event: any) => console.log("deployment", JSON.parse(event.data)));
+        eventSource.addEventListener("done", () => {
+            eventSource.close();
+            callback();
+        });
+        eventSource.addEventListener("failed", (event: any) => {
+            eventSource.close();
+            window.alert(`Deployment failed.\n${JSON.parse(event.data).detail}`);
+        });
     }, 5);
 }
 
@@ -9,7 +9,8 @@ const deviceContext: { devices: any[] } = {devices: []};
 function getDevices(callback: any) {
     get("devices", responseData => {
         console.log("Devices", responseData);
-        deviceContext.devices = responseData;
+        // Devices with the most merge candidates first
+        deviceContext.devices = responseData.sort((a: any, b: any) => (b.vpn.p2pTopologies ?? 0) - (a.vpn.p2pTopologies ?? 0));
         callback();
     }, 5)
 }
@@ -25,6 +26,9 @@ function Device() {
                             getP2pTopologies(() => pageState.setPage(<P2pTopologies/>));
                         }}>
                             {device.name}
+                            {device.vpn.p2pTopologies !== null &&
+                            <small className="text-muted"> ({device.vpn.p2pTopologies} P2P, {device.vpn.hnsTopologies} HNS
+                                {device.vpn.conflictGroups !== null && `, ${device.vpn.conflictGroups} setting groups`})</small>}
                         </ListGroup.Item>
                     ))
                 }
@@ -30,6 +30,11 @@ function addEventListener(task: string, callback: () => void) {
             callback();
         }
     );
+    eventSource.addEventListener("timeout", () => {
+            eventSource.close();
+            window.alert(`Timed out waiting for ${task}. Please check the backend logs.`);
+        }
+    );
 }
 
 function get(path: string, responseCallback: (responseData: any) => any, secondsEstimate: number, params: any = {}, task?: string): void {